@@ -1,6 +1,8 @@
 # API Handler
 
-from fastapi import FastAPI, HTTPException
+import datetime
+
+from fastapi import FastAPI, HTTPException, Query
 from pydantic import BaseModel
 import uvicorn # For running the FastAPI app
 
@@ -17,6 +19,7 @@ class TaskRequest(BaseModel):
     prompt: str
     profile: str = "General" # Default profile
     role: str = "Chat-Agent" # Default role
+    priority: int | None = None # Optional explicit priority (higher is more urgent)
 
 class TaskResponse(BaseModel):
     task_id: str | None = None
@@ -24,6 +27,21 @@ class TaskResponse(BaseModel):
     result: str | None = None
     error: str | None = None
 
+class TaskSummary(BaseModel):
+    task_id: str
+    status: str
+    role: str | None = None
+    profile: str | None = None
+    created_at: str
+    updated_at: str
+    finalized_at: str | None = None
+
+class TaskListResponse(BaseModel):
+    tasks: list[TaskSummary]
+    next_cursor: str | None = None
+    total: int
+    status_counts: dict[str, int]
+
 class MetricsResponse(BaseModel):
     server_status: str
     uptime_seconds: float
@@ -34,6 +52,30 @@ class MetricsResponse(BaseModel):
     average_response_time_ms: float
     success_rate: float
     llm_status: dict
+    mcp_publisher_pool: dict = {}
+    mcp_publisher_confirms: dict = {}
+    engine_health: dict = {}
+    ollama_scheduling: dict = {}
+
+class DeadLetterListResponse(BaseModel):
+    count: int
+    dead_letters: list[dict]
+
+class DeadLetterReplayRequest(BaseModel):
+    queue: str | None = None # Source queue; all queues when omitted
+    limit: int | None = None # Maximum number of messages to replay; all when omitted
+
+class DeadLetterReplayResponse(BaseModel):
+    replayed: int
+
+class OllamaEndpointRequest(BaseModel):
+    url: str
+    max_concurrency: int | None = None # Defaults to ollama.max_concurrency
+    models: list[str] | None = None # Models routed to this host; all it has pulled when omitted
+    max_loaded_models: int | None = None # Models that fit in its memory at once; learned from `ps` when omitted
+
+class OllamaEndpointListResponse(BaseModel):
+    endpoints: list[dict]
 
 # Initialize FastAPI app
 app = FastAPI()
@@ -60,7 +102,8 @@ def create_app():
     # Initialize the Orchestration Engine on startup
     @app.on_event("startup")
     async def startup_event():
-        get_orchestration_engine()
+        orchestration_engine = get_orchestration_engine()
+        await orchestration_engine.connect_async_mcp()
         print("FastAPI app started and OrchestrationEngine is ready.")
 
     @app.on_event("shutdown")
@@ -68,7 +111,13 @@ def create_app():
         orchestration_engine = get_orchestration_engine()
         if orchestration_engine and orchestration_engine.mcp_handler:
             print("Closing MCP Handler connection...")
+            await orchestration_engine.close_async_mcp()
             orchestration_engine.mcp_handler.close()
+        if orchestration_engine:
+            if orchestration_engine.task_recovery:
+                orchestration_engine.task_recovery.close()
+            orchestration_engine.load_balancer.close()
+            orchestration_engine.task_state_manager.close()
 
     @app.post("/api/v1/tasks", response_model=TaskResponse)
     async def create_task(request: TaskRequest):
@@ -77,11 +126,15 @@ def create_app():
             raise HTTPException(status_code=503, detail="Orchestration Engine not available.")
 
         try:
-            task_id = orchestration_engine.process_request(request.prompt)
+            # Only an explicitly requested profile overrides the diagnosed one.
+            profile = request.profile if "profile" in request.model_fields_set else None
+            task_id = await orchestration_engine.process_request_async(
+                request.prompt, priority=request.priority, profile=profile
+            )
             
             if task_id:
-                # The task is now processed asynchronously.
-                # We can immediately return the task ID with a "Queued" status.
+                # The task is now processed asynchronously. With publisher confirms enabled
+                # the broker has already acked (stored) the message at this point.
                 return TaskResponse(task_id=task_id, status="Queued")
             else:
                 raise HTTPException(status_code=500, detail="Failed to publish task to the queue.")
@@ -90,8 +143,44 @@ def create_app():
             print(f"Error in create_task endpoint: {e}")
             raise HTTPException(status_code=500, detail=f"Error processing task: {str(e)}")
 
+    def _local_timestamp(value: datetime.datetime | None) -> str | None:
+        """Task timestamps are stored as local ISO times; aware datetimes are converted to them."""
+        if value is None:
+            return None
+        if value.tzinfo is not None:
+            value = value.astimezone().replace(tzinfo=None)
+        return value.isoformat()
+
+    # Blocking index queries, so this runs in FastAPI's threadpool (plain def).
+    @app.get("/api/v1/tasks", response_model=TaskListResponse)
+    def list_tasks(
+        status: str | None = None,
+        role: str | None = None,
+        profile: str | None = None,
+        created_after: datetime.datetime | None = None,
+        created_before: datetime.datetime | None = None,
+        limit: int = Query(50, ge=1, le=1000),
+        cursor: str | None = None,
+    ):
+        orchestration_engine = get_orchestration_engine()
+        if not orchestration_engine:
+            raise HTTPException(status_code=503, detail="Orchestration Engine not available.")
+
+        try:
+            listing = orchestration_engine.task_state_manager.list_tasks(
+                status=status, role=role, profile=profile,
+                created_after=_local_timestamp(created_after), created_before=_local_timestamp(created_before),
+                limit=limit, cursor=cursor,
+            )
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        if listing is None:
+            raise HTTPException(status_code=503, detail="Task index is disabled (task_state.index.enabled).")
+        return TaskListResponse(**listing)
+
+    # Reads the task state and resolves blob references from disk, so this runs in FastAPI's threadpool (plain def).
     @app.get("/api/v1/tasks/{task_id}", response_model=TaskResponse)
-    async def get_task_status(task_id: str):
+    def get_task_status(task_id: str):
         orchestration_engine = get_orchestration_engine()
         if not orchestration_engine:
             raise HTTPException(status_code=503, detail="Orchestration Engine not available.")
@@ -101,11 +190,13 @@ def create_app():
             raise HTTPException(status_code=404, detail="Task not found.")
 
         result = task_state.get("result") or task_state.get("payload", {}).get("result")
+        # Large results are stored as blob references; only the returned fields are loaded.
+        task_state_manager = orchestration_engine.task_state_manager
         return TaskResponse(
             task_id=task_id,
             status=task_state.get("status"),
-            result=result,
-            error=task_state.get("error")
+            result=task_state_manager.resolve(result),
+            error=task_state_manager.resolve(task_state.get("error"))
         )
 
     @app.get("/api/v1/metrics", response_model=MetricsResponse)
@@ -125,9 +216,64 @@ def create_app():
             metrics_data["llm_status"]["OpenAI Engine"] = "active"
         elif orchestration_engine.llm_engines.get('openai'):
             metrics_data["llm_status"]["OpenAI Engine"] = "inactive (API key missing)"
+        metrics_data["engine_health"] = orchestration_engine.load_balancer.get_engine_health()
+        if orchestration_engine.llm_engines.get('ollama'):
+            metrics_data["ollama_scheduling"] = orchestration_engine.llm_engines['ollama'].get_scheduling_stats()
+
+        if orchestration_engine.mcp_handler:
+            metrics_data["mcp_publisher_pool"] = orchestration_engine.mcp_handler.get_publisher_pool_stats()
+            metrics_data["mcp_publisher_confirms"] = orchestration_engine.mcp_handler.get_publisher_confirm_stats()
 
         return MetricsResponse(**metrics_data)
 
+    # Blocking broker calls, so these run in FastAPI's threadpool (plain def).
+    @app.get("/api/v1/dead-letters", response_model=DeadLetterListResponse)
+    def list_dead_letters(queue: str | None = None, limit: int = 100):
+        orchestration_engine = get_orchestration_engine()
+        if not orchestration_engine or not orchestration_engine.mcp_handler:
+            raise HTTPException(status_code=503, detail="MCP Handler not available.")
+
+        dead_letters = orchestration_engine.mcp_handler.list_dead_letters(queue, limit=limit)
+        return DeadLetterListResponse(count=len(dead_letters), dead_letters=dead_letters)
+
+    @app.post("/api/v1/dead-letters/replay", response_model=DeadLetterReplayResponse)
+    def replay_dead_letters(request: DeadLetterReplayRequest):
+        orchestration_engine = get_orchestration_engine()
+        if not orchestration_engine or not orchestration_engine.mcp_handler:
+            raise HTTPException(status_code=503, detail="MCP Handler not available.")
+
+        replayed = orchestration_engine.mcp_handler.replay_dead_letters(request.queue, limit=request.limit)
+        return DeadLetterReplayResponse(replayed=replayed)
+
+    def get_ollama_engine():
+        orchestration_engine = get_orchestration_engine()
+        ollama_engine = orchestration_engine.llm_engines.get('ollama') if orchestration_engine else None
+        if not ollama_engine:
+            raise HTTPException(status_code=503, detail="Ollama engine not available.")
+        return ollama_engine
+
+    @app.get("/api/v1/ollama/endpoints", response_model=OllamaEndpointListResponse)
+    def list_ollama_endpoints():
+        return OllamaEndpointListResponse(endpoints=get_ollama_engine().get_endpoint_stats())
+
+    # Adding a host lists the models of the pool, blocking calls.
+    @app.post("/api/v1/ollama/endpoints", response_model=OllamaEndpointListResponse)
+    def add_ollama_endpoint(request: OllamaEndpointRequest):
+        ollama_engine = get_ollama_engine()
+        ollama_engine.add_endpoint(request.url, request.max_concurrency, request.models, request.max_loaded_models)
+        try:
+            ollama_engine.list_models()
+        except ConnectionError:
+            pass # Unreachable hosts stay in the pool and are listed again by the health prober.
+        return OllamaEndpointListResponse(endpoints=ollama_engine.get_endpoint_stats())
+
+    @app.delete("/api/v1/ollama/endpoints", response_model=OllamaEndpointListResponse)
+    def remove_ollama_endpoint(url: str):
+        ollama_engine = get_ollama_engine()
+        if not ollama_engine.remove_endpoint(url):
+            raise HTTPException(status_code=404, detail=f"Ollama endpoint '{url}' not found.")
+        return OllamaEndpointListResponse(endpoints=ollama_engine.get_endpoint_stats())
+
     return app
 
 # The global 'app' variable is now created by the factory in main.py
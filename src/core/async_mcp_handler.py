@@ -0,0 +1,275 @@
+# Async MCP Handler
+
+import asyncio
+import functools
+import time
+
+import aio_pika
+
+from src.config.config_loader import config
+from src.core.mcp_topology import TopologyRegistry
+from src.core.mcp_codec import get_codec
+from src.core.blob_store import BlobStore
+from src.core.retry_policy import (
+    ATTEMPTS_HEADER, DEAD_LETTER_EXCHANGE, FAILED_AT_HEADER, LAST_ERROR_HEADER, ORIGINAL_QUEUE_HEADER,
+    RetryPolicy, dead_letter_queue,
+)
+
+class AsyncMCPHandler:
+    """
+    asyncio-native counterpart of MCPHandler built on aio-pika.
+    It exposes the same operations (connect, publish, subscribe, consume, close)
+    as coroutines so the FastAPI handlers can await them without stalling the
+    event loop on a broker round trip. The blocking MCPHandler remains available
+    for scripts and for the agent threads. Failed messages go through the same
+    retry tiers and dead-letter queues as with MCPHandler.
+    """
+    def __init__(self, topology: TopologyRegistry = None, blob_store: BlobStore = None):
+        """
+        Initializes the asynchronous MCP Handler for RabbitMQ communication.
+        Pass the blocking handler's `topology` to share one set of declarations.
+        Payload values above the blob store's threshold are published as blob references.
+        """
+        mcp_config = config.get("mcp_config", {})
+        self.rabbitmq_host = mcp_config.get("rabbitmq_host", "localhost")
+        self.codec = get_codec(mcp_config.get("codec", "json"))
+        self.blob_store = blob_store or BlobStore()
+        self.publisher_confirms = mcp_config.get("publisher_confirms", False)
+        self.connection = None
+        self.channel = None
+        self.topology = topology or TopologyRegistry()
+        self.retry_policy = RetryPolicy()
+        self.retry_policy.register_topology(self.topology)
+        self.declared_queues = {}
+        self.declared_exchanges = {}
+        self.callbacks = {}
+        self.consumer_tags = {}
+        self.is_consuming = False
+        print("Async MCP Handler initialized for RabbitMQ.")
+
+    async def connect(self):
+        """
+        Establishes a robust (auto-reconnecting) connection to the RabbitMQ broker.
+        """
+        if self.connection and not self.connection.is_closed:
+            return
+
+        try:
+            print(f"Connecting asynchronously to RabbitMQ broker at {self.rabbitmq_host}...")
+            self.connection = await aio_pika.connect_robust(host=self.rabbitmq_host)
+            # In confirm mode each awaited publish resolves on the broker's ack; concurrent
+            # requests keep many publishes in flight on the same channel.
+            self.channel = await self.connection.channel(publisher_confirms=self.publisher_confirms)
+            # Declarations are cached per connection; drop the cache whenever it reconnects.
+            self.connection.reconnect_callbacks.add(self._on_reconnect)
+            await self.declare_topology()
+            print("Successfully connected to RabbitMQ broker (asyncio transport).")
+        except (aio_pika.exceptions.AMQPConnectionError, OSError) as e:
+            print(f"Error connecting to RabbitMQ: {e}")
+            self.connection = None
+            self.channel = None
+            raise
+
+    def _on_reconnect(self, *args):
+        """Forgets declared queues so they are re-declared on the new connection."""
+        self.declared_queues.clear()
+        self.declared_exchanges.clear()
+
+    async def declare_topology(self):
+        """
+        Declares every registered exchange, queue and binding in one batch.
+        """
+        if not self.channel:
+            print("Async MCP channel not available. Cannot declare topology.")
+            return
+        for exchange_name in list(self.topology.exchanges.keys()):
+            await self._declare_exchange(exchange_name)
+        for queue_name in list(self.topology.queues.keys()):
+            await self._declare_queue(queue_name)
+        for queue_name, exchange_name, routing_key in list(self.topology.bindings):
+            queue = await self._declare_queue(queue_name)
+            await queue.bind(await self._declare_exchange(exchange_name), routing_key=routing_key)
+
+    async def _declare_exchange(self, exchange_name: str):
+        """Declares an exchange once per connection and returns it."""
+        exchange = self.declared_exchanges.get(exchange_name)
+        if exchange is None:
+            if exchange_name not in self.topology.exchanges:
+                self.topology.register_exchange(exchange_name)
+            options = self.topology.exchanges[exchange_name]
+            exchange = await self.channel.declare_exchange(
+                exchange_name, options["exchange_type"], durable=options["durable"], arguments=options["arguments"]
+            )
+            self.declared_exchanges[exchange_name] = exchange
+        return exchange
+
+    async def _declare_queue(self, queue_name: str):
+        """Declares a queue once per connection and returns it."""
+        queue = self.declared_queues.get(queue_name)
+        if queue is None:
+            if not self.topology.is_registered(queue_name):
+                self.topology.register_queue(queue_name)
+            options = self.topology.queues[queue_name]
+            queue = await self.channel.declare_queue(queue_name, durable=options["durable"], arguments=options["arguments"])
+            self.declared_queues[queue_name] = queue
+        return queue
+
+    async def _encode(self, message: dict) -> bytes:
+        """
+        Encodes a message, moving large values to the blob store first (claim check).
+        Blobs are written in the default executor, off the event loop.
+        """
+        if self.blob_store.enabled:
+            message = await asyncio.get_running_loop().run_in_executor(None, self.blob_store.offload, message)
+        return self.codec.encode(message)
+
+    async def publish_message(self, queue_name: str, message: dict, priority: int = None) -> bool:
+        """
+        Publishes a message to a specified RabbitMQ queue.
+        Returns True if the message was handed to the broker, or, with publisher
+        confirms enabled, once the broker has acked it.
+        """
+        return await self.publish_to_exchange('', queue_name, message, priority=priority)
+
+    async def publish_to_exchange(self, exchange_name: str, routing_key: str, message: dict, priority: int = None) -> bool:
+        """
+        Publishes a message to an exchange with a routing key. The default exchange ('')
+        routes straight to the queue named by the routing key.
+        """
+        if not self.channel:
+            print("Async MCP channel not available. Cannot publish message.")
+            return False
+
+        destination = f"{exchange_name}/{routing_key}" if exchange_name else routing_key
+        try:
+            if exchange_name:
+                exchange = await self._declare_exchange(exchange_name)
+            else:
+                await self._declare_queue(routing_key)
+                exchange = self.channel.default_exchange
+            await exchange.publish(
+                aio_pika.Message(
+                    body=await self._encode(message),
+                    content_type=self.codec.content_type,
+                    priority=priority,
+                    delivery_mode=aio_pika.DeliveryMode.PERSISTENT,  # make message persistent
+                ),
+                routing_key=routing_key,
+            )
+            print(f"Published to '{destination}' (task {message.get('task_id')}).")
+            return True
+        except Exception as e:
+            print(f"Error publishing message to RabbitMQ: {e}")
+            return False
+
+    async def subscribe_to_channel(self, queue_name: str, callback):
+        """
+        Registers a callback for a specific queue. The callback receives the raw body
+        and its content_type, and may be a coroutine function or a regular function;
+        regular functions run in the default executor.
+        """
+        self.callbacks[queue_name] = callback
+        self.retry_policy.register_dead_letter_queue(self.topology, queue_name)
+        print(f"Callback registered for queue '{queue_name}'.")
+        if self.is_consuming and self.channel:
+            await self._consume_queue(queue_name)
+
+    async def start_consuming(self):
+        """
+        Starts consuming messages from all subscribed queues on the running event loop.
+        """
+        if not self.channel:
+            print("Async MCP channel not available. Cannot start consuming.")
+            return
+
+        if self.is_consuming:
+            print("Already consuming messages.")
+            return
+
+        self.is_consuming = True
+        for queue_name in list(self.callbacks.keys()):
+            await self._consume_queue(queue_name)
+        print("Started consuming messages on the event loop.")
+
+    async def _consume_queue(self, queue_name: str):
+        """Declares a queue and its dead-letter queue, and attaches the dispatching consumer to it."""
+        dlq = await self._declare_queue(dead_letter_queue(queue_name))
+        await dlq.bind(await self._declare_exchange(DEAD_LETTER_EXCHANGE), routing_key=queue_name)
+        queue = await self._declare_queue(queue_name)
+        self.consumer_tags[queue_name] = await queue.consume(
+            functools.partial(self._on_message, queue_name), no_ack=False
+        )
+
+    async def _on_message(self, queue_name: str, message):
+        """Internal callback to dispatch messages to the correct handler."""
+        callback = self.callbacks.get(queue_name)
+        if callback is None:
+            print(f"No callback registered for queue '{queue_name}'. Discarding message.")
+            await message.ack()
+            return
+
+        try:
+            if asyncio.iscoroutinefunction(callback):
+                await callback(message.body, message.content_type)
+            else:
+                loop = asyncio.get_running_loop()
+                await loop.run_in_executor(None, callback, message.body, message.content_type)
+            await message.ack()
+        except Exception as e:
+            print(f"Error processing message from '{queue_name}': {e}")
+            # Acked once parked in a retry tier or the DLQ; requeued after a back-off if neither took it.
+            if await self._handle_failure(queue_name, message, e):
+                await message.ack()
+            else:
+                await asyncio.sleep(self.retry_policy.requeue_delay_ms / 1000)
+                await message.nack(requeue=True)
+
+    async def _handle_failure(self, queue_name: str, message, error: Exception) -> bool:
+        """
+        Republishes a failed message to the next retry tier, or to the dead-letter
+        exchange once it has used up its attempts. Returns False if the publish failed.
+        """
+        headers = dict(message.headers or {})
+        attempts = int(headers.get(ATTEMPTS_HEADER, 0)) + 1
+        headers[ATTEMPTS_HEADER] = attempts
+        headers[ORIGINAL_QUEUE_HEADER] = queue_name
+        headers[LAST_ERROR_HEADER] = str(error)[:1024]
+        headers[FAILED_AT_HEADER] = time.time()
+
+        if self.retry_policy.should_retry(attempts):
+            delay_ms = self.retry_policy.delay_for(attempts)
+            print(f"Retrying message from '{queue_name}' in {delay_ms} ms (attempt {attempts}/{self.retry_policy.max_attempts}).")
+            exchange_name = self.retry_policy.tier_name(delay_ms)
+        else:
+            print(f"Message from '{queue_name}' failed {attempts} time(s). Moving it to the dead-letter queue.")
+            exchange_name = DEAD_LETTER_EXCHANGE
+        try:
+            exchange = await self._declare_exchange(exchange_name)
+            # Routed by the source queue name, which a retry tier keeps when it dead-letters back.
+            await exchange.publish(
+                aio_pika.Message(
+                    body=message.body,
+                    content_type=message.content_type,
+                    priority=message.priority,
+                    headers=headers,
+                    delivery_mode=aio_pika.DeliveryMode.PERSISTENT,
+                ),
+                routing_key=queue_name,
+            )
+            return True
+        except Exception as e:
+            print(f"Error republishing message to '{exchange_name}/{queue_name}': {e}")
+            return False
+
+    async def close(self):
+        """
+        Closes the connection to RabbitMQ.
+        """
+        self.is_consuming = False
+        if self.connection and not self.connection.is_closed:
+            await self.connection.close()
+            print("Async RabbitMQ connection closed.")
+        self.connection = None
+        self.channel = None
+        self.declared_queues.clear()
+        self.declared_exchanges.clear()
@@ -0,0 +1,164 @@
+# Blob Store
+
+import hashlib
+import os
+import tempfile
+
+from src.config.config_loader import config
+
+BLOB_REFERENCE_KEY = "$blob"
+
+class BlobStore:
+    """
+    Local content-addressed store for large payload values (claim-check pattern).
+    Values larger than `threshold_bytes` are written once under their sha256 digest
+    and replaced by a small reference dict, so only the reference travels through
+    the MCP broker and the task state files. Identical payloads are stored once.
+    Storing a value that is already there refreshes its blob's mtime, so the mtime is
+    the last time any task stored it; the history retention policy only deletes blobs
+    that no retained task references and that were not stored again since its cutoff.
+    """
+    def __init__(self, base_dir: str = None, threshold_bytes: int = None, enabled: bool = None):
+        """
+        Initializes the store from the `blob_store` configuration; arguments override it.
+        """
+        blob_config = config.get("blob_store", {})
+        self.base_dir = base_dir or blob_config.get("base_dir", "src/tasks_state/blobs")
+        self.threshold_bytes = threshold_bytes if threshold_bytes is not None else blob_config.get("threshold_bytes", 262144)
+        self.enabled = enabled if enabled is not None else blob_config.get("enabled", True)
+        os.makedirs(self.base_dir, exist_ok=True)
+
+    def _path_for(self, digest: str) -> str:
+        """Returns the file path of a blob, fanned out by the first two hex digits."""
+        return os.path.join(self.base_dir, digest[:2], digest)
+
+    def put(self, data: bytes | str) -> dict:
+        """
+        Stores a value and returns its reference. Strings are stored as UTF-8.
+        """
+        encoding = None
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+            encoding = "utf-8"
+        digest = hashlib.sha256(data).hexdigest()
+        path = self._path_for(digest)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Write to a temporary file and rename, so readers never see a partial blob.
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    f.write(data)
+                os.replace(tmp_path, path)
+            except Exception:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+        return {BLOB_REFERENCE_KEY: digest, "size": len(data), "encoding": encoding}
+
+    @staticmethod
+    def is_reference(value) -> bool:
+        """Returns True if a value is a blob reference."""
+        return isinstance(value, dict) and BLOB_REFERENCE_KEY in value
+
+    def exists(self, digest: str) -> bool:
+        """Returns True if a blob is stored."""
+        return os.path.exists(self._path_for(digest))
+
+    def get(self, reference: dict) -> bytes | str:
+        """
+        Returns the value a reference points to, decoded back to str if it was stored as one.
+        Raises FileNotFoundError if the blob does not exist, ValueError if it is truncated.
+        """
+        digest = reference[BLOB_REFERENCE_KEY]
+        with open(self._path_for(digest), "rb") as f:
+            data = f.read()
+        if reference.get("size") is not None and len(data) != reference["size"]:
+            raise ValueError(f"Blob {digest} has {len(data)} bytes, expected {reference['size']}.")
+        encoding = reference.get("encoding")
+        return data.decode(encoding) if encoding else data
+
+    def delete(self, digest: str, stored_before: float) -> bool:
+        """
+        Deletes a blob unless it was stored (put) at or after `stored_before` (a time.time()
+        value). The blob is renamed away before its mtime is checked, so a concurrent put
+        either refreshes it first (and it is kept) or finds it gone and writes it again.
+        Returns True if the blob was deleted.
+        """
+        path = self._path_for(digest)
+        doomed = os.path.join(os.path.dirname(path), f".del-{digest}")
+        try:
+            os.replace(path, doomed)
+        except FileNotFoundError:
+            return False
+        if os.stat(doomed).st_mtime >= stored_before:
+            os.replace(doomed, path)
+            return False
+        os.remove(doomed)
+        return True
+
+    @classmethod
+    def digests_in(cls, value) -> set:
+        """Returns the digests of every blob reference in `value`, at any depth of dicts and lists."""
+        if cls.is_reference(value):
+            return {value[BLOB_REFERENCE_KEY]}
+        if isinstance(value, dict):
+            items = value.values()
+        elif isinstance(value, list):
+            items = value
+        else:
+            return set()
+        digests = set()
+        for item in items:
+            digests |= cls.digests_in(item)
+        return digests
+
+    def _size_of(self, value) -> int:
+        """Returns the stored size of a str/bytes value (upper bound for str, without encoding it)."""
+        if isinstance(value, str):
+            # UTF-8 uses at most 4 bytes per character; the exact size is only needed near the threshold.
+            if len(value) * 4 < self.threshold_bytes:
+                return len(value)
+            return len(value.encode("utf-8"))
+        return len(value)
+
+    def offload(self, value):
+        """
+        Returns a copy of `value` in which every str/bytes larger than the threshold,
+        at any depth of dicts and lists, is replaced by a blob reference.
+        Small values are returned as they are, without copying.
+        """
+        if not self.enabled:
+            return value
+        if isinstance(value, (str, bytes)):
+            if self._size_of(value) > self.threshold_bytes:
+                return self.put(value)
+            return value
+        if isinstance(value, dict):
+            if self.is_reference(value):
+                return value
+            offloaded = {key: self.offload(item) for key, item in value.items()}
+            return offloaded if any(offloaded[key] is not value[key] for key in value) else value
+        if isinstance(value, list):
+            offloaded = [self.offload(item) for item in value]
+            return offloaded if any(new is not old for new, old in zip(offloaded, value)) else value
+        return value
+
+    def resolve(self, value):
+        """
+        Returns `value` with every blob reference replaced by the stored value.
+        A reference whose blob is missing is left in place.
+        """
+        if self.is_reference(value):
+            try:
+                return self.get(value)
+            except (FileNotFoundError, ValueError) as e:
+                print(f"Could not resolve blob {value.get(BLOB_REFERENCE_KEY)}: {e}")
+                return value
+        if isinstance(value, dict):
+            return {key: self.resolve(item) for key, item in value.items()}
+        if isinstance(value, list):
+            return [self.resolve(item) for item in value]
+        return value
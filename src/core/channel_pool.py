@@ -0,0 +1,166 @@
+# Publisher Channel Pool
+
+import queue
+import threading
+import time
+from contextlib import contextmanager
+
+import pika
+
+class PublisherChannelPool:
+    """
+    A bounded pool of publisher channels with checkout/return semantics.
+    pika's BlockingConnection (and every channel on it) must only be used by one
+    thread at a time, so each pooled channel owns its own connection. A thread
+    checks a channel out, publishes, and returns it; when every channel is busy
+    the caller waits for one to be returned and the wait is recorded.
+    """
+    def __init__(self, rabbitmq_host: str, size: int = 8, checkout_timeout: float = 5.0, on_open=None):
+        """
+        Initializes the pool. Connections are opened lazily, up to `size`.
+        `on_open` is called with every newly opened channel (e.g. to declare topology).
+        """
+        self.rabbitmq_host = rabbitmq_host
+        self.on_open = on_open
+        self.size = max(1, size)
+        self.checkout_timeout = checkout_timeout
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._created = 0
+        self._in_use = 0
+        self._closed = False
+
+        # Pool wait metrics
+        self.checkouts = 0
+        self.waits = 0
+        self.timeouts = 0
+        self.total_wait_time = 0.0
+        self.max_wait_time = 0.0
+        self.discarded = 0
+
+    def _open_channel(self):
+        """Opens a dedicated connection and channel for the pool."""
+        connection = pika.BlockingConnection(pika.ConnectionParameters(host=self.rabbitmq_host))
+        channel = connection.channel()
+        if self.on_open:
+            try:
+                self.on_open(channel)
+            except Exception:
+                connection.close()
+                raise
+        return connection, channel
+
+    def _checkout(self):
+        """Takes an idle channel, opens a new one if below capacity, or waits for a return."""
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            can_create = self._created < self.size
+            if can_create:
+                self._created += 1
+        if can_create:
+            try:
+                return self._open_channel()
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+
+        wait_start = time.perf_counter()
+        try:
+            entry = self._idle.get(timeout=self.checkout_timeout)
+        except queue.Empty:
+            with self._lock:
+                self.timeouts += 1
+            raise TimeoutError(f"No publisher channel became available within {self.checkout_timeout}s.")
+        waited = time.perf_counter() - wait_start
+        with self._lock:
+            self.waits += 1
+            self.total_wait_time += waited
+            self.max_wait_time = max(self.max_wait_time, waited)
+        return entry
+
+    def _discard(self, entry):
+        """Closes a broken channel and frees its slot in the pool."""
+        connection, _ = entry
+        try:
+            if connection.is_open:
+                connection.close()
+        except Exception:
+            pass
+        with self._lock:
+            self._created -= 1
+            self.discarded += 1
+
+    @contextmanager
+    def channel(self):
+        """
+        Context manager that checks a channel out of the pool and returns it afterwards.
+        Channels that fail while checked out are discarded instead of returned.
+        """
+        if self._closed:
+            raise RuntimeError("Publisher channel pool is closed.")
+
+        entry = self._checkout()
+        connection, channel = entry
+        if not (connection.is_open and channel.is_open):
+            # The broker dropped this connection while it was idle; replace it.
+            self._discard(entry)
+            with self._lock:
+                self._created += 1
+            try:
+                entry = self._open_channel()
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+
+        with self._lock:
+            self.checkouts += 1
+            self._in_use += 1
+        try:
+            yield entry[1]
+        except Exception:
+            self._discard(entry)
+            entry = None
+            raise
+        finally:
+            with self._lock:
+                self._in_use -= 1
+            if entry is not None:
+                if self._closed:
+                    self._discard(entry)
+                else:
+                    self._idle.put(entry)
+
+    def get_stats(self) -> dict:
+        """
+        Returns pool usage and wait metrics.
+        """
+        with self._lock:
+            return {
+                "size": self.size,
+                "open_channels": self._created,
+                "in_use": self._in_use,
+                "checkouts": self.checkouts,
+                "waits": self.waits,
+                "timeouts": self.timeouts,
+                "discarded": self.discarded,
+                "average_wait_ms": (self.total_wait_time / self.waits * 1000) if self.waits else 0.0,
+                "max_wait_ms": self.max_wait_time * 1000,
+            }
+
+    def close(self):
+        """
+        Closes every idle pooled connection. Channels still checked out are closed on return.
+        """
+        self._closed = True
+        while True:
+            try:
+                entry = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._discard(entry)
@@ -0,0 +1,205 @@
+# Confirming Publisher
+
+import functools
+import threading
+from concurrent.futures import Future
+
+import pika
+
+class ConfirmingPublisher:
+    """
+    Publishes messages with RabbitMQ publisher confirms without waiting for one
+    confirm per message. A dedicated I/O thread owns a pika SelectConnection in
+    confirm mode; any thread may call publish(), which returns a Future that is
+    resolved with True (ack) or False (nack) once the broker confirms it.
+    Many publishes can be outstanding at once and the broker acknowledges them in
+    batches (`multiple=True`), so each ack frame resolves every Future up to its tag.
+    """
+    def __init__(self, rabbitmq_host: str, topology=None, max_outstanding: int = 1000):
+        """
+        Initializes the publisher. `topology` is declared when the channel opens.
+        `max_outstanding` bounds the number of unconfirmed messages (backpressure).
+        """
+        self.rabbitmq_host = rabbitmq_host
+        self.topology = topology
+        self.max_outstanding = max(1, max_outstanding)
+        self._connection = None
+        self._channel = None
+        self._thread = None
+        self._ready = threading.Event()
+        self._start_lock = threading.Lock()
+        self._outstanding = threading.BoundedSemaphore(self.max_outstanding)
+        self._pending = {}
+        self._delivery_tag = 0
+        self._stopping = False
+
+        # Confirm metrics (only mutated on the I/O thread)
+        self.published = 0
+        self.acked = 0
+        self.nacked = 0
+        self.confirm_frames = 0
+
+    def start(self, timeout: float = 10.0):
+        """
+        Starts the I/O thread and waits until the channel is in confirm mode.
+        """
+        with self._start_lock:
+            if self.is_ready():
+                return
+            self._stopping = False
+            self._ready.clear()
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+            self._ready.wait(timeout)
+            if not self.is_ready():
+                raise ConnectionError(f"Could not open a confirm-mode channel to RabbitMQ at {self.rabbitmq_host}.")
+        print("Confirming publisher started.")
+
+    def is_ready(self) -> bool:
+        """Returns True when the confirm-mode channel is open."""
+        return self._channel is not None and self._channel.is_open
+
+    def _run(self):
+        """I/O thread: runs the SelectConnection's event loop."""
+        self._connection = pika.SelectConnection(
+            pika.ConnectionParameters(host=self.rabbitmq_host),
+            on_open_callback=self._on_connection_open,
+            on_open_error_callback=self._on_connection_open_error,
+            on_close_callback=self._on_connection_closed
+        )
+        self._connection.ioloop.start()
+
+    def _on_connection_open(self, connection):
+        connection.channel(on_open_callback=self._on_channel_open)
+
+    def _on_connection_open_error(self, connection, error):
+        print(f"Confirming publisher could not connect to RabbitMQ: {error}")
+        self._ready.set()
+        connection.ioloop.stop()
+
+    def _on_connection_closed(self, connection, reason):
+        self._channel = None
+        self._fail_pending(ConnectionError(f"RabbitMQ connection closed: {reason}"))
+        if not self._stopping:
+            print(f"Confirming publisher connection closed unexpectedly: {reason}")
+        connection.ioloop.stop()
+
+    def _on_channel_open(self, channel):
+        if self.topology:
+            self.topology.declare_all(channel)
+        channel.confirm_delivery(
+            ack_nack_callback=self._on_delivery_confirmation,
+            callback=functools.partial(self._on_confirm_mode, channel)
+        )
+
+    def _on_confirm_mode(self, channel, frame):
+        self._delivery_tag = 0
+        self._channel = channel
+        self._ready.set()
+
+    def publish(self, exchange: str, routing_key: str, body: bytes, properties=None, timeout: float = None) -> Future:
+        """
+        Schedules a publish on the I/O thread and returns a Future for its confirm.
+        Blocks only when `max_outstanding` messages are already awaiting confirms.
+        """
+        future = Future()
+        if not self.is_ready():
+            try:
+                self.start()
+            except ConnectionError as e:
+                future.set_exception(e)
+                return future
+
+        if not self._outstanding.acquire(timeout=timeout):
+            future.set_exception(TimeoutError("Too many unconfirmed messages outstanding."))
+            return future
+
+        try:
+            self._connection.ioloop.add_callback_threadsafe(
+                functools.partial(self._do_publish, exchange, routing_key, body, properties, future)
+            )
+        except Exception as e:
+            self._outstanding.release()
+            future.set_exception(e)
+        return future
+
+    def _do_publish(self, exchange, routing_key, body, properties, future):
+        """Runs on the I/O thread: publishes and records the delivery tag."""
+        if not self.is_ready():
+            self._outstanding.release()
+            future.set_exception(ConnectionError("Confirm-mode channel is not open."))
+            return
+        try:
+            if self.topology and exchange == '':
+                self.topology.ensure_queue(self._channel, routing_key)
+            self._channel.basic_publish(exchange=exchange, routing_key=routing_key, body=body, properties=properties)
+        except Exception as e:
+            self._outstanding.release()
+            future.set_exception(e)
+            return
+        self._delivery_tag += 1
+        self._pending[self._delivery_tag] = future
+        self.published += 1
+
+    def _on_delivery_confirmation(self, method_frame):
+        """Resolves the Futures covered by an ack/nack frame (possibly several at once)."""
+        method = method_frame.method
+        acked = isinstance(method, pika.spec.Basic.Ack)
+        self.confirm_frames += 1
+
+        if method.multiple:
+            # Pending tags are inserted in increasing order, so pop from the front.
+            resolved = []
+            while self._pending:
+                tag = next(iter(self._pending))
+                if tag > method.delivery_tag:
+                    break
+                resolved.append(self._pending.pop(tag))
+        else:
+            future = self._pending.pop(method.delivery_tag, None)
+            resolved = [future] if future else []
+
+        for future in resolved:
+            self._outstanding.release()
+            if not future.done():
+                future.set_result(acked)
+        if acked:
+            self.acked += len(resolved)
+        else:
+            self.nacked += len(resolved)
+
+    def _fail_pending(self, error: Exception):
+        """Fails every unconfirmed publish, e.g. after the connection dropped."""
+        pending, self._pending = self._pending, {}
+        for future in pending.values():
+            self._outstanding.release()
+            if not future.done():
+                future.set_exception(error)
+
+    def get_stats(self) -> dict:
+        """
+        Returns confirm metrics. `average_batch_size` is messages resolved per confirm frame.
+        """
+        resolved = self.acked + self.nacked
+        return {
+            "published": self.published,
+            "acked": self.acked,
+            "nacked": self.nacked,
+            "outstanding": len(self._pending),
+            "confirm_frames": self.confirm_frames,
+            "average_batch_size": (resolved / self.confirm_frames) if self.confirm_frames else 0.0,
+        }
+
+    def close(self):
+        """
+        Closes the connection and stops the I/O thread.
+        """
+        self._stopping = True
+        if self._connection and self._connection.is_open:
+            try:
+                self._connection.ioloop.add_callback_threadsafe(self._connection.close)
+            except Exception:
+                pass
+        if self._thread and self._thread is not threading.current_thread():
+            self._thread.join(timeout=5)
+        self._channel = None
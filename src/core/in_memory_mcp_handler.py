@@ -0,0 +1,352 @@
+# In-Memory MCP Handler
+
+import heapq
+import itertools
+import os
+import threading
+import time
+from collections import deque
+
+from src.config.config_loader import config
+from src.core.mcp_codec import OBJECT_CONTENT_TYPE
+from src.core.retry_policy import RetryPolicy
+
+class _InMemoryQueue:
+    """
+    A bounded buffer of pending messages plus the deliveries awaiting ack.
+    Messages are kept in a heap ordered by priority with aging (see PriorityDispatcher),
+    which degrades to FIFO when every message has the same priority.
+    """
+    def __init__(self, name: str, maxsize: int):
+        self.name = name
+        self.maxsize = maxsize
+        self.messages = []
+        self.unacked = {}
+
+    def is_full(self) -> bool:
+        return self.maxsize > 0 and len(self.messages) >= self.maxsize
+
+class InMemoryMCPHandler:
+    """
+    In-process message broker with the same interface as MCPHandler, for
+    single-node deployments and for running the server without RabbitMQ.
+    Messages are handed over as Python objects (no encoding or network hop) through
+    bounded per-queue buffers. Deliveries are acked when the callback returns; when it
+    raises, the message is retried after the RetryPolicy's delay and dead-lettered
+    once it has used up its attempts.
+    """
+    def __init__(self):
+        """
+        Initializes the in-memory broker.
+        """
+        mcp_config = config.get("mcp_config", {})
+        self.queue_maxsize = mcp_config.get("memory_queue_maxsize", 10000)
+        self.publish_timeout = mcp_config.get("memory_publish_timeout", 5.0)
+        self.priority_aging_rate = config.get("task_priorities", {}).get("aging_rate", 1.0)
+        self.consumer_workers = max(1, mcp_config.get("consumer_workers") or os.cpu_count() or 1)
+        self.queues = {}
+        self.callbacks = {}
+        self.bindings = {}
+        self.consumer_groups = {}
+        self.subscription_groups = {}
+        self.dead_letters = deque(maxlen=mcp_config.get("memory_dead_letter_maxlen", 1000))
+        self.retry_policy = RetryPolicy()
+        self.retry_timers = set()
+        self._cond = threading.Condition()
+        self._delivery_tags = itertools.count(1)
+        self._sequence = itertools.count()
+        self.workers = []
+        self.is_connected = False
+        self.is_consuming = False
+        print("MCP Handler initialized with the in-memory broker.")
+
+    def connect(self):
+        """
+        Marks the broker as available. There is nothing to connect to.
+        """
+        self.is_connected = True
+        print("In-memory MCP broker ready.")
+
+    def declare_topology(self):
+        """
+        Queues are created on first use; kept for interface compatibility.
+        """
+        pass
+
+    def _get_queue(self, queue_name: str) -> _InMemoryQueue:
+        """Returns the named queue, creating it on first use. Caller holds the lock."""
+        queue = self.queues.get(queue_name)
+        if queue is None:
+            queue = _InMemoryQueue(queue_name, self.queue_maxsize)
+            self.queues[queue_name] = queue
+        return queue
+
+    def publish_message(self, queue_name: str, message: dict, priority: int = None, attempts: int = 0) -> bool:
+        """
+        Enqueues a message. Blocks while the queue is full, up to `memory_publish_timeout`.
+        Higher `priority` messages are delivered first; waiting messages age so none starve.
+        `attempts` is the number of times the message has already failed (used by retries).
+        Returns True once the message is stored in the queue.
+        """
+        if not self.is_connected:
+            print("In-memory MCP broker not connected. Cannot publish message.")
+            return False
+
+        deadline = time.monotonic() + self.publish_timeout
+        with self._cond:
+            queue = self._get_queue(queue_name)
+            while queue.is_full():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    print(f"In-memory queue '{queue_name}' is full. Message rejected.")
+                    return False
+                self._cond.wait(remaining)
+            key = -((priority or 0) - self.priority_aging_rate * time.monotonic())
+            heapq.heappush(queue.messages, (key, next(self._sequence), message, {"priority": priority, "attempts": attempts}))
+            self._cond.notify_all()
+        return True
+
+    def publish_to_exchange(self, exchange: str, routing_key: str, message: dict, priority: int = None) -> bool:
+        """
+        Routes a message like a direct exchange: to every queue bound with `routing_key`.
+        The default exchange ('') routes to the queue named by the routing key.
+        """
+        if exchange == '':
+            return self.publish_message(routing_key, message, priority)
+        queue_names = self.bindings.get((exchange, routing_key), [])
+        if not queue_names:
+            print(f"No queue bound to '{exchange}/{routing_key}'. Message dropped.")
+            return False
+        return all([self.publish_message(queue_name, message, priority) for queue_name in queue_names])
+
+    def bind_queue(self, queue_name: str, exchange_name: str, routing_key: str, exchange_type: str = 'direct'):
+        """
+        Binds a queue to an exchange routing key (direct-exchange semantics).
+        """
+        with self._cond:
+            self._get_queue(queue_name)
+            queue_names = self.bindings.setdefault((exchange_name, routing_key), [])
+            if queue_name not in queue_names:
+                queue_names.append(queue_name)
+
+    def configure_consumer_group(self, group_name: str, workers: int):
+        """
+        Declares a consumer group with its own `workers` threads, which only serve
+        the queues subscribed with that group.
+        """
+        self.consumer_groups[group_name] = max(1, workers)
+
+    def publish_batch(self, queue_name: str, messages: list[dict], priority: int = None) -> list[bool]:
+        """
+        Enqueues several messages. Returns one success flag per message, in order.
+        """
+        return [self.publish_message(queue_name, message, priority) for message in messages]
+
+    def subscribe_to_channel(self, queue_name: str, callback, prefetch: int = None, consumer_group: str = None):
+        """
+        Registers a callback for a specific queue.
+        The callback receives the message and its content_type, like with MCPHandler.
+        `prefetch` is accepted for interface compatibility; workers pull one message at a time.
+        """
+        with self._cond:
+            self.callbacks[queue_name] = callback
+            if consumer_group:
+                self.subscription_groups[queue_name] = consumer_group
+            self._get_queue(queue_name)
+            self._cond.notify_all()
+        print(f"Callback registered for queue '{queue_name}'.")
+
+    def start_consuming(self):
+        """
+        Starts `consumer_workers` threads that deliver messages to the subscribed callbacks.
+        """
+        if not self.is_connected:
+            print("In-memory MCP broker not connected. Cannot start consuming.")
+            return
+
+        if self.is_consuming:
+            print("Already consuming messages.")
+            return
+
+        self.is_consuming = True
+        groups = {None: self.consumer_workers}
+        groups.update(self.consumer_groups)
+        for group, workers in groups.items():
+            for index in range(workers):
+                worker = threading.Thread(
+                    target=self._worker_loop, args=(group,), name=f"mcp-memory-worker-{group or 'default'}-{index}", daemon=True
+                )
+                worker.start()
+                self.workers.append(worker)
+        print(f"Started consuming in-memory messages with {len(self.workers)} worker(s).")
+
+    def _next_delivery(self, group: str = None):
+        """
+        Takes the most urgent message across the queues subscribed by a consumer group.
+        Caller holds the lock. Returns (queue, delivery_tag, message) or None.
+        """
+        candidates = [
+            self.queues[name] for name in self.callbacks
+            if self.queues[name].messages and self.subscription_groups.get(name) == group
+        ]
+        if not candidates:
+            return None
+        queue = min(candidates, key=lambda candidate: candidate.messages[0])
+        entry = heapq.heappop(queue.messages)
+        message = entry[2]
+        delivery_tag = next(self._delivery_tags)
+        queue.unacked[delivery_tag] = entry
+        self._cond.notify_all()  # wake publishers waiting for room
+        return queue, delivery_tag, message
+
+    def _worker_loop(self, group: str = None):
+        """Delivers a consumer group's messages until the broker is closed."""
+        while True:
+            with self._cond:
+                delivery = self._next_delivery(group)
+                while delivery is None and self.is_consuming:
+                    self._cond.wait()
+                    delivery = self._next_delivery(group)
+                if delivery is None:
+                    return
+
+            queue, delivery_tag, message = delivery
+            try:
+                self.callbacks[queue.name](message, OBJECT_CONTENT_TYPE)
+            except Exception as e:
+                print(f"Error processing message from '{queue.name}': {e}")
+                self._handle_failure(queue.name, delivery_tag, e)
+            else:
+                self.ack(queue.name, delivery_tag)
+
+    def _handle_failure(self, queue_name: str, delivery_tag: int, error: Exception):
+        """
+        Schedules a failed delivery for redelivery after the retry delay, or
+        dead-letters it once it has used up its attempts.
+        """
+        with self._cond:
+            entry = self.queues[queue_name].unacked.pop(delivery_tag, None)
+            if entry is None:
+                return
+            _, _, message, meta = entry
+            attempts = meta["attempts"] + 1
+            if not self.retry_policy.should_retry(attempts):
+                self._dead_letter(queue_name, message, meta["priority"], attempts, error)
+                return
+            delay_ms = self.retry_policy.delay_for(attempts)
+            timer = threading.Timer(delay_ms / 1000.0, self._retry, args=(queue_name, message, meta["priority"], attempts))
+            timer.daemon = True
+            self.retry_timers.add(timer)
+        print(f"Retrying message from '{queue_name}' in {delay_ms} ms (attempt {attempts}/{self.retry_policy.max_attempts}).")
+        timer.start()
+
+    def _retry(self, queue_name: str, message, priority: int, attempts: int):
+        """Timer callback: puts a failed message back on its queue."""
+        with self._cond:
+            self.retry_timers = {timer for timer in self.retry_timers if timer.is_alive() and timer is not threading.current_thread()}
+        if not self.publish_message(queue_name, message, priority, attempts=attempts):
+            with self._cond:
+                self._dead_letter(queue_name, message, priority, attempts, "retry could not be enqueued")
+
+    def _dead_letter(self, queue_name: str, message, priority: int, attempts: int, error):
+        """Records a message that will not be retried. Caller holds the lock."""
+        print(f"Message from '{queue_name}' failed {attempts} time(s). Moving it to the dead letters.")
+        self.dead_letters.append({
+            "queue": queue_name,
+            "message": message,
+            "priority": priority,
+            "attempts": attempts,
+            "last_error": str(error),
+            "failed_at": time.time(),
+        })
+
+    def ack(self, queue_name: str, delivery_tag: int):
+        """Acknowledges a delivery, removing it for good."""
+        with self._cond:
+            self.queues[queue_name].unacked.pop(delivery_tag, None)
+
+    def nack(self, queue_name: str, delivery_tag: int, requeue: bool = False):
+        """Rejects a delivery, either putting it back at the head of the queue or dead-lettering it."""
+        with self._cond:
+            queue = self.queues[queue_name]
+            entry = queue.unacked.pop(delivery_tag, None)
+            if entry is None:
+                return
+            if requeue:
+                # Keeps its original ordering key, so it goes back to (near) the head.
+                heapq.heappush(queue.messages, entry)
+                self._cond.notify_all()
+            else:
+                self._dead_letter(queue_name, entry[2], entry[3]["priority"], entry[3]["attempts"], "rejected")
+
+    def list_dead_letters(self, queue_name: str = None, limit: int = 100) -> list[dict]:
+        """
+        Returns up to `limit` dead-lettered messages (optionally for one queue) without removing them.
+        """
+        with self._cond:
+            dead_letters = [
+                {key: value for key, value in dead_letter.items() if key != "priority"}
+                for dead_letter in self.dead_letters
+                if queue_name is None or dead_letter["queue"] == queue_name
+            ]
+        return dead_letters[:limit]
+
+    def replay_dead_letters(self, queue_name: str = None, limit: int = None) -> int:
+        """
+        Moves dead-lettered messages back to their queue with a fresh attempt count.
+        Returns the number of messages replayed.
+        """
+        with self._cond:
+            selected = [
+                dead_letter for dead_letter in self.dead_letters
+                if queue_name is None or dead_letter["queue"] == queue_name
+            ][:limit]
+            for dead_letter in selected:
+                self.dead_letters.remove(dead_letter)
+
+        replayed = 0
+        for dead_letter in selected:
+            if self.publish_message(dead_letter["queue"], dead_letter["message"], dead_letter["priority"]):
+                replayed += 1
+            else:
+                with self._cond:
+                    self.dead_letters.append(dead_letter)
+        print(f"Replayed {replayed} dead-lettered message(s).")
+        return replayed
+
+    def get_publisher_pool_stats(self) -> dict:
+        """
+        Returns queue depths; there is no channel pool in the in-memory broker.
+        """
+        with self._cond:
+            return {
+                "backend": "memory",
+                "queues": {
+                    name: {"ready": len(queue.messages), "unacked": len(queue.unacked)}
+                    for name, queue in self.queues.items()
+                },
+                "dead_letters": len(self.dead_letters),
+            }
+
+    def get_publisher_confirm_stats(self) -> dict:
+        """
+        Publishing is synchronous in memory, so there are no confirms to report.
+        """
+        return {}
+
+    def close(self):
+        """
+        Stops the worker threads. Unprocessed messages and pending retries are discarded.
+        """
+        with self._cond:
+            self.is_consuming = False
+            self.is_connected = False
+            for timer in self.retry_timers:
+                timer.cancel()
+            self.retry_timers.clear()
+            self._cond.notify_all()
+        for worker in self.workers:
+            if worker is not threading.current_thread():
+                worker.join(timeout=5)
+        self.workers = []
+        print("In-memory MCP broker closed.")
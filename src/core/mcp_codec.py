@@ -0,0 +1,95 @@
+# MCP Message Codecs
+
+import json
+
+try:
+    import orjson
+except ImportError:  # optional dependency
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:  # optional dependency
+    msgpack = None
+
+JSON_CONTENT_TYPE = "application/json"
+MSGPACK_CONTENT_TYPE = "application/msgpack"
+# Used by the in-memory broker, which hands messages over as Python objects.
+OBJECT_CONTENT_TYPE = "application/x-python-object"
+
+class MessageDecodeError(ValueError):
+    """Raised when an MCP message body cannot be decoded."""
+
+class JsonCodec:
+    """Standard-library JSON codec. Always available."""
+    name = "json"
+    content_type = JSON_CONTENT_TYPE
+
+    def encode(self, message: dict) -> bytes:
+        return json.dumps(message).encode('utf-8')
+
+    def decode(self, body: bytes) -> dict:
+        return json.loads(body)
+
+class OrjsonCodec:
+    """JSON codec backed by orjson; produces the same wire format as JsonCodec, faster."""
+    name = "orjson"
+    content_type = JSON_CONTENT_TYPE
+
+    def encode(self, message: dict) -> bytes:
+        return orjson.dumps(message)
+
+    def decode(self, body: bytes) -> dict:
+        return orjson.loads(body)
+
+class MsgpackCodec:
+    """Compact binary codec backed by msgpack."""
+    name = "msgpack"
+    content_type = MSGPACK_CONTENT_TYPE
+
+    def encode(self, message: dict) -> bytes:
+        return msgpack.packb(message, use_bin_type=True)
+
+    def decode(self, body: bytes) -> dict:
+        return msgpack.unpackb(body, raw=False)
+
+def _available_codecs() -> dict:
+    codecs = {"json": JsonCodec()}
+    if orjson is not None:
+        codecs["orjson"] = OrjsonCodec()
+    if msgpack is not None:
+        codecs["msgpack"] = MsgpackCodec()
+    return codecs
+
+CODECS = _available_codecs()
+
+# Decoders keyed by AMQP content_type. JSON bodies are decoded with orjson when installed.
+DECODERS = {JSON_CONTENT_TYPE: CODECS.get("orjson", CODECS["json"])}
+if "msgpack" in CODECS:
+    DECODERS[MSGPACK_CONTENT_TYPE] = CODECS["msgpack"]
+
+def get_codec(name: str):
+    """
+    Returns the codec registered under `name`, falling back to JSON when the
+    codec's optional dependency is not installed.
+    """
+    codec = CODECS.get(name or "json")
+    if codec is None:
+        print(f"Warning: MCP codec '{name}' is not available. Falling back to 'json'.")
+        codec = CODECS["json"]
+    return codec
+
+def decode_message(body: bytes, content_type: str | None = None) -> dict:
+    """
+    Decodes an MCP message body according to its AMQP content_type.
+    Messages without a content_type are treated as JSON (the historical format).
+    """
+    if content_type == OBJECT_CONTENT_TYPE:
+        return body
+    decoder = DECODERS.get(content_type or JSON_CONTENT_TYPE)
+    if decoder is None:
+        raise MessageDecodeError(f"Unsupported MCP message content type: {content_type}")
+    try:
+        return decoder.decode(body)
+    except Exception as e:
+        raise MessageDecodeError(f"Could not decode {content_type or JSON_CONTENT_TYPE} message: {e}") from e
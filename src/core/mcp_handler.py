@@ -1,23 +1,57 @@
 # MCP Handler
 
-import json
+import functools
+import os
 import pika
 import threading
 import time
 
 from src.config.config_loader import config
+from src.core.channel_pool import PublisherChannelPool
+from src.core.mcp_topology import TopologyRegistry
+from src.core.confirming_publisher import ConfirmingPublisher
+from src.core.mcp_codec import get_codec, decode_message
+from src.core.priority_dispatcher import PriorityDispatcher
+from src.core.blob_store import BlobStore
+from src.core.retry_policy import (
+    RetryPolicy, DEAD_LETTER_EXCHANGE, ATTEMPTS_HEADER, ORIGINAL_QUEUE_HEADER, LAST_ERROR_HEADER, FAILED_AT_HEADER
+)
 
 class MCPHandler:
-    def __init__(self):
+    def __init__(self, blob_store: BlobStore = None):
         """
         Initializes the MCP Handler for RabbitMQ communication.
+        Payload values above the blob store's threshold are published as blob references.
         """
         mcp_config = config.get("mcp_config", {})
         self.rabbitmq_host = mcp_config.get("rabbitmq_host", "localhost")
+        self.codec = get_codec(mcp_config.get("codec", "json"))
+        self.blob_store = blob_store or BlobStore()
+        self.publisher_pool_size = mcp_config.get("publisher_pool_size", 8)
+        self.publisher_checkout_timeout = mcp_config.get("publisher_checkout_timeout", 5.0)
+        self.publisher_pool = None
+        self.publisher_confirms = mcp_config.get("publisher_confirms", False)
+        self.confirm_timeout = mcp_config.get("confirm_timeout", 5.0)
+        self.max_outstanding_confirms = mcp_config.get("max_outstanding_confirms", 1000)
+        self.confirming_publisher = None
+        self.topology = TopologyRegistry()
+        # Failed messages are retried through delayed tiers, then dead-lettered.
+        self.retry_policy = RetryPolicy()
+        self.retry_policy.register_topology(self.topology)
+        self.dead_letter_queues = {}
         self.connection = None
         self.channel = None
         self.consuming_thread = None
+        self.consumer_connection = None
+        self.dispatchers = {}
+        self._dispatchers_lock = threading.Lock()
+        self.consumer_workers = max(1, mcp_config.get("consumer_workers") or os.cpu_count() or 1)
+        self.consumer_prefetch_per_worker = max(1, mcp_config.get("consumer_prefetch_per_worker", 1))
+        self.priority_aging_rate = config.get("task_priorities", {}).get("aging_rate", 1.0)
         self.callbacks = {}
+        self.prefetch_counts = {}
+        self.consumer_groups = {}
+        self.subscription_groups = {}
         self.is_consuming = False
         print("MCP Handler initialized for RabbitMQ.")
 
@@ -32,6 +66,23 @@ class MCPHandler:
             print(f"Connecting to RabbitMQ broker at {self.rabbitmq_host}...")
             self.connection = pika.BlockingConnection(pika.ConnectionParameters(host=self.rabbitmq_host))
             self.channel = self.connection.channel()
+            # Publishing happens from the API, consumer and agent threads; each of them
+            # checks out its own channel (and connection) from this pool.
+            # New pooled connections declare the registered topology once, on open.
+            self.publisher_pool = PublisherChannelPool(
+                self.rabbitmq_host,
+                size=self.publisher_pool_size,
+                checkout_timeout=self.publisher_checkout_timeout,
+                on_open=self.topology.declare_all
+            )
+            if self.publisher_confirms:
+                # Confirmed publishes are pipelined over a single confirm-mode channel.
+                self.confirming_publisher = ConfirmingPublisher(
+                    self.rabbitmq_host,
+                    topology=self.topology,
+                    max_outstanding=self.max_outstanding_confirms
+                )
+                self.confirming_publisher.start()
             print("Successfully connected to RabbitMQ broker.")
         except pika.exceptions.AMQPConnectionError as e:
             print(f"Error connecting to RabbitMQ: {e}")
@@ -39,56 +90,279 @@ class MCPHandler:
             self.channel = None
             raise
 
-    def publish_message(self, queue_name: str, message: dict):
+    def declare_topology(self):
         """
-        Publishes a message to a specified RabbitMQ queue.
+        Declares every registered exchange, queue and binding in one batch.
+        Intended to be called once at startup, right after connect().
         """
         if not self.channel:
-            print("MCP channel not available. Cannot publish message.")
+            print("MCP channel not available. Cannot declare topology.")
             return
+        self.topology.declare_all(self.channel)
+        print(f"Declared MCP topology: {len(self.topology.exchanges)} exchange(s), {len(self.topology.queues)} queue(s).")
+
+    def _message_properties(self, priority: int = None):
+        """Returns the AMQP properties used for every published message."""
+        return pika.BasicProperties(
+            content_type=self.codec.content_type,
+            delivery_mode=2,  # make message persistent
+            priority=priority,
+        )
+
+    def _encode(self, message: dict) -> bytes:
+        """Encodes a message, moving large values to the blob store first (claim check)."""
+        return self.codec.encode(self.blob_store.offload(message))
+
+    def _publish_confirmed_async(self, exchange: str, routing_key: str, message: dict, priority: int = None):
+        """Hands a message to the confirming publisher and returns the confirm Future."""
+        return self.confirming_publisher.publish(
+            exchange, routing_key, self._encode(message), self._message_properties(priority), timeout=self.confirm_timeout
+        )
+
+    def _wait_for_confirm(self, destination: str, future) -> bool:
+        """Waits for a broker confirm; returns True only if the message was acked."""
+        try:
+            if future.result(timeout=self.confirm_timeout):
+                return True
+            print(f"Broker rejected (nacked) a message for '{destination}'.")
+        except Exception as e:
+            print(f"Error publishing message to RabbitMQ: {e}")
+        return False
+
+    def publish_message(self, queue_name: str, message: dict, priority: int = None) -> bool:
+        """
+        Publishes a message to a specified RabbitMQ queue.
+        `priority` (higher is more urgent) orders the message among those buffered by the consumer.
+        With publisher confirms enabled, returns True only once the broker has acked it;
+        otherwise returns True once the message was written to the channel.
+        """
+        return self.publish_to_exchange('', queue_name, message, priority=priority)
+
+    def publish_to_exchange(self, exchange: str, routing_key: str, message: dict, priority: int = None) -> bool:
+        """
+        Publishes a message to an exchange with a routing key. The default exchange ('')
+        routes straight to the queue named by the routing key.
+        """
+        destination = f"{exchange}/{routing_key}" if exchange else routing_key
+        if self.confirming_publisher:
+            if self._wait_for_confirm(destination, self._publish_confirmed_async(exchange, routing_key, message, priority)):
+                print(f"Published to '{destination}' (task {message.get('task_id')}), confirmed by broker.")
+                return True
+            return False
+
+        if not self.publisher_pool:
+            print("MCP channel not available. Cannot publish message.")
+            return False
 
         try:
-            self.channel.queue_declare(queue=queue_name, durable=True)
-            self.channel.basic_publish(
-                exchange='',
-                routing_key=queue_name,
-                body=json.dumps(message),
-                properties=pika.BasicProperties(
-                    delivery_mode=2,  # make message persistent
-                ))
-            print(f"Published to queue '{queue_name}': {json.dumps(message, indent=2)}")
+            with self.publisher_pool.channel() as channel:
+                if exchange == '':
+                    # Registered queues were declared when this channel's connection opened.
+                    self.topology.ensure_queue(channel, routing_key)
+                channel.basic_publish(
+                    exchange=exchange,
+                    routing_key=routing_key,
+                    body=self._encode(message),
+                    properties=self._message_properties(priority))
+            print(f"Published to '{destination}' (task {message.get('task_id')}).")
+            return True
         except Exception as e:
             print(f"Error publishing message to RabbitMQ: {e}")
+            return False
 
-    def subscribe_to_channel(self, queue_name: str, callback):
+    def publish_batch(self, queue_name: str, messages: list[dict], priority: int = None) -> list[bool]:
+        """
+        Publishes several messages to a queue. With publisher confirms enabled all of
+        them are in flight at once and are resolved by the broker's (batched) acks.
+        Returns one success flag per message, in order.
+        """
+        if self.confirming_publisher:
+            futures = [self._publish_confirmed_async('', queue_name, message, priority) for message in messages]
+            return [self._wait_for_confirm(queue_name, future) for future in futures]
+
+        if not self.publisher_pool:
+            print("MCP channel not available. Cannot publish messages.")
+            return [False] * len(messages)
+
+        results = []
+        try:
+            with self.publisher_pool.channel() as channel:
+                self.topology.ensure_queue(channel, queue_name)
+                for message in messages:
+                    channel.basic_publish(
+                        exchange='',
+                        routing_key=queue_name,
+                        body=self._encode(message),
+                        properties=self._message_properties(priority))
+                    results.append(True)
+        except Exception as e:
+            print(f"Error publishing batch to RabbitMQ: {e}")
+        return results + [False] * (len(messages) - len(results))
+
+    def bind_queue(self, queue_name: str, exchange_name: str, routing_key: str, exchange_type: str = 'direct'):
+        """
+        Registers an exchange, a queue and the binding between them in the topology.
+        They are declared by declare_topology() and on every new connection.
+        """
+        if exchange_name not in self.topology.exchanges:
+            self.topology.register_exchange(exchange_name, exchange_type=exchange_type)
+        if not self.topology.is_registered(queue_name):
+            self.topology.register_queue(queue_name)
+        self.topology.register_binding(queue_name, exchange_name, routing_key)
+
+    def configure_consumer_group(self, group_name: str, workers: int):
+        """
+        Declares a consumer group with its own pool of `workers` threads. Queues
+        subscribed with this group are processed only by that pool, so one group's
+        backlog cannot occupy another group's workers.
+        """
+        self.consumer_groups[group_name] = max(1, workers)
+
+    def subscribe_to_channel(self, queue_name: str, callback, prefetch: int = None, consumer_group: str = None):
         """
         Registers a callback for a specific queue.
+        The callback receives the raw message body and its AMQP content_type.
+        Each queue is consumed on its own channel; `prefetch` overrides how many
+        unacked messages that channel may hold (a queue's share of the workers).
+        `consumer_group` selects a worker pool set up with configure_consumer_group().
         """
         self.callbacks[queue_name] = callback
+        self.dead_letter_queues[queue_name] = self.retry_policy.register_dead_letter_queue(self.topology, queue_name)
+        if prefetch:
+            self.prefetch_counts[queue_name] = prefetch
+        if consumer_group:
+            self.subscription_groups[queue_name] = consumer_group
         print(f"Callback registered for queue '{queue_name}'.")
-        if self.is_consuming and self.channel:
-             # If already consuming, just declare the new queue and start consuming from it
-            self.channel.queue_declare(queue=queue_name, durable=True)
-            self.channel.basic_consume(queue=queue_name, on_message_callback=self._on_message, auto_ack=False)
+        if self.is_consuming and self.consumer_connection:
+            # If already consuming, start consuming from the new queue on the consumer's own thread
+            self.consumer_connection.add_callback_threadsafe(
+                functools.partial(self._consume_queue, self.consumer_connection, queue_name)
+            )
 
+    def _dispatcher_for(self, queue_name: str) -> PriorityDispatcher:
+        """Returns the worker pool of the queue's consumer group, creating it on first use."""
+        group = self.subscription_groups.get(queue_name)
+        with self._dispatchers_lock:
+            dispatcher = self.dispatchers.get(group)
+            if dispatcher is None:
+                workers = self.consumer_groups.get(group, self.consumer_workers)
+                dispatcher = PriorityDispatcher(
+                    workers, aging_rate=self.priority_aging_rate, name=f"mcp-worker-{group or 'default'}"
+                )
+                self.dispatchers[group] = dispatcher
+            return dispatcher
+
+    def _consume_queue(self, connection, queue_name: str):
+        """Opens a channel for a queue, declares it (if needed) and attaches the dispatching consumer."""
+        channel = connection.channel()
+        # Bound how many unacked messages this queue may hold; by default enough to keep every worker busy.
+        group = self.subscription_groups.get(queue_name)
+        workers = self.consumer_groups.get(group, self.consumer_workers)
+        default_prefetch = workers * self.consumer_prefetch_per_worker
+        channel.basic_qos(prefetch_count=self.prefetch_counts.get(queue_name, default_prefetch))
+        self.topology.ensure_queue(channel, queue_name)
+        channel.basic_consume(
+            queue=queue_name,
+            on_message_callback=functools.partial(self._on_message, queue_name),
+            auto_ack=False
+        )
+
+    def _on_message(self, queue_name, ch, method, properties, body):
+        """
+        Internal callback, run on the consumer thread. Hands the message to the worker
+        pool so a slow handler does not hold up the rest of the queue; buffered messages
+        are picked by priority (with aging), not arrival order.
+        """
+        self._dispatcher_for(queue_name).submit(
+            properties.priority or 0,
+            self._process_message, queue_name, ch, method.delivery_tag, properties, body
+        )
 
-    def _on_message(self, ch, method, properties, body):
-        """Internal callback to dispatch messages to the correct handler."""
-        queue_name = method.routing_key
-        if queue_name in self.callbacks:
+    def _process_message(self, queue_name, ch, delivery_tag, properties, body):
+        """Runs on a worker thread: dispatches the message to the correct handler."""
+        callback = self.callbacks.get(queue_name)
+        success = True
+        if callback:
             try:
-                self.callbacks[queue_name](body)
-                ch.basic_ack(delivery_tag=method.delivery_tag)
+                callback(body, properties.content_type)
             except Exception as e:
                 print(f"Error processing message from '{queue_name}': {e}")
-                ch.basic_nack(delivery_tag=method.delivery_tag, requeue=False) # Move to DLQ if configured
+                # Once the message is parked in a retry tier or the DLQ, the delivery can be acked.
+                # If neither could take it (the broker is failing), it is requeued after a
+                # back-off instead of being redelivered to this consumer right away.
+                success = self._handle_failure(queue_name, properties, body, e)
+                self._settle(ch, delivery_tag, success, requeue=True, delay=self.retry_policy.requeue_delay_ms / 1000)
+                return
         else:
             print(f"No callback registered for queue '{queue_name}'. Discarding message.")
-            ch.basic_ack(delivery_tag=method.delivery_tag)
+        self._settle(ch, delivery_tag, success)
+
+    def _handle_failure(self, queue_name: str, properties, body: bytes, error: Exception) -> bool:
+        """
+        Republishes a failed message to the next retry tier, or to the dead-letter
+        exchange once it has used up its attempts. Returns False if neither publish succeeded.
+        """
+        headers = dict(properties.headers or {})
+        attempts = int(headers.get(ATTEMPTS_HEADER, 0)) + 1
+        headers[ATTEMPTS_HEADER] = attempts
+        headers[ORIGINAL_QUEUE_HEADER] = queue_name
+        headers[LAST_ERROR_HEADER] = str(error)[:1024]
+        headers[FAILED_AT_HEADER] = time.time()
+        retry_properties = pika.BasicProperties(
+            content_type=properties.content_type,
+            delivery_mode=2,
+            priority=properties.priority,
+            headers=headers,
+        )
+
+        if self.retry_policy.should_retry(attempts):
+            delay_ms = self.retry_policy.delay_for(attempts)
+            print(f"Retrying message from '{queue_name}' in {delay_ms} ms (attempt {attempts}/{self.retry_policy.max_attempts}).")
+            # Routed by the source queue name, which the tier keeps when it dead-letters back.
+            return self._publish_raw(self.retry_policy.tier_name(delay_ms), queue_name, body, retry_properties)
+
+        print(f"Message from '{queue_name}' failed {attempts} time(s). Moving it to the dead-letter queue.")
+        return self._publish_raw(DEAD_LETTER_EXCHANGE, queue_name, body, retry_properties)
+
+    def _publish_raw(self, exchange: str, routing_key: str, body: bytes, properties) -> bool:
+        """Publishes an already-encoded body (used to move messages between queues)."""
+        if self.confirming_publisher:
+            future = self.confirming_publisher.publish(exchange, routing_key, body, properties, timeout=self.confirm_timeout)
+            return self._wait_for_confirm(f"{exchange}/{routing_key}", future)
+        if not self.publisher_pool:
+            return False
+        try:
+            with self.publisher_pool.channel() as channel:
+                channel.basic_publish(exchange=exchange, routing_key=routing_key, body=body, properties=properties)
+            return True
+        except Exception as e:
+            print(f"Error republishing message to '{exchange}/{routing_key}': {e}")
+            return False
+
+    def _settle(self, ch, delivery_tag, success: bool, requeue: bool = False, delay: float = 0):
+        """
+        Acks (or nacks) a delivery. pika channels are bound to the consumer thread,
+        so the ack is scheduled onto that thread instead of being sent from the worker.
+        A nack is sent `delay` seconds later; the delivery stays unacked (holding its
+        prefetch slot) meanwhile.
+        """
+        if success:
+            settle = functools.partial(ch.basic_ack, delivery_tag=delivery_tag)
+        else:
+            settle = functools.partial(ch.basic_nack, delivery_tag=delivery_tag, requeue=requeue)
+            if delay > 0:
+                settle = functools.partial(ch.connection.call_later, delay, settle)
+        try:
+            ch.connection.add_callback_threadsafe(settle)
+        except Exception as e:
+            # The connection is gone; the broker will redeliver the unacked message.
+            print(f"Could not settle message {delivery_tag}: {e}")
 
     def start_consuming(self):
         """
         Starts consuming messages from all subscribed queues in a separate thread.
+        Messages are processed by a pool of `consumer_workers` threads, or by the
+        pool of the queue's consumer group.
         """
         if not self.channel:
             print("MCP channel not available. Cannot start consuming.")
@@ -101,37 +375,159 @@ class MCPHandler:
         self.is_consuming = True
         self.consuming_thread = threading.Thread(target=self._consume_loop, daemon=True)
         self.consuming_thread.start()
-        print("Started consuming messages in a background thread.")
+        print(f"Started consuming messages in a background thread ({len(self.consumer_groups)} consumer group(s)).")
 
     def _consume_loop(self):
         """The actual loop that consumes messages from RabbitMQ."""
-        # Re-establish channel in the new thread
+        # Re-establish the connection in the new thread
         local_connection = pika.BlockingConnection(pika.ConnectionParameters(host=self.rabbitmq_host))
-        local_channel = local_connection.channel()
-        
+        self.consumer_connection = local_connection
+
         print("Consumer thread started.")
-        for queue_name in self.callbacks.keys():
-            local_channel.queue_declare(queue=queue_name, durable=True)
-            local_channel.basic_consume(queue=queue_name, on_message_callback=self._on_message, auto_ack=False)
-        
         try:
-            local_channel.start_consuming()
+            self.topology.declare_all(local_connection.channel())
+            for queue_name in list(self.callbacks.keys()):
+                self._consume_queue(local_connection, queue_name)
+
+            while self.is_consuming:
+                local_connection.process_data_events(time_limit=1)
         except Exception as e:
             print(f"Consumer thread encountered an error: {e}")
         finally:
-            local_connection.close()
+            self.consumer_connection = None
+            self._shutdown_dispatchers()
+            try:
+                local_connection.close()
+            except Exception:
+                pass
             print("Consumer thread stopped.")
             self.is_consuming = False
 
+    def _dead_letter_queues_for(self, queue_name: str = None) -> dict:
+        """Returns {source queue: DLQ} for one source queue, or for all of them."""
+        if queue_name is None:
+            return dict(self.dead_letter_queues)
+        if queue_name in self.dead_letter_queues:
+            return {queue_name: self.dead_letter_queues[queue_name]}
+        print(f"No dead-letter queue known for '{queue_name}'.")
+        return {}
+
+    def list_dead_letters(self, queue_name: str = None, limit: int = 100) -> list[dict]:
+        """
+        Returns up to `limit` dead-lettered messages without removing them.
+        Messages are fetched with basic_get and handed back to their DLQ afterwards.
+        """
+        if not self.publisher_pool:
+            print("MCP channel not available. Cannot inspect dead letters.")
+            return []
+
+        dead_letters = []
+        with self.publisher_pool.channel() as channel:
+            for source_queue, dlq in self._dead_letter_queues_for(queue_name).items():
+                last_tag = None
+                while len(dead_letters) < limit:
+                    method, properties, body = channel.basic_get(queue=dlq, auto_ack=False)
+                    if method is None:
+                        break
+                    last_tag = method.delivery_tag
+                    headers = properties.headers or {}
+                    try:
+                        message = decode_message(body, properties.content_type)
+                    except Exception as e:
+                        message = {"undecodable": str(e)}
+                    dead_letters.append({
+                        "queue": source_queue,
+                        "attempts": headers.get(ATTEMPTS_HEADER),
+                        "last_error": headers.get(LAST_ERROR_HEADER),
+                        "failed_at": headers.get(FAILED_AT_HEADER),
+                        "message": message,
+                    })
+                if last_tag is not None:
+                    # Return everything we looked at to the DLQ.
+                    channel.basic_nack(delivery_tag=last_tag, multiple=True, requeue=True)
+        return dead_letters
+
+    def replay_dead_letters(self, queue_name: str = None, limit: int = None) -> int:
+        """
+        Moves dead-lettered messages back to their source queue with a fresh attempt
+        count, in bulk. Returns the number of messages replayed.
+        """
+        if not self.publisher_pool:
+            print("MCP channel not available. Cannot replay dead letters.")
+            return 0
+
+        replayed = 0
+        with self.publisher_pool.channel() as channel:
+            for source_queue, dlq in self._dead_letter_queues_for(queue_name).items():
+                while limit is None or replayed < limit:
+                    method, properties, body = channel.basic_get(queue=dlq, auto_ack=False)
+                    if method is None:
+                        break
+                    replay_properties = pika.BasicProperties(
+                        content_type=properties.content_type,
+                        delivery_mode=2,
+                        priority=properties.priority,
+                    )
+                    if not self._publish_raw('', source_queue, body, replay_properties):
+                        channel.basic_nack(delivery_tag=method.delivery_tag, requeue=True)
+                        print(f"Replay of '{dlq}' stopped: could not republish to '{source_queue}'.")
+                        return replayed
+                    channel.basic_ack(delivery_tag=method.delivery_tag)
+                    replayed += 1
+        print(f"Replayed {replayed} dead-lettered message(s).")
+        return replayed
+
+    def _shutdown_dispatchers(self):
+        """Stops every consumer group's worker pool."""
+        with self._dispatchers_lock:
+            dispatchers, self.dispatchers = self.dispatchers, {}
+        for dispatcher in dispatchers.values():
+            dispatcher.shutdown(wait=False)
+
+    def get_publisher_pool_stats(self) -> dict:
+        """
+        Returns usage and wait metrics of the publisher channel pool.
+        """
+        if not self.publisher_pool:
+            return {}
+        return self.publisher_pool.get_stats()
+
+    def get_publisher_confirm_stats(self) -> dict:
+        """
+        Returns publisher-confirm metrics (acked, nacked, outstanding, batch size).
+        """
+        if not self.confirming_publisher:
+            return {}
+        return self.confirming_publisher.get_stats()
 
     def close(self):
         """
         Closes the connection to RabbitMQ.
         """
+        if self.publisher_pool:
+            self.publisher_pool.close()
+        if self.confirming_publisher:
+            self.confirming_publisher.close()
         if self.is_consuming and self.consuming_thread:
+            # The consumer loop checks this flag between event-processing rounds.
             self.is_consuming = False
-            # The consumer is blocking, so we can't join it directly.
-            # Pika recommends closing the connection from another thread.
-            if self.connection and self.connection.is_open:
-                self.connection.close()
-            print("RabbitMQ connection closed.")
+            self.consuming_thread.join(timeout=5)
+        self._shutdown_dispatchers()
+        if self.connection and self.connection.is_open:
+            self.connection.close()
+        print("RabbitMQ connection closed.")
+
+
+def create_mcp_handler(blob_store: BlobStore = None):
+    """
+    Returns the MCP handler for the backend selected by `mcp_config.backend`:
+    "rabbitmq" (default) or "memory" for the in-process broker.
+    The in-process broker hands messages over by reference, so it never offloads to the blob store.
+    """
+    backend = config.get("mcp_config", {}).get("backend", "rabbitmq")
+    if backend == "memory":
+        from src.core.in_memory_mcp_handler import InMemoryMCPHandler
+        return InMemoryMCPHandler()
+    if backend != "rabbitmq":
+        print(f"Warning: Unknown MCP backend '{backend}'. Using RabbitMQ.")
+    return MCPHandler(blob_store=blob_store)
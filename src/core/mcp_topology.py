@@ -0,0 +1,77 @@
+# MCP Topology Registry
+
+import threading
+
+INBOUND_QUEUE = 'ai-agent-server.tasks.inbound'
+FEEDBACK_QUEUE = 'ai-agent-server.tasks.feedback'
+
+class TopologyRegistry:
+    """
+    Keeps track of the exchanges, queues and bindings the server relies on so they
+    are declared once per connection instead of before every publish.
+    A freshly opened connection declares the whole registry in one batch; queues
+    registered later are declared once, on the channel that first needs them.
+    """
+    def __init__(self):
+        """
+        Initializes the registry with the server's core queues.
+        """
+        self._lock = threading.Lock()
+        self.exchanges = {}
+        self.queues = {}
+        self.bindings = []
+        self.register_queue(INBOUND_QUEUE)
+        self.register_queue(FEEDBACK_QUEUE)
+
+    def register_exchange(self, exchange_name: str, exchange_type: str = 'direct', durable: bool = True, arguments: dict = None):
+        """Registers an exchange to be declared on every new connection."""
+        with self._lock:
+            self.exchanges[exchange_name] = {
+                "exchange_type": exchange_type,
+                "durable": durable,
+                "arguments": arguments or None
+            }
+
+    def register_queue(self, queue_name: str, durable: bool = True, arguments: dict = None):
+        """Registers a queue to be declared on every new connection."""
+        with self._lock:
+            self.queues[queue_name] = {"durable": durable, "arguments": arguments or None}
+
+    def register_binding(self, queue_name: str, exchange_name: str, routing_key: str):
+        """Registers a queue-to-exchange binding."""
+        with self._lock:
+            binding = (queue_name, exchange_name, routing_key)
+            if binding not in self.bindings:
+                self.bindings.append(binding)
+
+    def is_registered(self, queue_name: str) -> bool:
+        """Returns True if the queue is part of the registered topology."""
+        return queue_name in self.queues
+
+    def declare_all(self, channel):
+        """
+        Declares every registered exchange, queue and binding on a (blocking) channel.
+        Called once for each newly opened connection.
+        """
+        with self._lock:
+            exchanges = list(self.exchanges.items())
+            queues = list(self.queues.items())
+            bindings = list(self.bindings)
+
+        for exchange_name, options in exchanges:
+            channel.exchange_declare(exchange=exchange_name, **options)
+        for queue_name, options in queues:
+            channel.queue_declare(queue=queue_name, **options)
+        for queue_name, exchange_name, routing_key in bindings:
+            channel.queue_bind(queue=queue_name, exchange=exchange_name, routing_key=routing_key)
+
+    def ensure_queue(self, channel, queue_name: str):
+        """
+        Declares a queue that is not yet part of the registry and registers it,
+        so later publishes to it skip the declaration round trip.
+        """
+        if self.is_registered(queue_name):
+            return
+        self.register_queue(queue_name)
+        options = self.queues[queue_name]
+        channel.queue_declare(queue=queue_name, **options)
@@ -1,5 +1,6 @@
 # Metrics Collector
 
+import threading
 import time
 from collections import deque
 
@@ -14,23 +15,30 @@ class MetricsCollector:
         self.failed_requests = 0
         self.active_tasks = 0
         self.response_times = deque(maxlen=100) # Store last 100 response times
+        # Counters are updated concurrently by the MCP consumer workers.
+        self._lock = threading.Lock()
         print("Metrics Collector initialized.")
 
     def increment_total_requests(self):
-        self.total_requests += 1
+        with self._lock:
+            self.total_requests += 1
 
     def increment_successful_requests(self):
-        self.successful_requests += 1
+        with self._lock:
+            self.successful_requests += 1
 
     def increment_failed_requests(self):
-        self.failed_requests += 1
+        with self._lock:
+            self.failed_requests += 1
 
     def task_started(self):
-        self.active_tasks += 1
+        with self._lock:
+            self.active_tasks += 1
 
     def task_finished(self):
-        if self.active_tasks > 0:
-            self.active_tasks -= 1
+        with self._lock:
+            if self.active_tasks > 0:
+                self.active_tasks -= 1
 
     def add_response_time(self, response_time: float):
         self.response_times.append(response_time)
@@ -1,5 +1,7 @@
 # Orchestration Engine
 
+import asyncio
+import functools
 import json
 import os
 import uuid
@@ -26,10 +28,17 @@ from src.agents.transversal.terminal_automator_agent import TerminalAutomatorAge
 from src.agents.transversal.excel_agent import ExcelAgent
 from src.agents.general.chat_agent import ChatAgent
 from src.tasks_state.task_state_manager import TaskStateManager
+from src.tasks_state.task_recovery import TaskRecovery
 from src.load_balancer.load_balancer import LoadBalancer
 from src.llm_engines.local.ollama_engine import OllamaEngine
 from src.llm_engines.api.openai_engine import OpenAIEngine
-from src.core.mcp_handler import MCPHandler
+from src.core.mcp_handler import create_mcp_handler
+from src.core.blob_store import BlobStore
+from src.core.async_mcp_handler import AsyncMCPHandler
+from src.core.mcp_codec import decode_message, MessageDecodeError
+from src.core.task_priority import TaskPrioritizer
+from src.core.task_router import TaskRouter
+from src.config.config_loader import config
 from src.core.metrics_collector import MetricsCollector
 import time
 import threading
@@ -42,17 +51,31 @@ class OrchestrationEngine:
         print("Initializing Orchestration Engine...")
         
         # Initialize components and assign as instance variables
-        self.task_state_manager = TaskStateManager()
+        # Shared claim-check store: large payloads travel and persist as blob references.
+        self.blob_store = BlobStore()
+        self.task_state_manager = TaskStateManager(blob_store=self.blob_store)
         self.load_balancer = LoadBalancer()
-        self.mcp_handler = MCPHandler()
+        self.mcp_handler = create_mcp_handler(blob_store=self.blob_store)
+        # The asyncio transport is used by the API handlers; it is connected on app startup.
+        # The in-memory backend never blocks on I/O, so it does not need one.
+        mcp_config = config.get("mcp_config", {})
+        use_async_transport = (
+            mcp_config.get("transport", "blocking") == "asyncio"
+            and mcp_config.get("backend", "rabbitmq") == "rabbitmq"
+        )
+        self.async_mcp_handler = AsyncMCPHandler(topology=self.mcp_handler.topology, blob_store=self.blob_store) if use_async_transport else None
         self.metrics_collector = MetricsCollector()
         
         # Load agents
         self.agents = self._load_agents()
         self.diagnosis_agent = self.agents.get('Diagnosis-Agent')
+        self.task_prioritizer = TaskPrioritizer(self.diagnosis_agent)
+        self.task_router = TaskRouter(self.task_prioritizer, self.diagnosis_agent)
 
         # Initialize LLM Engines
         self.llm_engines = self._initialize_llm_engines()
+        # Their call outcomes and probes drive the LoadBalancer's circuit breakers.
+        self.load_balancer.attach_engines(self.llm_engines)
 
         # The LoadBalancer now loads its own configuration.
         # self._configure_load_balancer()
@@ -60,6 +83,9 @@ class OrchestrationEngine:
         # Connect to MCP and start consuming
         self._initialize_mcp()
 
+        # Requeue (or fail) tasks orphaned by a previous run, then keep watching for them.
+        self.task_recovery = self._initialize_task_recovery()
+
         print("Orchestration Engine initialized successfully.")
 
     def _load_agents(self):
@@ -139,38 +165,142 @@ class OrchestrationEngine:
         """Initializes the MCP handler, connects, and subscribes to channels."""
         try:
             self.mcp_handler.connect()
-            self.mcp_handler.subscribe_to_channel('ai-agent-server.tasks.inbound', self.handle_mcp_task)
+            # Every priority lane (per shard, when sharding is enabled) is a separate inbound
+            # queue with its own prefetch share; each shard has its own consumer group.
+            for group_name, workers in self.task_router.consumer_groups().items():
+                self.mcp_handler.configure_consumer_group(group_name, workers)
+            for subscription in self.task_router.inbound_subscriptions():
+                if subscription.get("exchange"):
+                    self.mcp_handler.bind_queue(subscription["queue"], subscription["exchange"], subscription["routing_key"])
+                self.mcp_handler.subscribe_to_channel(
+                    subscription["queue"],
+                    self.handle_mcp_task,
+                    prefetch=subscription["prefetch"],
+                    consumer_group=subscription["consumer_group"]
+                )
             self.mcp_handler.subscribe_to_channel('ai-agent-server.tasks.feedback', self.handle_feedback_message)
+            self.mcp_handler.declare_topology()
             self.mcp_handler.start_consuming()
             print("MCP Handler connected and consuming from inbound and feedback channels.")
         except Exception as e:
             print(f"Failed to initialize MCP Handler: {e}")
 
-    def process_request(self, user_prompt: str):
-        """
-        Receives a user request and publishes it to the inbound task queue.
-        """
-        self.metrics_collector.increment_total_requests()
-        task_id = str(uuid.uuid4())
+    def _initialize_task_recovery(self):
+        """Starts orphaned-task recovery, if it is enabled (it needs the task index)."""
+        recovery_config = config.get("task_state", {}).get("recovery", {})
+        if not recovery_config.get("enabled", False):
+            return None
+        if not self.task_state_manager.task_index:
+            print("Warning: Task recovery needs task_state.index to be enabled. Orphaned tasks will not be recovered.")
+            return None
+        task_recovery = TaskRecovery(
+            self.task_state_manager,
+            self.requeue_task,
+            policy=recovery_config.get("policy", "requeue"),
+            statuses=recovery_config.get("statuses"),
+            stale_after=recovery_config.get("stale_after", 120.0),
+            heartbeat_interval=recovery_config.get("heartbeat_interval", 15.0),
+            interval=recovery_config.get("interval", 30.0),
+            batch_size=recovery_config.get("batch_size", 500),
+            max_requeues=recovery_config.get("max_requeues", 3),
+            recover_all_on_startup=recovery_config.get("recover_all_on_startup", True),
+        )
+        task_recovery.start()
+        return task_recovery
+
+    def requeue_task(self, task_data: dict, attempts: int) -> bool:
+        """Publishes an orphaned task to the inbound queue again, under its original task_id."""
+        prompt = task_data.get("prompt")
+        analysis = (task_data.get("payload") or {}).get("analysis") or {}
+        profile = analysis.get("target_profile")
+        priority = self.task_prioritizer.priority_for(prompt, profile=profile)
         task_message = {
-            "task_id": task_id,
+            "task_id": task_data["task_id"],
+            "prompt": prompt,
+            "status": "Received",
+            "priority": priority,
+            "start_time": time.time(),
+            "recovery_attempts": attempts
+        }
+        exchange, routing_key = self.task_router.route(prompt, priority, profile=profile)
+        if not self.mcp_handler.publish_to_exchange(exchange, routing_key, task_message, priority=priority):
+            return False
+        print(f"Orphaned task {task_data['task_id']} requeued to '{exchange or '(default)'}/{routing_key}' (attempt {attempts}).")
+        return True
+
+    async def connect_async_mcp(self):
+        """Connects the asyncio MCP transport, if it is enabled."""
+        if self.async_mcp_handler:
+            try:
+                await self.async_mcp_handler.connect()
+            except Exception as e:
+                print(f"Failed to connect async MCP Handler: {e}")
+
+    async def close_async_mcp(self):
+        """Closes the asyncio MCP transport, if it is enabled."""
+        if self.async_mcp_handler:
+            await self.async_mcp_handler.close()
+
+    def _build_task_message(self, user_prompt: str, priority: int = None, profile: str = None) -> dict:
+        """Builds the message published to the inbound task queue."""
+        return {
+            "task_id": str(uuid.uuid4()),
             "prompt": user_prompt,
             "status": "Received",
+            "priority": self.task_prioritizer.priority_for(user_prompt, priority=priority, profile=profile),
             "start_time": time.time()
         }
-        self.mcp_handler.publish_message('ai-agent-server.tasks.inbound', task_message)
-        print(f"Task {task_id} published to inbound queue.")
+
+    def process_request(self, user_prompt: str, priority: int = None, profile: str = None):
+        """
+        Receives a user request and publishes it to the inbound queue of its shard and priority lane.
+        """
+        self.metrics_collector.increment_total_requests()
+        task_message = self._build_task_message(user_prompt, priority=priority, profile=profile)
+        task_id = task_message["task_id"]
+        exchange, routing_key = self.task_router.route(user_prompt, task_message["priority"], profile=profile)
+        if not self.mcp_handler.publish_to_exchange(exchange, routing_key, task_message, priority=task_message["priority"]):
+            self.metrics_collector.increment_failed_requests()
+            return None
+        print(f"Task {task_id} published to inbound route '{exchange or '(default)'}/{routing_key}'.")
         return task_id
 
-    def handle_mcp_task(self, message_body: bytes):
+    async def process_request_async(self, user_prompt: str, priority: int = None, profile: str = None):
+        """
+        Awaitable variant of process_request used by the API handlers.
+        Publishes through the asyncio transport so the event loop is never blocked;
+        falls back to the blocking transport, in the default executor, when the asyncio
+        one is disabled.
+        """
+        if not self.async_mcp_handler:
+            return await asyncio.get_running_loop().run_in_executor(
+                None, functools.partial(self.process_request, user_prompt, priority=priority, profile=profile)
+            )
+
+        self.metrics_collector.increment_total_requests()
+        task_message = self._build_task_message(user_prompt, priority=priority, profile=profile)
+        task_id = task_message["task_id"]
+        exchange, routing_key = self.task_router.route(user_prompt, task_message["priority"], profile=profile)
+        if not await self.async_mcp_handler.publish_to_exchange(exchange, routing_key, task_message, priority=task_message["priority"]):
+            self.metrics_collector.increment_failed_requests()
+            return None
+        print(f"Task {task_id} published to inbound route '{exchange or '(default)'}/{routing_key}'.")
+        return task_id
+
+    def handle_mcp_task(self, message_body: bytes, content_type: str = None):
         """
         Callback function to handle tasks received from the MCP inbound queue.
         """
         try:
-            task_data = json.loads(message_body.decode('utf-8'))
+            task_data = decode_message(message_body, content_type)
             task_id = task_data.get("task_id")
             user_prompt = task_data.get("prompt")
             start_time = task_data.get("start_time")
+
+            # A redelivered message may belong to a task that is finished or that another node still runs.
+            if task_id and not self.task_state_manager.claim_task(task_id):
+                print(f"Task {task_id} is finished or owned by another node. Skipping the message.")
+                return
             
             self.metrics_collector.task_started()
             print(f"Orchestration Engine received task from MCP: '{user_prompt}' (ID: {task_id})")
@@ -187,13 +317,14 @@ class OrchestrationEngine:
             target_role = analysis.get("target_role")
             confidence = analysis.get("confidence_score")
 
-            # 2. Create or update task state
-            self.task_state_manager.create_task_state(
-                user_prompt,
-                initial_status="Processing",
-                initial_payload={"analysis": analysis},
-                task_id=task_id
-            )
+            # 2. Create or update task state (a requeued or redelivered task keeps its state and history)
+            if not self.task_state_manager.resume_task(task_id, "Processing", {"analysis": analysis}):
+                self.task_state_manager.create_task_state(
+                    user_prompt,
+                    initial_status="Processing",
+                    initial_payload={"analysis": analysis},
+                    task_id=task_id
+                )
 
             # 3. Route based on analysis
             if confidence < 0.7:
@@ -217,21 +348,23 @@ class OrchestrationEngine:
                 self.metrics_collector.add_response_time(end_time - start_time)
             self.metrics_collector.task_finished()
 
-        except json.JSONDecodeError:
-            print("Error decoding JSON message from MCP.")
+        except MessageDecodeError as e:
+            print(f"Error decoding message from MCP: {e}")
             self.metrics_collector.increment_failed_requests()
             self.metrics_collector.task_finished()
         except Exception as e:
             print(f"Error handling MCP task: {e}")
             self.metrics_collector.increment_failed_requests()
             self.metrics_collector.task_finished()
+            # Re-raised so the MCP handler retries the task with backoff (malformed messages are not retried).
+            raise
 
-    def handle_feedback_message(self, message_body: bytes):
+    def handle_feedback_message(self, message_body: bytes, content_type: str = None):
         """
         Callback function to handle feedback messages from agents.
         """
         try:
-            feedback_data = json.loads(message_body.decode('utf-8'))
+            feedback_data = decode_message(message_body, content_type)
             task_id = feedback_data.get("task_id")
             status = feedback_data.get("status")
             payload = feedback_data.get("payload")
@@ -251,10 +384,12 @@ class OrchestrationEngine:
                 self.metrics_collector.increment_successful_requests()
                 # Note: We might need to adjust how response time is calculated for multi-step tasks.
 
-        except json.JSONDecodeError:
-            print("Error decoding JSON feedback message.")
+        except MessageDecodeError as e:
+            print(f"Error decoding feedback message: {e}")
         except Exception as e:
             print(f"Error processing feedback message: {e}")
+            # Re-raised so the MCP handler retries the message with backoff, then dead-letters it.
+            raise
 
     def _handle_chat_mode(self, task_id: str, prompt: str):
         """Handles requests in Chat mode."""
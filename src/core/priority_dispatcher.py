@@ -0,0 +1,72 @@
+# Priority Dispatcher
+
+import heapq
+import itertools
+import threading
+import time
+
+class PriorityDispatcher:
+    """
+    A fixed pool of worker threads that always runs the most urgent pending job.
+    Urgency is the job's priority plus an aging bonus of `aging_rate` points per
+    second spent waiting, so low-priority work is eventually picked even while
+    high-priority work keeps arriving. Because every job ages at the same rate,
+    the ordering key can be computed once at submit time and kept in a heap.
+    """
+    def __init__(self, workers: int, aging_rate: float = 1.0, name: str = "mcp-worker"):
+        """
+        Initializes and starts the worker threads.
+        """
+        self.aging_rate = aging_rate
+        self._heap = []
+        self._sequence = itertools.count()
+        self._cond = threading.Condition()
+        self._shutdown = False
+        self._threads = []
+        for index in range(max(1, workers)):
+            thread = threading.Thread(target=self._worker_loop, name=f"{name}-{index}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, priority: int, fn, *args):
+        """
+        Queues `fn(*args)` with the given priority (higher runs first).
+        """
+        # urgency(now) = priority + aging_rate * (now - submitted); the (now) term is
+        # shared by every job, so ordering by (priority - aging_rate * submitted) is stable.
+        key = -(priority - self.aging_rate * time.monotonic())
+        with self._cond:
+            if self._shutdown:
+                raise RuntimeError("Dispatcher has been shut down.")
+            heapq.heappush(self._heap, (key, next(self._sequence), fn, args))
+            self._cond.notify()
+
+    def pending(self) -> int:
+        """Returns the number of jobs waiting for a worker."""
+        with self._cond:
+            return len(self._heap)
+
+    def _worker_loop(self):
+        while True:
+            with self._cond:
+                while not self._heap and not self._shutdown:
+                    self._cond.wait()
+                if self._shutdown and not self._heap:
+                    return
+                _, _, fn, args = heapq.heappop(self._heap)
+            try:
+                fn(*args)
+            except Exception as e:
+                print(f"Unhandled error in dispatched job: {e}")
+
+    def shutdown(self, wait: bool = False):
+        """
+        Stops accepting jobs. Workers finish the pending queue and exit.
+        """
+        with self._cond:
+            self._shutdown = True
+            self._cond.notify_all()
+        if wait:
+            for thread in self._threads:
+                if thread is not threading.current_thread():
+                    thread.join()
@@ -0,0 +1,81 @@
+# Retry Policy
+
+from src.config.config_loader import config
+
+DEAD_LETTER_EXCHANGE = 'ai-agent-server.dlx'
+RETRY_EXCHANGE_PREFIX = 'ai-agent-server.retry'
+
+ATTEMPTS_HEADER = 'x-attempts'
+ORIGINAL_QUEUE_HEADER = 'x-original-queue'
+LAST_ERROR_HEADER = 'x-last-error'
+FAILED_AT_HEADER = 'x-failed-at'
+
+def dead_letter_queue(queue_name: str) -> str:
+    """Returns the name of the dead-letter queue that collects a queue's failed messages."""
+    return f"{queue_name}.dlq"
+
+class RetryPolicy:
+    """
+    Delayed-retry policy for messages whose handler raised.
+    A failed message is republished to a retry tier: a fanout exchange feeding a
+    queue whose `x-message-ttl` is the tier's delay and whose dead-letter exchange
+    is the default exchange. When the TTL expires the broker dead-letters the message
+    with its original routing key (the source queue), so it is redelivered after the
+    delay without any timer in this process. Delays grow per attempt (exponential
+    backoff by default); after `max_attempts` the message goes to the source queue's
+    dead-letter queue through the `ai-agent-server.dlx` exchange.
+    A message that could be neither retried nor dead-lettered (the publish failed)
+    is requeued after `requeue_delay_ms`, so a broken broker is not hot-looped.
+    """
+    def __init__(self):
+        """
+        Initializes the policy from `mcp_config.retry_policy`.
+        """
+        retry_config = config.get("mcp_config", {}).get("retry_policy", {})
+        self.enabled = retry_config.get("enabled", True)
+        self.max_attempts = max(1, retry_config.get("max_attempts", 5))
+        base_delay_ms = retry_config.get("base_delay_ms", 1000)
+        multiplier = retry_config.get("multiplier", 4)
+        # Tiers are explicit or derived as base * multiplier^n, one per retry.
+        self.delays_ms = retry_config.get("delays_ms") or [
+            int(base_delay_ms * multiplier ** attempt) for attempt in range(self.max_attempts - 1)
+        ]
+        self.requeue_delay_ms = max(0, retry_config.get("requeue_delay_ms", 5000))
+
+    def delay_for(self, attempt: int) -> int:
+        """Returns the delay (ms) before retry number `attempt` (1-based)."""
+        return self.delays_ms[min(attempt, len(self.delays_ms)) - 1]
+
+    def should_retry(self, attempt: int) -> bool:
+        """Returns True if a message that has failed `attempt` times may be retried."""
+        return self.enabled and bool(self.delays_ms) and attempt < self.max_attempts
+
+    def tier_name(self, delay_ms: int) -> str:
+        """Returns the exchange/queue name of a retry tier."""
+        return f"{RETRY_EXCHANGE_PREFIX}.{delay_ms}ms"
+
+    def register_topology(self, topology):
+        """
+        Registers the dead-letter exchange and every retry tier in a TopologyRegistry.
+        """
+        topology.register_exchange(DEAD_LETTER_EXCHANGE, exchange_type='direct')
+        if not self.enabled:
+            return
+        for delay_ms in sorted(set(self.delays_ms)):
+            tier = self.tier_name(delay_ms)
+            topology.register_exchange(tier, exchange_type='fanout')
+            topology.register_queue(tier, arguments={
+                "x-message-ttl": delay_ms,
+                # Expired messages go back through the default exchange, keeping their routing key.
+                "x-dead-letter-exchange": "",
+            })
+            topology.register_binding(tier, tier, '')
+
+    def register_dead_letter_queue(self, topology, queue_name: str) -> str:
+        """
+        Registers the dead-letter queue of a source queue, bound to the DLX by the source queue's name.
+        """
+        dlq = dead_letter_queue(queue_name)
+        topology.register_queue(dlq)
+        topology.register_binding(dlq, DEAD_LETTER_EXCHANGE, queue_name)
+        return dlq
@@ -0,0 +1,58 @@
+# Task Priority
+
+from src.config.config_loader import config
+from src.core.mcp_topology import INBOUND_QUEUE
+
+class TaskPrioritizer:
+    """
+    Derives a priority for each inbound task and maps it to a priority lane.
+    Priority comes from, in order: the explicit value on the request, the nature
+    the DiagnosisAgent classifies the prompt as, the request's profile, and the
+    configured default. Each lane is a separate inbound queue whose consumer
+    channel has its own prefetch, so every lane (including the lowest) always has
+    messages in flight and batch work cannot starve, nor be starved by, interactive work.
+    """
+    def __init__(self, diagnosis_agent=None):
+        """
+        Initializes the prioritizer from the `task_priorities` configuration.
+        """
+        priority_config = config.get("task_priorities", {})
+        self.diagnosis_agent = diagnosis_agent
+        self.max_priority = priority_config.get("max_priority", 10)
+        self.default_priority = priority_config.get("default", 5)
+        self.by_nature = priority_config.get("by_nature", {})
+        self.by_profile = priority_config.get("by_profile", {})
+        # Lanes sorted from most to least urgent.
+        self.lanes = sorted(priority_config.get("lanes", []), key=lambda lane: lane.get("min_priority", 0), reverse=True)
+
+    def priority_for(self, prompt: str, priority: int = None, profile: str = None) -> int:
+        """
+        Returns the priority (0..max_priority, higher is more urgent) for a request.
+        """
+        if priority is None and self.diagnosis_agent and self.by_nature:
+            # classify_intent is a handful of substring checks, cheap enough for the publish path.
+            priority = self.by_nature.get(self.diagnosis_agent.classify_intent(prompt))
+        if priority is None and profile:
+            priority = self.by_profile.get(profile)
+        if priority is None:
+            priority = self.default_priority
+        return max(0, min(int(priority), self.max_priority))
+
+    def queue_for(self, priority: int) -> str:
+        """
+        Returns the inbound queue (lane) that a task with this priority is published to.
+        """
+        for lane in self.lanes:
+            if priority >= lane.get("min_priority", 0):
+                return f"{INBOUND_QUEUE}.{lane['name']}"
+        return INBOUND_QUEUE
+
+    def inbound_queues(self) -> list[tuple[str, int | None]]:
+        """
+        Returns (queue name, prefetch) for every inbound queue the orchestrator must consume.
+        The plain inbound queue is always included so messages published before lanes
+        were configured are still drained.
+        """
+        queues = [(f"{INBOUND_QUEUE}.{lane['name']}", lane.get("prefetch")) for lane in self.lanes]
+        queues.append((INBOUND_QUEUE, None))
+        return queues
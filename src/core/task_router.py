@@ -0,0 +1,87 @@
+# Task Router
+
+from src.config.config_loader import config
+from src.core.mcp_topology import INBOUND_QUEUE
+
+class TaskRouter:
+    """
+    Decides where an inbound task is published and which queues the orchestrator consumes.
+    Without sharding every task goes to its priority lane queue (see TaskPrioritizer).
+    With `task_sharding.enabled`, tasks are published to a direct exchange with the
+    routing key "<shard>.<lane>", where the shard is the agent profile the request
+    belongs to. Every shard has its own lane queues and its own consumer group, so
+    one profile's backlog cannot occupy another profile's workers.
+    """
+    def __init__(self, prioritizer, diagnosis_agent=None):
+        """
+        Initializes the router from the `task_sharding` configuration.
+        """
+        sharding_config = config.get("task_sharding", {})
+        self.prioritizer = prioritizer
+        self.diagnosis_agent = diagnosis_agent
+        self.enabled = sharding_config.get("enabled", False)
+        self.exchange = sharding_config.get("exchange", "ai-agent-server.tasks")
+        self.shards = sharding_config.get("shards", {})
+        self.default_shard = sharding_config.get("default_shard", "General")
+
+    def shard_for(self, prompt: str, profile: str = None) -> str:
+        """
+        Returns the shard (agent profile) a request belongs to: the explicit profile if it
+        is a known shard, otherwise the profile the DiagnosisAgent classifies the prompt into.
+        """
+        if profile in self.shards:
+            return profile
+        if self.diagnosis_agent:
+            nature = self.diagnosis_agent.classify_intent(prompt)
+            classified_profile, _ = self.diagnosis_agent.determine_target_profile_and_role(nature)
+            if classified_profile in self.shards:
+                return classified_profile
+        return self.default_shard
+
+    def route(self, prompt: str, priority: int, profile: str = None) -> tuple[str, str]:
+        """
+        Returns (exchange, routing_key) for a task. The default exchange ('') means the
+        routing key is a queue name.
+        """
+        lane_queue = self.prioritizer.queue_for(priority)
+        if not self.enabled:
+            return '', lane_queue
+        lane = self._lane_name(lane_queue)
+        return self.exchange, f"{self.shard_for(prompt, profile)}.{lane}"
+
+    def _lane_name(self, lane_queue: str) -> str:
+        """Returns the lane part of a lane queue name ("default" for the plain inbound queue)."""
+        prefix = f"{INBOUND_QUEUE}."
+        return lane_queue[len(prefix):] if lane_queue.startswith(prefix) else "default"
+
+    def inbound_subscriptions(self) -> list[dict]:
+        """
+        Returns every inbound queue to consume, as dicts with `queue`, `prefetch`,
+        `consumer_group` and, for sharded queues, the `exchange`/`routing_key` binding.
+        """
+        subscriptions = [
+            {"queue": queue_name, "prefetch": prefetch, "consumer_group": None}
+            for queue_name, prefetch in self.prioritizer.inbound_queues()
+        ]
+        if not self.enabled:
+            return subscriptions
+
+        for shard in self.shards:
+            for lane_queue, prefetch in self.prioritizer.inbound_queues():
+                lane = self._lane_name(lane_queue)
+                subscriptions.append({
+                    "queue": f"{INBOUND_QUEUE}.{shard}.{lane}",
+                    "prefetch": prefetch,
+                    "consumer_group": shard,
+                    "exchange": self.exchange,
+                    "routing_key": f"{shard}.{lane}",
+                })
+        return subscriptions
+
+    def consumer_groups(self) -> dict[str, int]:
+        """
+        Returns the number of workers for each shard's consumer group.
+        """
+        if not self.enabled:
+            return {}
+        return {shard: shard_config.get("workers", 1) for shard, shard_config in self.shards.items()}
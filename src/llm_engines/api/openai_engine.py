@@ -23,8 +23,21 @@ class OpenAIEngine:
             self.client = None
         else:
             self.client = openai.OpenAI(api_key=self.api_key)
+        # Called as listener(model, success, error) after every generate_response call.
+        self.outcome_listeners = []
         self.logger.info("OpenAIEngine initialized.")
 
+    def add_outcome_listener(self, listener):
+        """Registers a callable notified of each call's outcome (e.g. by the engine health tracker)."""
+        self.outcome_listeners.append(listener)
+
+    def _report_outcome(self, model: str, success: bool, error: str = None):
+        for listener in self.outcome_listeners:
+            try:
+                listener(model, success, error)
+            except Exception as e:
+                self.logger.error(f"Outcome listener failed: {e}")
+
     def generate_response(self, prompt: str, model: str = "gpt-4o", **kwargs) -> str:
         """
         Generates a response from the OpenAI API based on the prompt.
@@ -32,6 +45,7 @@ class OpenAIEngine:
         if not self.client:
             error_msg = "OpenAI client not initialized due to missing API key."
             self.logger.error(error_msg)
+            self._report_outcome(model, False, error_msg)
             return f"Error: {error_msg}"
         
         self.logger.info(f"Generating response with OpenAI model '{model}' for prompt: '{prompt}'")
@@ -44,7 +58,9 @@ class OpenAIEngine:
                 ],
                 **kwargs
             )
-            
+            # The API answered: the engine is healthy even if the content is empty.
+            self._report_outcome(model, True)
+
             if response.choices and response.choices[0].message and response.choices[0].message.content:
                 return response.choices[0].message.content.strip()
             else:
@@ -52,11 +68,22 @@ class OpenAIEngine:
                 return "Error: No response content received from OpenAI."
         except openai.APIError as e:
             self.logger.error(f"OpenAI API error: {e}")
+            self._report_outcome(model, False, str(e))
             return f"Error: OpenAI API error - {str(e)}"
         except Exception as e:
             self.logger.error(f"An unexpected error occurred: {e}")
+            self._report_outcome(model, False, str(e))
             return f"Error: An unexpected error occurred - {str(e)}"
 
+    def list_models(self) -> list[str]:
+        """
+        Returns the ids of all the models the API key can use. Unlike
+        get_available_models, raises on errors; used as the health probe.
+        """
+        if not self.client:
+            raise ConnectionError("OpenAI client not initialized due to missing API key.")
+        return [model.id for model in self.client.models.list().data]
+
     def get_available_models(self) -> list[str]:
         """
         Retrieves a list of available GPT models from the OpenAI API.
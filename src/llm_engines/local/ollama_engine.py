@@ -1,36 +1,103 @@
 # src/llm_engines/local/ollama_engine.py
 
-import ollama
 import logging
+import time
+
+from src.config.config_loader import config
+from src.llm_engines.local.ollama_pool import EndpointPool, NoEndpointError, OllamaEndpoint
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 
 class OllamaEngine:
     """
-    Handles communication with a local Ollama instance, supporting dynamic model management.
+    Handles communication with Ollama, supporting dynamic model management. Calls are
+    spread over a pool of Ollama hosts (`ollama.hosts`), balanced per call by fewest calls
+    in flight or by latency (`ollama.balancing`), each host with its own concurrency limit.
+    Hosts can be added and removed at runtime; a call failing on one host is retried on
+    another serving the same model. Calls are scheduled by the models each host has loaded
+    (`ollama.scheduling`), so that hosts swap multi-GB models in and out less often.
     """
     def __init__(self):
         """
         Initializes the OllamaEngine.
         """
-        self.client = None
+        ollama_config = config.get("ollama", {})
+        self.hosts = ollama_config.get("hosts", [])
+        self.default_max_concurrency = ollama_config.get("max_concurrency", 2)
+        self.default_max_loaded_models = ollama_config.get("max_loaded_models")
+        scheduling_config = ollama_config.get("scheduling", {})
         self.logger = logging.getLogger(self.__class__.__name__)
-        self.currently_loaded_model = None
+        self.pool = EndpointPool(
+            strategy=ollama_config.get("balancing", "least_outstanding"),
+            ewma_alpha=ollama_config.get("ewma_alpha", 0.3),
+            acquire_timeout=ollama_config.get("acquire_timeout", 30.0),
+            max_failures=ollama_config.get("max_failures", 2),
+            cooldown=ollama_config.get("cooldown", 30.0),
+            residency_aware=scheduling_config.get("residency_aware", True),
+            fairness_window=scheduling_config.get("fairness_window", 4),
+        )
+        # Called as listener(model, success, error) after every generate_response call.
+        self.outcome_listeners = []
         self.logger.info("OllamaEngine initialized.")
 
-    def connect(self, ollama_url: str = "http://localhost:11434"):
+    @property
+    def client(self):
+        """The client of the first endpoint in the pool (None without endpoints)."""
+        endpoints = self.pool.endpoints()
+        return endpoints[0].client if endpoints else None
+
+    def add_outcome_listener(self, listener):
+        """Registers a callable notified of each call's outcome (e.g. by the engine health tracker)."""
+        self.outcome_listeners.append(listener)
+
+    def _report_outcome(self, model: str, success: bool, error: str = None):
+        for listener in self.outcome_listeners:
+            try:
+                listener(model, success, error)
+            except Exception as e:
+                self.logger.error(f"Outcome listener failed: {e}")
+
+    def connect(self, ollama_url: str = None):
         """
-        Establishes a connection to the Ollama service.
+        Adds the Ollama service at `ollama_url` to the pool or, without one, every host
+        in `ollama.hosts` (http://localhost:11434 if there are none), then lists their models.
+        An unreachable host stays in the pool and is used once a listing reaches it.
         """
-        self.logger.info(f"Connecting to Ollama at {ollama_url}...")
+        hosts = [{"url": ollama_url}] if ollama_url else (self.hosts or [{"url": "http://localhost:11434"}])
+        for host in hosts:
+            self.add_endpoint(host["url"], host.get("max_concurrency"), host.get("models"), host.get("max_loaded_models"))
         try:
-            self.client = ollama.Client(host=ollama_url)
-            self.client.list() # Test connection
+            self.pool.refresh()
             self.logger.info("Successfully connected to Ollama.")
         except Exception as e:
             self.logger.error(f"Failed to connect to Ollama: {e}")
-            self.client = None
+
+    def add_endpoint(self, url: str, max_concurrency: int = None, models: list = None, max_loaded_models: int = None) -> dict:
+        """
+        Adds an Ollama host to the pool (or updates its limits and models). `models`
+        restricts the models routed to it; by default, any model it has pulled.
+        `max_loaded_models` is how many models fit in its memory at once; by default,
+        the most its `ps` listing has shown.
+        """
+        self.logger.info(f"Connecting to Ollama at {url}...")
+        endpoint = self.pool.add(OllamaEndpoint(
+            url, max_concurrency or self.default_max_concurrency, models,
+            max_loaded_models=max_loaded_models or self.default_max_loaded_models,
+        ))
+        return endpoint.stats()
+
+    def remove_endpoint(self, url: str) -> bool:
+        """Removes an Ollama host from the pool. Its running calls complete."""
+        return self.pool.remove(url)
+
+    def get_endpoint_stats(self) -> list[dict]:
+        """Returns, per Ollama host, its calls in flight, latency, failures and models."""
+        return self.pool.stats()
+
+    def get_scheduling_stats(self) -> dict:
+        """Returns the model loads and swaps caused so far, and the calls waiting for a host."""
+        return self.pool.scheduling_stats()
 
     def generate_response(self, prompt: str, model: str, **kwargs) -> str:
         """
@@ -38,45 +105,64 @@ class OllamaEngine:
         Ollama's API handles loading models into memory on demand. If memory is insufficient,
         it may offload the previously used model. This implementation ensures the correct
         model is requested for each task.
+        The call runs on the pool's best endpoint for `model`, preferably one that already
+        has it loaded, and on the next one if it fails.
         """
-        if not self.client:
-            error_msg = "Ollama client not connected."
-            self.logger.error(error_msg)
-            return f"Error: {error_msg}"
-
         self.logger.info(f"Requesting response from model '{model}' for prompt: '{prompt}'")
-        
-        try:
-            # Ollama handles the loading and unloading of models implicitly.
-            # When a request for a new model comes in, Ollama will load it.
-            # If the hardware is constrained, it will automatically unload the least recently used model.
-            if model != self.currently_loaded_model:
-                self.logger.info(f"Switching active model to '{model}'. Ollama will handle memory management.")
-                self.currently_loaded_model = model
-
-            response = self.client.chat(
-                model=model,
-                messages=[{'role': 'user', 'content': prompt}],
-                **kwargs
-            )
+
+        tried = []
+        last_error = None
+        while True:
+            try:
+                endpoint = self.pool.acquire(model, exclude=tried)
+            except NoEndpointError as e:
+                if e.busy and last_error is None:
+                    # Saturated, not failing: nothing to report to the health tracker.
+                    self.logger.error(str(e))
+                    return f"Error: {e}"
+                break
+            start = time.monotonic()
+            try:
+                response = endpoint.client.chat(
+                    model=model,
+                    messages=[{'role': 'user', 'content': prompt}],
+                    **kwargs
+                )
+            except Exception as e:
+                self.logger.error(f"Error generating response from Ollama model '{model}' on {endpoint.url}: {e}")
+                if getattr(e, "status_code", None) == 404:
+                    # The host does not have the model; the host itself is fine.
+                    self.pool.release(endpoint, time.monotonic() - start, None)
+                    self.pool.forget_model(endpoint, model)
+                else:
+                    self.pool.release(endpoint, time.monotonic() - start, False, str(e))
+                tried.append(endpoint)
+                last_error = e
+                continue
+            self.pool.release(endpoint, time.monotonic() - start, True)
+            self._report_outcome(model, True)
             return response['message']['content']
-        except Exception as e:
-            self.logger.error(f"Error generating response from Ollama model '{model}': {e}")
-            return f"Error: {e}"
+
+        error_msg = str(last_error) if last_error is not None else f"No available Ollama endpoint serves model '{model}'."
+        self.logger.error(f"Error generating response from Ollama model '{model}': {error_msg}")
+        self._report_outcome(model, False, error_msg)
+        return f"Error: {error_msg}"
+
+    def list_models(self) -> list[str]:
+        """
+        Returns the names of the models pulled on any Ollama host of the pool, refreshing
+        what each host serves. Unlike get_available_models, raises if no host can be
+        reached; used as the health probe.
+        """
+        return sorted(self.pool.refresh())
 
     def get_available_models(self) -> list[str]:
         """
-        Retrieves a list of locally available models from the Ollama service.
+        Retrieves a list of the models available on the Ollama hosts.
         """
-        if not self.client:
-            error_msg = "Ollama client not connected."
-            self.logger.error(error_msg)
-            return [f"Error: {error_msg}"]
-        
         self.logger.info("Fetching available Ollama models...")
         try:
-            models_info = self.client.list()
-            return [model['name'] for model in models_info['models']]
+            return self.list_models()
         except Exception as e:
             self.logger.error(f"Error fetching models from Ollama: {e}")
             return [f"Error: {e}"]
@@ -86,6 +172,7 @@ if __name__ == '__main__':
     ollama_engine = OllamaEngine()
     ollama_engine.connect()
 
+    print("Endpoints:", ollama_engine.get_endpoint_stats())
     if ollama_engine.client:
         models = ollama_engine.get_available_models()
         print("Available models:", models)
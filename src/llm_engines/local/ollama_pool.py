@@ -0,0 +1,354 @@
+# src/llm_engines/local/ollama_pool.py
+
+import itertools
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+import ollama
+
+STRATEGIES = ("least_outstanding", "ewma")
+
+def _model_key(name: str) -> str:
+    """Ollama lists 'tinyllama:latest' for a model requested as 'tinyllama'."""
+    return name if ":" in name else f"{name}:latest"
+
+class NoEndpointError(RuntimeError):
+    """
+    Raised by EndpointPool.acquire when no endpoint can take a call for a model.
+    `busy` is True when some endpoint serves the model but all of them stayed at
+    their concurrency limit until the timeout.
+    """
+    def __init__(self, message: str, busy: bool = False):
+        super().__init__(message)
+        self.busy = busy
+
+class OllamaEndpoint:
+    """
+    One Ollama host. `max_concurrency` calls run on it at once at most. `allowed_models`
+    (from the configuration) restricts which models are routed to it; `models` is what
+    the host has pulled, as last listed (None until listed: any model is tried).
+    """
+    def __init__(self, url: str, max_concurrency: int = 1, allowed_models: list = None, client=None,
+                 max_loaded_models: int = None):
+        self.url = url
+        self.max_concurrency = max(1, int(max_concurrency))
+        self.allowed_models = {_model_key(model) for model in allowed_models} if allowed_models else None
+        self.client = client if client is not None else ollama.Client(host=url)
+        self.models = None
+        # Models loaded in the host's memory, least recently used first: as listed by
+        # `ps`, and between listings as estimated from the calls sent to it.
+        self.resident = OrderedDict()
+        # How many models fit at once; without a configured value, the most `ps` has shown.
+        self.max_loaded_models = max_loaded_models
+        self.observed_loaded_models = 1
+        self.model_loads = 0      # calls for a model that was not resident
+        self.model_swaps = 0      # ... that had to evict another one
+        self.outstanding = 0
+        self.ewma_latency = None  # seconds
+        self.completed = 0
+        self.failures = 0         # consecutive
+        self.down_until = 0.0
+        self.last_error = None
+
+    def serves(self, model_key: str) -> bool:
+        return ((self.allowed_models is None or model_key in self.allowed_models)
+                and (self.models is None or model_key in self.models))
+
+    def use_model(self, model_key: str):
+        """Records that a call for `model_key` starts, counting the load (and swap) it causes."""
+        if model_key in self.resident:
+            self.resident.move_to_end(model_key)
+            return
+        self.model_loads += 1
+        capacity = self.max_loaded_models or self.observed_loaded_models
+        if len(self.resident) >= capacity:
+            self.model_swaps += 1
+            while len(self.resident) >= capacity:
+                self.resident.popitem(last=False)
+        self.resident[model_key] = True
+
+    def set_resident(self, model_keys: list):
+        self.resident = OrderedDict.fromkeys(model_keys, True)
+        self.observed_loaded_models = max(self.observed_loaded_models, len(model_keys))
+
+    def stats(self) -> dict:
+        return {
+            "url": self.url,
+            "max_concurrency": self.max_concurrency,
+            "outstanding": self.outstanding,
+            "ewma_latency_ms": round(self.ewma_latency * 1000, 1) if self.ewma_latency is not None else None,
+            "completed": self.completed,
+            "failures": self.failures,
+            "down": self.down_until > time.monotonic(),
+            "last_error": self.last_error,
+            "models": sorted(self.models) if self.models is not None else None,
+            "allowed_models": sorted(self.allowed_models) if self.allowed_models is not None else None,
+            "resident_models": list(self.resident),
+            # Counted from the calls sent, not reported by the host.
+            "estimated_model_loads": self.model_loads,
+            "estimated_model_swaps": self.model_swaps,
+        }
+
+class _Waiter:
+    """A call waiting in EndpointPool.acquire, woken through its own condition on the pool's lock."""
+    __slots__ = ("model_key", "exclude", "skips", "wake")
+
+    def __init__(self, model_key: str, exclude, lock):
+        self.model_key = model_key
+        self.exclude = exclude
+        self.skips = 0  # times a later call took a slot it could have used
+        self.wake = threading.Condition(lock)
+
+class EndpointPool:
+    """
+    The Ollama hosts a model can run on, balanced per call:
+    - `least_outstanding`: the endpoint with the fewest calls in flight, then the
+      lowest latency;
+    - `ewma`: the lowest exponentially weighted moving average of call latency
+      (weight `ewma_alpha` for the newest sample), scaled by the calls in flight, so a
+      slow or loaded host gets less traffic. Endpoints without samples go first.
+    Endpoints at their concurrency limit are skipped; when all of those serving the model
+    are, acquire() waits up to `acquire_timeout` seconds for one to free up.
+    With `residency_aware`, a call goes to a host that already has its model loaded when
+    one is free, and a freed slot goes to the first waiting call whose model is loaded on
+    that host, looking at most `fairness_window` calls ahead. Calls for the same model are
+    thus grouped and hosts swap models less often. A waiting call is overtaken at most
+    `fairness_window` times, then served first. `max_failures`
+    consecutive failed calls, or a failed listing, take an endpoint out for `cooldown`
+    seconds. Endpoints can be added and removed while calls run: a removed endpoint
+    finishes its calls but gets no new ones.
+    A freed slot wakes only the waiting call it goes to, not every waiting call; a call
+    left without any endpoint serving its model is woken to fail at once.
+    """
+    def __init__(self, strategy: str = "least_outstanding", ewma_alpha: float = 0.3, acquire_timeout: float = 30.0,
+                 max_failures: int = 2, cooldown: float = 30.0, residency_aware: bool = True, fairness_window: int = 4):
+        if strategy not in STRATEGIES:
+            raise ValueError(f"Unknown balancing strategy '{strategy}'. Expected one of {STRATEGIES}.")
+        self.strategy = strategy
+        self.ewma_alpha = ewma_alpha
+        self.acquire_timeout = acquire_timeout
+        self.max_failures = max_failures
+        self.cooldown = cooldown
+        self.residency_aware = residency_aware
+        self.fairness_window = fairness_window
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self._endpoints = {}  # url -> OllamaEndpoint
+        self._lock = threading.Lock()
+        self._rotation = itertools.count()  # spreads ties
+        self._waiting = []  # _Waiter, in arrival order
+        self._removed_loads = self._removed_swaps = 0  # counters of removed endpoints
+
+    def add(self, endpoint: OllamaEndpoint) -> OllamaEndpoint:
+        """Adds an endpoint. If its URL is already in the pool, only its limits and allowed models are updated."""
+        with self._lock:
+            existing = self._endpoints.get(endpoint.url)
+            if existing is not None:
+                existing.max_concurrency = endpoint.max_concurrency
+                existing.allowed_models = endpoint.allowed_models
+                existing.max_loaded_models = endpoint.max_loaded_models
+                endpoint = existing
+            else:
+                self._endpoints[endpoint.url] = endpoint
+            self._dispatch()
+        self.logger.info(f"Ollama endpoint {endpoint.url} in pool (max concurrency {endpoint.max_concurrency}).")
+        return endpoint
+
+    def remove(self, url: str) -> bool:
+        with self._lock:
+            endpoint = self._endpoints.pop(url, None)
+            if endpoint is not None:
+                self._removed_loads += endpoint.model_loads
+                self._removed_swaps += endpoint.model_swaps
+            # Waiters may now have no endpoint left at all.
+            self._wake_stranded()
+        if endpoint is not None:
+            self.logger.info(f"Ollama endpoint {url} removed from pool ({endpoint.outstanding} calls still running).")
+        return endpoint is not None
+
+    def endpoints(self) -> list[OllamaEndpoint]:
+        with self._lock:
+            return list(self._endpoints.values())
+
+    def _score(self, endpoint: OllamaEndpoint, model_key: str):
+        latency = endpoint.ewma_latency or 0.0
+        # With residency_aware, a host holding the model comes first.
+        swap = self.residency_aware and model_key not in endpoint.resident
+        if self.strategy == "ewma":
+            return (swap, latency * (endpoint.outstanding + 1), endpoint.outstanding)
+        return (swap, endpoint.outstanding, latency)
+
+    def _can_use(self, waiter: _Waiter, endpoint: OllamaEndpoint, now: float) -> bool:
+        return endpoint not in waiter.exclude and endpoint.down_until <= now and endpoint.serves(waiter.model_key)
+
+    def _next_for(self, endpoint: OllamaEndpoint, now: float) -> _Waiter:
+        """The waiting call a free slot on `endpoint` goes to. Caller holds the lock."""
+        head = None
+        looked_at = 0
+        for waiter in self._waiting:
+            if not self._can_use(waiter, endpoint, now):
+                continue
+            if head is None:
+                head = waiter
+                if not self.residency_aware or waiter.skips >= self.fairness_window:
+                    return head
+            if waiter.model_key in endpoint.resident:
+                return waiter
+            looked_at += 1
+            if looked_at > self.fairness_window:
+                break
+        return head
+
+    def acquire(self, model: str, exclude=()) -> OllamaEndpoint:
+        """
+        Reserves a call slot on the best endpoint serving `model`, other than those in
+        `exclude`. Raises NoEndpointError if there is none, or none frees up in time.
+        """
+        waiter = _Waiter(_model_key(model), exclude, self._lock)
+        deadline = time.monotonic() + self.acquire_timeout
+        with self._lock:
+            self._waiting.append(waiter)
+            try:
+                while True:
+                    now = time.monotonic()
+                    serving = [endpoint for endpoint in self._endpoints.values() if self._can_use(waiter, endpoint, now)]
+                    if not serving:
+                        raise NoEndpointError(f"No available Ollama endpoint serves model '{model}'.")
+                    won = [
+                        endpoint for endpoint in serving
+                        if endpoint.outstanding < endpoint.max_concurrency and self._next_for(endpoint, now) is waiter
+                    ]
+                    if won:
+                        offset = next(self._rotation) % len(won)
+                        endpoint = min(won[offset:] + won[:offset], key=lambda endpoint: self._score(endpoint, waiter.model_key))
+                        for other in self._waiting:
+                            if other is waiter:
+                                break
+                            if self._can_use(other, endpoint, now):
+                                other.skips += 1
+                        endpoint.outstanding += 1
+                        endpoint.use_model(waiter.model_key)
+                        return endpoint
+                    remaining = deadline - now
+                    if remaining <= 0:
+                        raise NoEndpointError(f"All Ollama endpoints serving model '{model}' are busy.", busy=True)
+                    waiter.wake.wait(remaining)
+            finally:
+                self._waiting.remove(waiter)
+                # Slots this call was first in line for may now go to the next one.
+                self._dispatch()
+
+    def release(self, endpoint: OllamaEndpoint, latency: float, success: bool | None, error: str = None):
+        """
+        Frees the slot taken by acquire() and records the call's latency and outcome.
+        `success` None records nothing (e.g. the host answered that it lacks the model).
+        """
+        with self._lock:
+            endpoint.outstanding -= 1
+            if success is None:
+                pass
+            elif success:
+                endpoint.completed += 1
+                endpoint.failures = 0
+                endpoint.last_error = None
+                if endpoint.ewma_latency is None:
+                    endpoint.ewma_latency = latency
+                else:
+                    endpoint.ewma_latency += self.ewma_alpha * (latency - endpoint.ewma_latency)
+            else:
+                self._fail(endpoint, error, self.max_failures)
+            self._dispatch()
+
+    def _fail(self, endpoint: OllamaEndpoint, error: str, max_failures: int):
+        """Caller holds the lock."""
+        endpoint.failures += 1
+        endpoint.last_error = error
+        if endpoint.failures >= max_failures:
+            endpoint.down_until = time.monotonic() + self.cooldown
+            self.logger.warning(f"Ollama endpoint {endpoint.url} down for {self.cooldown}s: {error}")
+            self._wake_stranded()
+
+    def _dispatch(self):
+        """Wakes, for each endpoint with a free slot, the waiting call that slot goes to. Caller holds the lock."""
+        if not self._waiting:
+            return
+        now = time.monotonic()
+        for endpoint in self._endpoints.values():
+            if endpoint.outstanding < endpoint.max_concurrency:
+                waiter = self._next_for(endpoint, now)
+                if waiter is not None:
+                    waiter.wake.notify()
+
+    def _wake_stranded(self):
+        """Wakes the waiting calls no endpoint can serve any more, so they fail now. Caller holds the lock."""
+        now = time.monotonic()
+        endpoints = list(self._endpoints.values())
+        for waiter in self._waiting:
+            if not any(self._can_use(waiter, endpoint, now) for endpoint in endpoints):
+                waiter.wake.notify()
+
+    def forget_model(self, endpoint: OllamaEndpoint, model: str):
+        """
+        The endpoint answered that it does not have `model`: stop routing it there. The
+        call counted the model as loaded on the endpoint; it is not, whether or not the
+        endpoint's models have been listed.
+        """
+        model_key = _model_key(model)
+        with self._lock:
+            if endpoint.models is not None:
+                endpoint.models.discard(model_key)
+            endpoint.resident.pop(model_key, None)
+            self._wake_stranded()
+
+    def refresh(self) -> set:
+        """
+        Lists the models of every endpoint, and those loaded in its memory. A reachable endpoint is back in service; an
+        unreachable one is taken out at once. Returns the models served by any endpoint;
+        raises ConnectionError if no endpoint could be listed.
+        """
+        endpoints = self.endpoints()
+        if not endpoints:
+            raise ConnectionError("No Ollama endpoint configured.")
+        served, errors = set(), []
+        for endpoint in endpoints:
+            try:
+                listed = endpoint.client.list()['models']
+                models = {_model_key(model.get('model') or model.get('name')) for model in listed}
+            except Exception as e:
+                with self._lock:
+                    self._fail(endpoint, str(e), 1)
+                errors.append(f"{endpoint.url}: {e}")
+                continue
+            try:
+                running = [_model_key(model.get('model') or model.get('name')) for model in endpoint.client.ps()['models']]
+            except Exception as e:
+                # Older Ollama versions have no `ps`: keep the estimate.
+                self.logger.debug(f"Could not list the models loaded on {endpoint.url}: {e}")
+                running = None
+            with self._lock:
+                endpoint.models = models
+                if running is not None:
+                    endpoint.set_resident(running)
+                endpoint.failures, endpoint.down_until, endpoint.last_error = 0, 0.0, None
+                self._wake_stranded()
+                self._dispatch()
+            served |= models if endpoint.allowed_models is None else models & endpoint.allowed_models
+        if len(errors) == len(endpoints):
+            raise ConnectionError(f"No Ollama endpoint reachable ({'; '.join(errors)}).")
+        return served
+
+    def stats(self) -> list[dict]:
+        with self._lock:
+            return [endpoint.stats() for endpoint in self._endpoints.values()]
+
+    def scheduling_stats(self) -> dict:
+        """Estimated model loads and swaps over all endpoints, and the calls waiting for a slot."""
+        with self._lock:
+            endpoints = list(self._endpoints.values())
+            return {
+                "estimated_model_loads": self._removed_loads + sum(endpoint.model_loads for endpoint in endpoints),
+                "estimated_model_swaps": self._removed_swaps + sum(endpoint.model_swaps for endpoint in endpoints),
+                "waiting_calls": len(self._waiting),
+                "resident_models": {endpoint.url: list(endpoint.resident) for endpoint in endpoints},
+            }
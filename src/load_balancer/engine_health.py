@@ -0,0 +1,162 @@
+# Engine Health
+
+import threading
+import time
+
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+def normalize_model(name: str) -> str:
+    """Ollama lists 'tinyllama:latest' for a model configured as 'tinyllama'."""
+    return name if ":" in name else f"{name}:latest"
+
+class CircuitBreaker:
+    """
+    Per-engine circuit breaker. `failure_threshold` consecutive failed calls open it;
+    after `reset_timeout` seconds it becomes half-open, and the next outcome (a probe
+    or a call) closes it again or reopens it.
+    """
+    def __init__(self, failure_threshold: int = 3, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.last_error = None
+
+    def record(self, success: bool, error: str = None, trip: bool = False):
+        """Records an outcome. `trip` opens the breaker at once (e.g. the model is missing)."""
+        if success:
+            self.state, self.failures, self.last_error = CLOSED, 0, None
+            return
+        self.failures += 1
+        self.last_error = error
+        if trip or self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+            self.state, self.opened_at = OPEN, time.monotonic()
+
+    def tick(self):
+        if self.state == OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+            self.state = HALF_OPEN
+
+class EngineHealth:
+    """
+    Tracks the health of the LoadBalancer's engines (`llm_engines` entries) with one
+    CircuitBreaker each, fed by:
+    - call outcomes, reported by the LLM engine clients' outcome listeners;
+    - a background prober that, every `probe_interval` seconds, calls each engine
+      client's probe (a callable returning the model names it serves) and checks that
+      every configured model is there. An unreachable host or a missing model opens
+      the breaker at once; a successful probe only closes a half-open breaker.
+    `unavailable` is the set of engines routing must skip: open ones, and half-open
+    ones that a probe will decide on. It is rebuilt on every state change, so reading
+    it costs nothing on the selection path.
+    """
+    def __init__(self, llm_engines: dict, failure_threshold: int = 3, reset_timeout: float = 30.0, probe_interval: float = 15.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.probe_interval = probe_interval
+        self.probes = {}          # engine type (e.g. "ollama") -> callable() -> list of model names
+        self.unavailable = frozenset()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.configure(llm_engines)
+
+    def configure(self, llm_engines: dict):
+        """(Re)builds the breakers for the given `llm_engines` section, keeping known engines' state."""
+        with self._lock:
+            previous = getattr(self, "breakers", {})
+            self.breakers = {
+                name: previous.get(name) or CircuitBreaker(self.failure_threshold, self.reset_timeout)
+                for name in llm_engines
+            }
+            # (engine type, model) -> LoadBalancer engine names, to attribute call outcomes.
+            self._by_model = {}
+            self._models = {}
+            for name, engine_config in llm_engines.items():
+                model = engine_config.get("model")
+                if model:
+                    self._models[name] = model
+                    self._by_model.setdefault((name.split('_')[0], normalize_model(model)), []).append(name)
+            self._refresh()
+
+    def _refresh(self):
+        """Caller holds the lock."""
+        self.unavailable = frozenset(
+            name for name, breaker in self.breakers.items()
+            if breaker.state == OPEN or (breaker.state == HALF_OPEN and name.split('_')[0] in self.probes)
+        )
+
+    def add_probe(self, engine_type: str, probe):
+        with self._lock:
+            self.probes[engine_type] = probe
+            self._refresh()
+
+    def record_outcome(self, engine_type: str, model: str, success: bool, error: str = None):
+        """Outcome listener for LLM engine clients: one call to `model` succeeded or failed."""
+        with self._lock:
+            for name in self._by_model.get((engine_type, normalize_model(model)), ()):
+                self.breakers[name].record(success, error)
+            self._refresh()
+
+    def set_status(self, engine_name: str, healthy: bool, error: str = None):
+        """Marks an engine healthy (closes its breaker) or unhealthy (opens it)."""
+        with self._lock:
+            breaker = self.breakers.get(engine_name)
+            if breaker is None:
+                return False
+            breaker.record(healthy, error, trip=True)
+            self._refresh()
+            return True
+
+    def probe_once(self):
+        """Runs every probe and updates the breakers of the engines it covers."""
+        with self._lock:
+            probes = dict(self.probes)
+            for breaker in self.breakers.values():
+                breaker.tick()
+        results = {}
+        for engine_type, probe in probes.items():
+            try:
+                results[engine_type] = ({normalize_model(model) for model in probe()}, None)
+            except Exception as e:
+                results[engine_type] = (None, f"Probe failed: {e}")
+        with self._lock:
+            for name, model in self._models.items():
+                engine_type = name.split('_')[0]
+                if engine_type not in results:
+                    continue
+                served, error = results[engine_type]
+                if served is None:
+                    self.breakers[name].record(False, error, trip=True)
+                elif normalize_model(model) not in served:
+                    self.breakers[name].record(False, f"Model '{model}' is not available.", trip=True)
+                elif self.breakers[name].state == HALF_OPEN:
+                    # An open breaker stays open until its reset timeout, however the probe went.
+                    self.breakers[name].record(True)
+            self._refresh()
+
+    def states(self) -> dict:
+        with self._lock:
+            return {
+                name: {"state": breaker.state, "failures": breaker.failures, "last_error": breaker.last_error}
+                for name, breaker in self.breakers.items()
+            }
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="engine-health-prober", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                self.probe_once()
+            except Exception as e:
+                print(f"Error probing LLM engines: {e}")
+            if self._stop.wait(self.probe_interval):
+                return
+
+    def close(self):
+        self._stop.set()
+        if self._thread and self._thread.is_alive() and self._thread is not threading.current_thread():
+            self._thread.join(timeout=5)
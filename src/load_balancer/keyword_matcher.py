@@ -0,0 +1,79 @@
+# Keyword Matcher
+
+try:
+    import ahocorasick
+except ImportError:  # optional dependency
+    ahocorasick = None
+
+class KeywordMatcher:
+    """
+    Finds which of a set of keywords occur in a text with one Aho-Corasick scan,
+    however many keywords there are. Each keyword is identified by a bit: find()
+    returns the OR of the bits of every keyword found.
+    Uses pyahocorasick (C) when it is installed, and a pure Python automaton otherwise.
+    """
+    def __init__(self, keywords: dict[str, int]):
+        """`keywords` maps each keyword (already lowercased) to its bit."""
+        self.all_bits = 0
+        for bit in keywords.values():
+            self.all_bits |= bit
+        if ahocorasick is not None:
+            self._automaton = ahocorasick.Automaton()
+            for keyword, bit in keywords.items():
+                self._automaton.add_word(keyword, bit)
+            self._automaton.make_automaton()
+            self.find = self._find_native
+        else:
+            self._build(keywords)
+            self.find = self._find_python
+
+    def _build(self, keywords: dict[str, int]):
+        """Builds the goto, failure and output tables (state 0 is the root)."""
+        goto, fail, output = [{}], [0], [0]
+        for keyword, bit in keywords.items():
+            state = 0
+            for char in keyword:
+                next_state = goto[state].get(char)
+                if next_state is None:
+                    next_state = len(goto)
+                    goto[state][char] = next_state
+                    goto.append({})
+                    fail.append(0)
+                    output.append(0)
+                state = next_state
+            output[state] |= bit
+        # Breadth-first, so a state's failure target is complete before its children's.
+        # Depth-1 states fail to the root, as initialized.
+        queue = list(goto[0].values())
+        for state in queue:
+            for char, child in goto[state].items():
+                target = fail[state]
+                while target and char not in goto[target]:
+                    target = fail[target]
+                fail[child] = goto[target].get(char, 0)
+                output[child] |= output[fail[child]]
+                queue.append(child)
+        self._goto, self._fail, self._output = goto, fail, output
+
+    def _find_python(self, text: str) -> int:
+        goto, fail, output = self._goto, self._fail, self._output
+        all_bits = self.all_bits
+        state = found = 0
+        for char in text:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if output[state]:
+                found |= output[state]
+                if found == all_bits:
+                    break
+        return found
+
+    def _find_native(self, text: str) -> int:
+        all_bits = self.all_bits
+        found = 0
+        for _, bit in self._automaton.iter(text):
+            found |= bit
+            if found == all_bits:
+                break
+        return found
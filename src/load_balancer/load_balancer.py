@@ -1,109 +1,115 @@
 # Load Balancer
 
 from src.config.config_loader import config
+from src.load_balancer.engine_health import EngineHealth
+from src.load_balancer.rules import RuleSet
 
 class LoadBalancer:
+    """
+    Selects an LLM engine per agent call. `load_balancer_rules` are compiled into a
+    RuleSet when the balancer is created and again on reload(), so selecting an engine
+    parses nothing, prints nothing and, for rules that only name agents, is a dict lookup.
+    Engines whose circuit breaker (EngineHealth) is open or awaiting a probe are skipped,
+    so calls fail over, or fail fast, instead of waiting on a backend that is down.
+    """
     def __init__(self):
         """
         Initializes the Load Balancer, using the centralized configuration.
         """
-        self.llm_engines = config.get("llm_engines", {})
-        lb_rules = config.get("load_balancer_rules", {})
-        self.rules = lb_rules.get("rules", [])
-        self.default_engine = lb_rules.get("default_engine")
+        health_config = config.get("engine_health", {})
+        self.health_enabled = health_config.get("enabled", True)
+        self.engine_health = EngineHealth(
+            {},
+            failure_threshold=health_config.get("failure_threshold", 3),
+            reset_timeout=health_config.get("reset_timeout", 30.0),
+            probe_interval=health_config.get("probe_interval", 15.0),
+        )
+        self.reload()
         print("Load Balancer initialized.")
         print(f"Engines configured: {list(self.llm_engines.keys())}")
-        print(f"Rules loaded: {len(self.rules)}")
+        print(f"Rules loaded: {len(self.rule_set.rules)} of {len(self.rules)}")
         print(f"Default engine: {self.default_engine}")
 
-    def select_llm_engine(self, task_details: dict) -> str | None:
+    def reload(self, llm_engines: dict = None, lb_rules: dict = None):
         """
-        Selects the most suitable LLM engine based on configured rules and engine availability.
+        Recompiles the rules from the given `llm_engines` and `load_balancer_rules`
+        sections (by default, from the configuration). Selections running meanwhile
+        keep using the previous RuleSet.
         """
-        prompt = task_details.get('prompt', '').lower()
-        print(f"Selecting LLM engine for prompt: '{prompt}'")
-
-        # 1. Filter available engines based on 'locked' and 'toggle' status
-        available_engines = {
-            name: config for name, config in self.llm_engines.items()
-            if config.get('toggle', True) and not config.get('locked', False)
-        }
-
+        self.llm_engines = llm_engines if llm_engines is not None else config.get("llm_engines", {})
+        lb_rules = lb_rules if lb_rules is not None else config.get("load_balancer_rules", {})
+        self.rules = lb_rules.get("rules", [])
+        self.default_engine = lb_rules.get("default_engine")
+        # Only engines that are toggled on and not locked can be selected.
+        available_engines = [
+            name for name, engine_config in self.llm_engines.items()
+            if engine_config.get('toggle', True) and not engine_config.get('locked', False)
+        ]
         if not available_engines:
             print("No available (toggled on, not locked) LLM engines found.")
-            return None
-
-        # 2. Apply rule-based selection
-        for rule in self.rules:
-            condition = rule.get("condition", "")
-            target_engine = rule.get("engine")
-
-            # Condition check for agent name
-            if "agent.is_one_of" in condition:
-                agent_list_str = condition.split("['")[1].split("']")[0]
-                agent_list = [agent.strip() for agent in agent_list_str.split(',')]
-                if task_details.get('agent') in agent_list:
-                    if target_engine in available_engines:
-                        print(f"Rule matched: Agent is one of {agent_list}. Selected engine: {target_engine}")
-                        return target_engine
-                    else:
-                        print(f"Rule matched for agent in {agent_list}, but target engine '{target_engine}' is not available.")
-            
-            # Condition check for agent name and prompt content
-            elif "agent.is" in condition and "prompt.contains" in condition:
-                agent_name = condition.split("agent.is('")[1].split("')")[0]
-                keyword = condition.split("prompt.contains('")[1].split("')")[0]
-                if task_details.get('agent') == agent_name and keyword in prompt:
-                    if target_engine in available_engines:
-                        print(f"Rule matched: Agent is '{agent_name}' and prompt contains '{keyword}'. Selected engine: {target_engine}")
-                        return target_engine
-                    else:
-                        print(f"Rule matched for agent '{agent_name}' and prompt '{keyword}', but target engine '{target_engine}' is not available.")
-
-            # Simple condition check: "prompt.contains('keyword')"
-            elif "prompt.contains" in condition:
-                keyword = condition.split("'")[1]
-                if keyword in prompt:
-                    if target_engine in available_engines:
-                        print(f"Rule matched: '{keyword}'. Selected engine: {target_engine}")
-                        return target_engine
-                    else:
-                        print(f"Rule matched for '{keyword}', but target engine '{target_engine}' is not available.")
+        self.rule_set = RuleSet(self.rules, available_engines, self.default_engine)
+        self.engine_health.configure(self.llm_engines)
 
-        # 3. Use default engine if no rules matched
-        if self.default_engine and self.default_engine in available_engines:
-            print(f"No specific rule matched. Using default engine: {self.default_engine}")
-            return self.default_engine
-        
-        # 4. Fallback: if default is not available, select the first available one
-        if available_engines:
-            fallback_engine = list(available_engines.keys())[0]
-            print(f"Default engine not available. Falling back to first available engine: {fallback_engine}")
-            return fallback_engine
+    def attach_engines(self, engines: dict, probes: dict = None):
+        """
+        Feeds the engine health tracker from the LLM engine clients, keyed by engine type
+        ('ollama', 'openai'; the prefix of the `llm_engines` names): their call outcomes
+        drive the circuit breakers, and their list_models() is the health probe. `probes`
+        overrides the probe of an engine type with any callable returning model names,
+        e.g. a local stub. Starts the prober.
+        """
+        if not self.health_enabled:
+            return
+        probes = probes or {}
+        for engine_type, engine in engines.items():
+            if hasattr(engine, "add_outcome_listener"):
+                engine.add_outcome_listener(
+                    lambda model, success, error=None, engine_type=engine_type:
+                        self.engine_health.record_outcome(engine_type, model, success, error)
+                )
+        for engine_type in set(engines) | set(probes):
+            probe = probes.get(engine_type) or getattr(engines.get(engine_type), "list_models", None)
+            if probe:
+                self.engine_health.add_probe(engine_type, probe)
+        self.engine_health.start()
 
-        print("No suitable LLM engine could be selected.")
-        return None
+    def select_llm_engine(self, task_details: dict) -> str | None:
+        """
+        Selects the most suitable LLM engine based on configured rules and engine availability:
+        the first matching rule whose engine is available and healthy, else the default
+        engine, else the first available engine, healthy in both cases. Returns None when
+        no engine is healthy.
+        """
+        return self.rule_set.select(task_details.get('agent'), task_details.get('prompt'), self.engine_health.unavailable)
 
     def update_engine_status(self, engine_name: str, status: str):
         """
-        Updates the status of an engine (e.g., 'active', 'inactive', 'error').
-        This is a placeholder for more dynamic health checks.
+        Updates the status of an engine: 'active' closes its circuit breaker, anything
+        else (e.g. 'inactive', 'error') opens it until a probe or call succeeds.
         """
-        if engine_name in self.llm_engines:
-            self.llm_engines[engine_name]['status'] = status
+        if self.engine_health.set_status(engine_name, status == 'active', f"Status set to '{status}'."):
             print(f"Updated status for {engine_name} to '{status}'.")
         else:
             print(f"Engine '{engine_name}' not found.")
 
+    def get_engine_health(self) -> dict:
+        """Returns each engine's circuit breaker state, failure count and last error."""
+        return self.engine_health.states()
+
+    def close(self):
+        self.engine_health.close()
+
 # Example of how LoadBalancer might be used:
 if __name__ == "__main__":
+    import timeit
+
     # This assumes a valid configuration.json exists at the default path
     lb = LoadBalancer()
 
     print("\n--- Selecting Engines ---")
-    task_code = {"prompt": "Please write some code to solve fizzbuzz."}
+    task_code = {"prompt": "Please write some code to solve fizzbuzz.", "agent": "Fast-Coder-Agent"}
     selected_engine_code = lb.select_llm_engine(task_code)
-    print(f"Task '{task_code['prompt']}' -> Engine: {selected_engine_code}")
+    print(f"Task '{task_code['prompt']}' ({task_code['agent']}) -> Engine: {selected_engine_code}")
 
     task_summary = {"prompt": "Can you summarize this long article for me?"}
     selected_engine_summary = lb.select_llm_engine(task_summary)
@@ -112,3 +118,39 @@ if __name__ == "__main__":
     task_general = {"prompt": "What is the capital of France?"}
     selected_engine_general = lb.select_llm_engine(task_general)
     print(f"Task '{task_general['prompt']}' -> Engine: {selected_engine_general}")
+
+    print("\n--- Failing over ---")
+    # A stub probe standing in for `ollama list`: tinyllama has not been pulled.
+    lb.attach_engines({}, probes={"ollama": lambda: ["phi3:mini", "gemma:2b"]})
+    lb.engine_health.probe_once()
+    print(f"Unavailable: {sorted(lb.engine_health.unavailable)}")
+    print(f"Task ({task_code['agent']}) -> Engine: {lb.select_llm_engine(task_code)}")
+    lb.update_engine_status("ollama_tinyllama", "active")
+    print(f"After update_engine_status('ollama_tinyllama', 'active') -> Engine: {lb.select_llm_engine(task_code)}")
+    lb.close()
+
+    print("\n--- Selection cost ---")
+    lb.reload(
+        llm_engines={name: {"toggle": True, "locked": False} for name in ("tiny", "coder", "writer", "large", "default")},
+        lb_rules={
+            "default_engine": "default",
+            "rules": [
+                {"condition": f"agent.is_one_of(['Agent{i}', 'Other{i}'])", "engine": "coder"} for i in range(100)
+            ] + [
+                {"condition": f"agent.is('Writing-Agent') and prompt.contains('keyword{i}')", "engine": "writer"} for i in range(500)
+            ] + [
+                {"condition": "agent.is('Writing-Agent') and prompt.tokens > 50000", "engine": "large"},
+                {"condition": "agent.is_one_of(['Fast-Coder-Agent'])", "engine": "tiny"}
+            ],
+        },
+    )
+    short_prompt = "Please rewrite the following paragraph. " * 25   # ~1 KB
+    long_prompt = short_prompt * 40                                 # ~40 KB
+    for label, task, runs in (
+        ("agent rule", {"prompt": long_prompt, "agent": "FastCoderAgent"}, 200000),
+        ("500 keyword rules, 1 KB prompt", {"prompt": short_prompt, "agent": "Writing-Agent"}, 2000),
+        ("500 keyword rules, 40 KB prompt", {"prompt": long_prompt, "agent": "Writing-Agent"}, 100),
+        ("no rule (default engine)", {"prompt": long_prompt, "agent": "Chat-Agent"}, 200000),
+    ):
+        seconds = timeit.timeit(lambda: lb.select_llm_engine(task), number=runs)
+        print(f"{label}: {seconds / runs * 1e6:.2f} us per selection -> {lb.select_llm_engine(task)}")
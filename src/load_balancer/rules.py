@@ -0,0 +1,278 @@
+# Load Balancer Rules
+
+import operator
+import re
+
+from src.load_balancer.keyword_matcher import KeywordMatcher
+
+_STRING = r"'[^']*'|\"[^\"]*\""
+# One clause of a rule condition; clauses are joined with "and".
+_CLAUSE = re.compile(
+    r"\s*(?:"
+    rf"agent\.is_one_of\(\s*\[(?P<agents>[^\]]*)\]\s*\)"
+    rf"|agent\.is\(\s*(?P<agent>{_STRING})\s*\)"
+    rf"|prompt\.contains\(\s*(?P<keyword>{_STRING})\s*\)"
+    rf"|prompt\.contains_(?P<set_mode>any|all)\(\s*\[(?P<keywords>[^\]]*)\]\s*\)"
+    rf"|prompt\.matches\(\s*(?P<regex>{_STRING})\s*\)"
+    r"|prompt\.(?P<measure>length|tokens)\s*(?P<op><=|>=|<|>|==)\s*(?P<number>\d+)"
+    r")\s*(?P<rest>and\b|$)"
+)
+_QUOTED = re.compile(r"'([^']*)'|\"([^\"]*)\"")
+_NOT_ALPHANUMERIC = re.compile(r"[^a-z0-9]")
+_OPERATORS = {"<": operator.lt, "<=": operator.le, ">": operator.gt, ">=": operator.ge, "==": operator.eq}
+# prompt.tokens is estimated from the length, the usual ~4 characters per token.
+CHARS_PER_TOKEN = 4
+
+class RuleSyntaxError(ValueError):
+    """Raised for a rule condition that is not valid rule syntax."""
+
+def normalize_agent(name: str) -> str:
+    """
+    Returns the key an agent is matched by, so a rule may name an agent by its class
+    name ('FastCoderAgent') or by its role ('Fast-Coder-Agent').
+    """
+    return _NOT_ALPHANUMERIC.sub("", name.lower())
+
+def _strings(text: str) -> list[str]:
+    return [a or b for a, b in _QUOTED.findall(text)]
+
+class CompiledRule:
+    """
+    A rule condition parsed once: the agents it applies to (None: any) and its prompt
+    conditions. Keywords are lowercased; RuleSet assigns each one a bit, so keyword
+    conditions become masks checked against the bits KeywordMatcher found.
+    """
+    def __init__(self, engine: str, condition: str, agents: frozenset | None = None, keywords: tuple = (),
+                 keyword_sets: tuple = (), regexes: tuple = (), measures: tuple = ()):
+        self.engine = engine
+        self.condition = condition
+        self.agents = agents
+        self.keywords = keywords          # all must occur
+        self.keyword_sets = keyword_sets  # for each set, at least one must occur
+        self.regexes = regexes
+        self.measures = measures          # (measure, comparison, number)
+        self.all_mask = 0
+        self.any_masks = ()
+
+    @property
+    def has_prompt_condition(self) -> bool:
+        return bool(self.keywords or self.keyword_sets or self.regexes or self.measures)
+
+    def assign_bits(self, bits: dict[str, int]):
+        for keyword in self.keywords:
+            self.all_mask |= bits[keyword]
+        any_masks = []
+        for keyword_set in self.keyword_sets:
+            mask = 0
+            for keyword in keyword_set:
+                mask |= bits[keyword]
+            any_masks.append(mask)
+        self.any_masks = tuple(any_masks)
+
+    def matches_prompt(self, prompt: str, found: int) -> bool:
+        """`found` holds the bits of the keywords present in `prompt`. Cheapest checks first."""
+        for measure, comparison, number in self.measures:
+            value = len(prompt) if measure == "length" else len(prompt) // CHARS_PER_TOKEN
+            if not comparison(value, number):
+                return False
+        if found & self.all_mask != self.all_mask:
+            return False
+        for mask in self.any_masks:
+            if not found & mask:
+                return False
+        for regex in self.regexes:
+            if not regex.search(prompt):
+                return False
+        return True
+
+def compile_condition(condition: str, engine: str) -> CompiledRule:
+    """
+    Parses a condition made of clauses joined with "and":
+    agent.is_one_of(['DebugAgent', 'QA-Agent']), agent.is('WritingAgent'),
+    prompt.contains('poem'), prompt.contains_any(['bug', 'error']),
+    prompt.contains_all(['sql', 'index']), prompt.matches('def \\w+\\('),
+    prompt.length > 20000 and prompt.tokens <= 512.
+    Keywords and regexes are case-insensitive. Raises RuleSyntaxError if it is not valid.
+    """
+    agents, keywords, keyword_sets, regexes, measures = None, [], [], [], []
+    position = 0
+    while position < len(condition):
+        match = _CLAUSE.match(condition, position)
+        if match is None or match.end() == position:
+            raise RuleSyntaxError(f"Invalid rule condition: {condition!r}")
+        if match.group("agents") is not None or match.group("agent") is not None:
+            names = match.group("agents") if match.group("agents") is not None else match.group("agent")
+            clause_agents = frozenset(normalize_agent(name) for name in _strings(names))
+            # Several agent clauses must all hold.
+            agents = clause_agents if agents is None else agents & clause_agents
+        elif match.group("keyword") is not None:
+            if len(match.group("keyword")) == 2:
+                raise RuleSyntaxError(f"Empty keyword in rule condition: {condition!r}")
+            keywords.append(match.group("keyword")[1:-1].lower())
+        elif match.group("set_mode") is not None:
+            keyword_set = [keyword.lower() for keyword in _strings(match.group("keywords")) if keyword]
+            if not keyword_set:
+                raise RuleSyntaxError(f"Empty keyword list in rule condition: {condition!r}")
+            if match.group("set_mode") == "all":
+                keywords.extend(keyword_set)
+            else:
+                keyword_sets.append(tuple(keyword_set))
+        elif match.group("regex") is not None:
+            try:
+                regexes.append(re.compile(match.group("regex")[1:-1], re.IGNORECASE))
+            except re.error as e:
+                raise RuleSyntaxError(f"Invalid regex in rule condition {condition!r}: {e}") from e
+        else:
+            measures.append((match.group("measure"), _OPERATORS[match.group("op")], int(match.group("number"))))
+        position = match.end()
+        if not match.group("rest"):
+            break
+    rule = CompiledRule(engine, condition, agents, tuple(keywords), tuple(keyword_sets), tuple(regexes), tuple(measures))
+    dangling_and = position and match.group("rest") == "and"
+    if position < len(condition) or dangling_and or (agents is None and not rule.has_prompt_condition):
+        raise RuleSyntaxError(f"Invalid rule condition: {condition!r}")
+    return rule
+
+class Route:
+    """
+    What one agent resolves to: the rules whose prompt conditions still have to be
+    checked, in order, then `engine` when none of them matches. `matcher` finds all
+    of these rules' keywords in one scan of the prompt. A rule that needs a keyword is
+    filed under one keyword it cannot match without (its anchor), so only the rules
+    whose anchor was found, plus the rules needing no keyword, are evaluated.
+    """
+    def __init__(self, rules: tuple, engine: str | None, bits: dict[str, int]):
+        self.rules = rules
+        self.engine = engine
+        self.engines = frozenset(rule.engine for rule in rules) | {engine}
+        route_keywords = {}
+        self.unanchored = []  # positions of rules without keyword conditions
+        self.anchored = {}    # keyword bit -> positions of the rules anchored on it
+        for position, rule in enumerate(rules):
+            for keyword in rule.keywords + tuple(k for keyword_set in rule.keyword_sets for k in keyword_set):
+                route_keywords[keyword] = bits[keyword]
+            if rule.all_mask:
+                anchors = [rule.all_mask & -rule.all_mask]
+            elif rule.any_masks:
+                anchors = [bits[keyword] for keyword in rule.keyword_sets[0]]
+            else:
+                self.unanchored.append(position)
+                continue
+            for anchor in anchors:
+                self.anchored.setdefault(anchor, []).append(position)
+        self.matcher = KeywordMatcher(route_keywords) if route_keywords else None
+
+    def candidates(self, found: int) -> list[int]:
+        """Returns, in rule order, the positions of the rules that can match given the keywords found."""
+        if not found:
+            return self.unanchored
+        positions = set(self.unanchored)
+        while found:
+            bit = found & -found
+            positions.update(self.anchored.get(bit, ()))
+            found ^= bit
+        return sorted(positions)
+
+class RuleSet:
+    """
+    `load_balancer_rules` compiled against the available engines. Rules are indexed
+    by agent: each agent gets a Route holding only the rules that can apply to it, up
+    to its first rule without a prompt condition, after which no later rule can win.
+    Rules whose engine is unavailable are dropped, since they can never be selected.
+    An agent whose Route has no prompt conditions left resolves with one dict lookup;
+    otherwise the prompt is scanned once for every keyword of the Route, and the rules
+    that can still match are evaluated with bit-mask tests on the result.
+    Engines passed to select() as `unavailable` (unhealthy ones) are skipped: only when
+    one of them is on the agent's Route is the agent's full rule list evaluated.
+    """
+    MAX_CACHED_AGENT_NAMES = 1024
+
+    def __init__(self, rules: list[dict], available_engines: list[str], default_engine: str = None):
+        self.available_engines = frozenset(available_engines)
+        self._engine_order = list(available_engines)
+        if default_engine in self.available_engines:
+            self.fallback_engine = default_engine
+        else:
+            self.fallback_engine = available_engines[0] if available_engines else None
+            if default_engine and self.fallback_engine:
+                print(f"Default engine '{default_engine}' not available. Falling back to: {self.fallback_engine}")
+        self.rules = []
+        for rule in rules:
+            try:
+                compiled = compile_condition(rule.get("condition", ""), rule.get("engine"))
+            except RuleSyntaxError as e:
+                print(f"Warning: Skipping load balancer rule. {e}")
+                continue
+            if compiled.engine not in self.available_engines:
+                print(f"Warning: Rule '{compiled.condition}' targets unavailable engine '{compiled.engine}'. Skipping it.")
+                continue
+            self.rules.append(compiled)
+
+        bits = {}
+        for rule in self.rules:
+            for keyword in rule.keywords + tuple(k for keyword_set in rule.keyword_sets for k in keyword_set):
+                bits.setdefault(keyword, 1 << len(bits))
+        for rule in self.rules:
+            rule.assign_bits(bits)
+
+        agent_keys = set()
+        for rule in self.rules:
+            agent_keys.update(rule.agents or ())
+        self._routes = {key: self._build_route(key, bits) for key in agent_keys}
+        self._default_route = self._build_route(None, bits)
+        self._routes_by_name = {}  # agent name as given by callers -> Route
+        self._bits = bits
+        self._full_routes = {}     # agent key -> Route without truncation, built on first use
+
+    def _build_route(self, agent_key: str | None, bits: dict[str, int], truncate: bool = True) -> Route:
+        chain = []
+        for rule in self.rules:
+            if rule.agents is not None and agent_key not in rule.agents:
+                continue
+            if not rule.has_prompt_condition and truncate:
+                # Matches whatever the prompt is: later rules are unreachable.
+                return Route(tuple(chain), rule.engine, bits)
+            chain.append(rule)
+        return Route(tuple(chain), self.fallback_engine, bits)
+
+    def route_for(self, agent: str | None) -> Route:
+        if not agent:
+            return self._default_route
+        route = self._routes_by_name.get(agent)
+        if route is None:
+            route = self._routes.get(normalize_agent(agent), self._default_route)
+            if len(self._routes_by_name) < self.MAX_CACHED_AGENT_NAMES:
+                self._routes_by_name[agent] = route
+        return route
+
+    def select(self, agent: str | None, prompt: str | None, unavailable: frozenset = frozenset()) -> str | None:
+        route = self.route_for(agent)
+        if unavailable and not route.engines.isdisjoint(unavailable):
+            return self._select_available(agent, prompt, unavailable)
+        if route.rules:
+            prompt = prompt or ""
+            found = route.matcher.find(prompt.lower()) if route.matcher else 0
+            rules = route.rules
+            for position in route.candidates(found):
+                if rules[position].matches_prompt(prompt, found):
+                    return rules[position].engine
+        return route.engine
+
+    def _select_available(self, agent: str | None, prompt: str | None, unavailable: frozenset) -> str | None:
+        """select() when the agent's Route involves an unavailable engine: every rule applying
+        to the agent is evaluated, in order, skipping those targeting unavailable engines."""
+        key = normalize_agent(agent) if agent else None
+        if key not in self._routes:
+            key = None
+        route = self._full_routes.get(key)
+        if route is None:
+            route = self._full_routes.setdefault(key, self._build_route(key, self._bits, truncate=False))
+        prompt = prompt or ""
+        found = route.matcher.find(prompt.lower()) if route.matcher else 0
+        for position in route.candidates(found):
+            rule = route.rules[position]
+            if rule.engine not in unavailable and rule.matches_prompt(prompt, found):
+                return rule.engine
+        if self.fallback_engine not in unavailable:
+            return self.fallback_engine
+        return next((engine for engine in self._engine_order if engine not in unavailable), None)
@@ -0,0 +1,194 @@
+# src/tasks_state/event_log.py
+
+import json
+import os
+import threading
+
+FSYNC_POLICIES = ("always", "interval", "none")
+
+class EventLog:
+    """
+    Append-only, segmented JSONL log. Each record is one line; the active segment
+    is closed and a new one started once it exceeds `segment_max_bytes`, so no
+    file grows without bound and appending is O(1) regardless of history length.
+    Durability is set by `fsync_policy`:
+    - "always": append() returns once the record is fsynced. Concurrent appenders
+      share one fsync (group commit), so throughput grows with concurrency.
+    - "interval": a background thread fsyncs every `fsync_interval` seconds.
+    - "none": the OS decides when data reaches the disk.
+    Segments already covered by a snapshot of their owner are removed with drop_segments().
+    """
+    SEGMENT_PREFIX = "events-"
+    SEGMENT_SUFFIX = ".jsonl"
+
+    def __init__(self, log_dir: str, segment_max_bytes: int = 64 * 1024 * 1024, fsync_policy: str = "interval", fsync_interval: float = 0.05):
+        if fsync_policy not in FSYNC_POLICIES:
+            print(f"Warning: Unknown fsync policy '{fsync_policy}'. Using 'interval'.")
+            fsync_policy = "interval"
+        self.log_dir = log_dir
+        self.segment_max_bytes = segment_max_bytes
+        self.fsync_policy = fsync_policy
+        self.fsync_interval = fsync_interval
+        os.makedirs(self.log_dir, exist_ok=True)
+        self._cond = threading.Condition()
+        self._appended = 0  # sequence number of the last appended record
+        self._synced = 0    # sequence number of the last fsynced record
+        self.fsyncs = 0
+        self._closed = False
+        segments = self.segments()
+        self._segment_index = self._index_of(segments[-1]) if segments else 1
+        if segments:
+            self._repair_tail(segments[-1])
+        self._file = open(self._segment_path(self._segment_index), "ab")
+        self._syncer = None
+        if self.fsync_policy != "none":
+            self._syncer = threading.Thread(target=self._sync_loop, name="event-log-fsync", daemon=True)
+            self._syncer.start()
+
+    def _segment_path(self, index: int) -> str:
+        return os.path.join(self.log_dir, f"{self.SEGMENT_PREFIX}{index:08d}{self.SEGMENT_SUFFIX}")
+
+    def _index_of(self, segment_path: str) -> int:
+        name = os.path.basename(segment_path)
+        return int(name[len(self.SEGMENT_PREFIX):-len(self.SEGMENT_SUFFIX)])
+
+    def _repair_tail(self, segment_path: str):
+        """Truncates a torn last line left by a crash, so new records start on a fresh line."""
+        with open(segment_path, "r+b") as f:
+            size = f.seek(0, os.SEEK_END)
+            if size == 0:
+                return
+            f.seek(size - 1)
+            if f.read(1) == b"\n":
+                return
+            # Walk back to the last complete line.
+            position = size
+            while position > 0:
+                step = min(65536, position)
+                f.seek(position - step)
+                chunk = f.read(step)
+                newline = chunk.rfind(b"\n")
+                if newline != -1:
+                    position = position - step + newline + 1
+                    break
+                position -= step
+            f.truncate(max(position, 0))
+            print(f"Truncated a torn record at the end of {segment_path}.")
+
+    def segments(self) -> list[str]:
+        """Returns the paths of every segment, oldest first."""
+        names = sorted(
+            name for name in os.listdir(self.log_dir)
+            if name.startswith(self.SEGMENT_PREFIX) and name.endswith(self.SEGMENT_SUFFIX)
+        )
+        return [os.path.join(self.log_dir, name) for name in names]
+
+    def append(self, record: dict, wait: bool = True) -> int:
+        """
+        Appends a record and returns its sequence number. With the "always" policy,
+        blocks until the record is on disk, unless `wait` is False (see wait_durable()).
+        """
+        line = (json.dumps(record, separators=(",", ":")) + "\n").encode("utf-8")
+        with self._cond:
+            if self._closed:
+                raise ValueError("Event log is closed.")
+            if self._file.tell() + len(line) > self.segment_max_bytes and self._file.tell() > 0:
+                self._roll()
+            self._file.write(line)
+            self._appended += 1
+            sequence = self._appended
+            if self.fsync_policy == "always":
+                self._cond.notify_all()
+        if wait:
+            self.wait_durable(sequence)
+        return sequence
+
+    def wait_durable(self, sequence: int):
+        """With the "always" policy, blocks until record `sequence` is fsynced."""
+        if self.fsync_policy != "always":
+            return
+        with self._cond:
+            while self._synced < sequence and not self._closed:
+                self._cond.wait()
+
+    def _roll(self):
+        """Closes the active segment and starts the next one. Caller holds the lock."""
+        self._sync_locked()
+        self._file.close()
+        self._segment_index += 1
+        self._file = open(self._segment_path(self._segment_index), "ab")
+
+    def _sync_locked(self):
+        """Flushes and fsyncs the active segment. Caller holds the lock."""
+        if self._synced == self._appended:
+            return
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._synced = self._appended
+        self.fsyncs += 1
+        self._cond.notify_all()
+
+    def _sync_loop(self):
+        with self._cond:
+            while not self._closed:
+                if self.fsync_policy == "always":
+                    while self._synced == self._appended and not self._closed:
+                        self._cond.wait()
+                else:
+                    self._cond.wait(self.fsync_interval)
+                # fsync runs under the lock: appenders queue up behind it and share the next one.
+                self._sync_locked()
+
+    def sync(self):
+        """Forces everything appended so far to disk."""
+        with self._cond:
+            self._sync_locked()
+
+    def roll(self) -> int:
+        """
+        Starts a new segment unless the active one is empty. Returns the index of the
+        active segment: every record appended so far is in a segment before it.
+        """
+        with self._cond:
+            if self._file.tell() > 0:
+                self._roll()
+            return self._segment_index
+
+    def drop_segments(self, before_index: int) -> int:
+        """Deletes the segments older than `before_index` (never the active one). Returns the number deleted."""
+        with self._cond:
+            before_index = min(before_index, self._segment_index)
+        dropped = 0
+        for segment_path in self.segments():
+            if self._index_of(segment_path) < before_index:
+                os.remove(segment_path)
+                dropped += 1
+        return dropped
+
+    def replay(self, start_index: int = 0):
+        """
+        Yields every record from segment `start_index` on, oldest first.
+        A torn last line (crash mid-write) is skipped.
+        """
+        with self._cond:
+            self._file.flush()
+        for segment_path in self.segments():
+            if self._index_of(segment_path) < start_index:
+                continue
+            with open(segment_path, "rb") as f:
+                for line in f:
+                    try:
+                        yield json.loads(line)
+                    except json.JSONDecodeError:
+                        print(f"Skipping a corrupt record in {segment_path}.")
+
+    def close(self):
+        with self._cond:
+            if self._closed:
+                return
+            self._sync_locked()
+            self._closed = True
+            self._cond.notify_all()
+        if self._syncer and self._syncer is not threading.current_thread():
+            self._syncer.join(timeout=5)
+        self._file.close()
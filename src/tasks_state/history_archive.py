@@ -0,0 +1,301 @@
+# src/tasks_state/history_archive.py
+
+import datetime
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+from src.core.blob_store import BlobStore
+
+try:
+    import zstandard
+except ImportError:  # optional dependency
+    zstandard = None
+
+class HistoryArchive:
+    """
+    Immutable segment files holding finalized task states, with an offset index.
+    Each segment is a sequence of records (one JSON document per task, zstd-compressed
+    one by one when `compression` is "zstd") and is never modified after it is written.
+    A SQLite index maps each task_id to (segment, offset, length), so reading an archived
+    task is one index lookup and one positioned read. Expired tasks are dropped from
+    the index, and a segment file is deleted once none of its tasks is left. The index
+    also records the blobs each archived task references, so the blobs of expired tasks
+    can be released once no archived task references them any more.
+    """
+    SEGMENT_PREFIX = "segment-"
+    SEGMENT_SUFFIX = ".seg"
+
+    def __init__(self, archive_dir: str = "src/tasks_history/archive", compression: str = "none", compression_level: int = 3):
+        if compression == "zstd" and zstandard is None:
+            print("Warning: zstandard is not installed. Archiving task history uncompressed.")
+            compression = "none"
+        self.archive_dir = archive_dir
+        self.compression = compression
+        self.compression_level = compression_level
+        os.makedirs(self.archive_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(os.path.join(archive_dir, "index.db"), isolation_level=None, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            """CREATE TABLE IF NOT EXISTS archive_index (
+                task_id TEXT PRIMARY KEY,
+                segment TEXT NOT NULL,
+                offset INTEGER NOT NULL,
+                length INTEGER NOT NULL,
+                codec TEXT NOT NULL,
+                status TEXT,
+                finalized_at TEXT,
+                archived_at TEXT NOT NULL
+            )"""
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS idx_archive_segment ON archive_index(segment)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS idx_archive_status_finalized ON archive_index(status, finalized_at)")
+        self._db.execute(
+            """CREATE TABLE IF NOT EXISTS archive_blobs (
+                digest TEXT NOT NULL,
+                task_id TEXT NOT NULL,
+                PRIMARY KEY (digest, task_id)
+            )"""
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS idx_archive_blobs_task ON archive_blobs(task_id)")
+
+    def _encode(self, task_data: dict) -> bytes:
+        data = json.dumps(task_data, separators=(",", ":")).encode("utf-8")
+        if self.compression == "zstd":
+            return zstandard.ZstdCompressor(level=self.compression_level).compress(data)
+        return data
+
+    @staticmethod
+    def _decode(data: bytes, codec: str) -> dict:
+        if codec == "zstd":
+            if zstandard is None:
+                raise RuntimeError("zstandard is required to read zstd-compressed history segments.")
+            data = zstandard.ZstdDecompressor().decompress(data)
+        return json.loads(data)
+
+    def _next_segment_name(self) -> str:
+        return f"{self.SEGMENT_PREFIX}{time.time_ns()}{self.SEGMENT_SUFFIX}"
+
+    def contains(self, task_id: str) -> bool:
+        with self._lock:
+            return self._db.execute("SELECT 1 FROM archive_index WHERE task_id = ?", (task_id,)).fetchone() is not None
+
+    def get(self, task_id: str) -> dict | None:
+        """Returns an archived task state, or None if it is not archived."""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT segment, offset, length, codec FROM archive_index WHERE task_id = ?", (task_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        segment, offset, length, codec = row
+        try:
+            fd = os.open(os.path.join(self.archive_dir, segment), os.O_RDONLY)
+            try:
+                data = os.pread(fd, length, offset)
+            finally:
+                os.close(fd)
+            return self._decode(data, codec)
+        except (OSError, ValueError, RuntimeError) as e:
+            print(f"Error reading archived task {task_id} from {segment}: {e}")
+            return None
+
+    def write_segment(self, tasks: list[dict]) -> int:
+        """
+        Writes the given finalized task states to a new segment and indexes them.
+        The segment is fully on disk before the index points at it. Returns the number archived.
+        """
+        if not tasks:
+            return 0
+        segment = self._next_segment_name()
+        rows, blob_rows, offset = [], [], 0
+        archived_at = datetime.datetime.now().isoformat()
+        fd, tmp_path = tempfile.mkstemp(dir=self.archive_dir, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                for task_data in tasks:
+                    record = self._encode(task_data)
+                    f.write(record)
+                    history = task_data.get("history") or [{}]
+                    rows.append((
+                        task_data["task_id"], segment, offset, len(record), self.compression,
+                        task_data.get("status"), history[-1].get("timestamp"), archived_at,
+                    ))
+                    blob_rows.extend((digest, task_data["task_id"]) for digest in BlobStore.digests_in(task_data))
+                    offset += len(record)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, os.path.join(self.archive_dir, segment))
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            self._db.executemany("INSERT OR REPLACE INTO archive_index VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            self._db.executemany("INSERT OR IGNORE INTO archive_blobs VALUES (?, ?)", blob_rows)
+            self._db.execute("COMMIT")
+        return len(rows)
+
+    def expire(self, retention_days: dict) -> list[str]:
+        """
+        Drops tasks finalized longer ago than their status' retention (`retention_days`
+        maps a status, or "default", to a number of days; missing or null means keep forever)
+        and deletes segments left without tasks. Returns the ids of the tasks dropped.
+        """
+        now = datetime.datetime.now()
+        expired = []
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            statuses = [row[0] for row in self._db.execute("SELECT DISTINCT status FROM archive_index")]
+            for status in statuses:
+                days = retention_days.get(status, retention_days.get("default"))
+                if days is None:
+                    continue
+                cutoff = (now - datetime.timedelta(days=days)).isoformat()
+                expired.extend(row[0] for row in self._db.execute(
+                    "SELECT task_id FROM archive_index WHERE status IS ? AND finalized_at < ?", (status, cutoff)
+                ))
+                self._db.execute("DELETE FROM archive_index WHERE status IS ? AND finalized_at < ?", (status, cutoff))
+            live_segments = {row[0] for row in self._db.execute("SELECT DISTINCT segment FROM archive_index")}
+            self._db.execute("COMMIT")
+        for name in os.listdir(self.archive_dir):
+            if name.startswith(self.SEGMENT_PREFIX) and name.endswith(self.SEGMENT_SUFFIX) and name not in live_segments:
+                os.remove(os.path.join(self.archive_dir, name))
+        return expired
+
+    def release_blobs(self, task_ids: list[str]) -> list[str]:
+        """
+        Forgets the blob references of the given (expired) tasks. Returns the digests
+        that no archived task references any more.
+        """
+        released = []
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            for start in range(0, len(task_ids), 500):
+                chunk = task_ids[start:start + 500]
+                placeholders = ",".join("?" * len(chunk))
+                digests = [row[0] for row in self._db.execute(
+                    f"SELECT DISTINCT digest FROM archive_blobs WHERE task_id IN ({placeholders})", chunk
+                )]
+                self._db.execute(f"DELETE FROM archive_blobs WHERE task_id IN ({placeholders})", chunk)
+                released.extend(
+                    digest for digest in digests
+                    if self._db.execute("SELECT 1 FROM archive_blobs WHERE digest = ?", (digest,)).fetchone() is None
+                )
+            self._db.execute("COMMIT")
+        return released
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+class HistoryCompactor:
+    """
+    Background thread that moves finalized task files out of the flat history
+    directory of a JsonFileTaskStorage into HistoryArchive segments, `batch_size`
+    tasks per segment, and applies the retention policy. Files younger than
+    `min_age` seconds are left alone so recent tasks are still read from their file.
+    Files are read under their task's stripe lock, and a file is only removed (under
+    the lock again) if no writer replaced it after it was read; a replaced file stays
+    and is archived again on a later pass. `on_expired`, if set, is called with the ids
+    of the tasks the retention policy dropped (TaskStateManager removes them from the task index).
+    With a `blob_store`, the blobs of dropped tasks are deleted too, unless an archived
+    task still references them or a task stored them again within the shortest retention.
+    """
+    def __init__(self, storage, archive: HistoryArchive, interval: float = 60.0, batch_size: int = 1000,
+                 min_age: float = 60.0, retention_days: dict = None):
+        self.storage = storage
+        self.archive = archive
+        self.interval = interval
+        self.batch_size = max(1, batch_size)
+        self.min_age = min_age
+        self.retention_days = retention_days or {}
+        self.on_expired = None
+        self.blob_store = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="history-compactor", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    @staticmethod
+    def _identity(stat: os.stat_result) -> tuple:
+        """Files are replaced by rename, so a rewritten file has a new inode."""
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    def compact_once(self) -> int:
+        """Packs every eligible history file into segments. Returns the number of tasks archived."""
+        cutoff = time.time() - self.min_age
+        batch, archived = [], 0
+        with os.scandir(self.storage.history_dir) as entries:
+            paths = [
+                entry.path for entry in entries
+                if entry.name.endswith(".json") and not entry.name.startswith(".")
+                and entry.is_file() and entry.stat().st_mtime < cutoff
+            ]
+        for path in paths:
+            task_id = os.path.basename(path)[:-len(".json")]
+            with self.storage._task_lock(task_id):
+                try:
+                    identity = self._identity(os.stat(path))
+                    task_data = self.storage._read_state_file(path)
+                except FileNotFoundError:
+                    continue
+            if task_data is None or task_data.get("task_id") != task_id:
+                continue
+            batch.append((path, identity, task_data))
+            if len(batch) >= self.batch_size:
+                archived += self._archive_batch(batch)
+                batch = []
+        archived += self._archive_batch(batch)
+        return archived
+
+    def _archive_batch(self, batch: list[tuple[str, tuple, dict]]) -> int:
+        if not batch:
+            return 0
+        archived = self.archive.write_segment([task_data for _, _, task_data in batch])
+        # Only removed once the index points at the segment, so a task is always readable.
+        for path, identity, task_data in batch:
+            with self.storage._task_lock(task_data["task_id"]):
+                try:
+                    if self._identity(os.stat(path)) == identity:
+                        os.remove(path)
+                except FileNotFoundError:
+                    pass
+        return archived
+
+    def release_blobs(self, task_ids: list[str]) -> int:
+        """Deletes the blobs only the given expired tasks referenced. Returns the number deleted."""
+        if self.blob_store is None:
+            return 0
+        digests = self.archive.release_blobs(task_ids)
+        windows = [days for days in self.retention_days.values() if days is not None]
+        if not digests or not windows:
+            return 0
+        # A live task may share a blob (identical content); storing it refreshed the blob's mtime.
+        stored_before = time.time() - min(windows) * 86400
+        return sum(self.blob_store.delete(digest, stored_before) for digest in digests)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                archived = self.compact_once()
+                expired = self.archive.expire(self.retention_days)
+                if expired and self.on_expired:
+                    self.on_expired(expired)
+                deleted = self.release_blobs(expired) if expired else 0
+                if archived or expired:
+                    print(f"History compaction: archived {archived} task(s), expired {len(expired)}, deleted {deleted} blob(s).")
+            except Exception as e:
+                print(f"Error compacting task history: {e}")
+
+    def close(self):
+        self._stop.set()
+        if self._thread.is_alive() and self._thread is not threading.current_thread():
+            self._thread.join(timeout=30)
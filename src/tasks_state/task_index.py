@@ -0,0 +1,258 @@
+# src/tasks_state/task_index.py
+
+import base64
+import json
+import os
+import sqlite3
+import threading
+
+class TaskIndex:
+    """
+    Secondary index over task states for listing and counting, kept in its own
+    SQLite database (WAL mode). TaskStateManager updates it on every transition,
+    so queries never touch the task states themselves.
+    Listing uses keyset (cursor) pagination on (created_at, task_id), newest first,
+    and every filter combination is served by a composite index, so a page costs
+    the same at the first task as at the millionth. Per-status totals are kept in
+    a counter table updated in the same transaction.
+    """
+    SCHEMA = [
+        """CREATE TABLE IF NOT EXISTS task_index (
+            task_id TEXT PRIMARY KEY,
+            status TEXT NOT NULL,
+            role TEXT,
+            profile TEXT,
+            created_at TEXT NOT NULL,
+            updated_at TEXT NOT NULL,
+            finalized_at TEXT
+        )""",
+        """CREATE TABLE IF NOT EXISTS task_status_counts (
+            status TEXT PRIMARY KEY,
+            count INTEGER NOT NULL
+        )""",
+        "CREATE INDEX IF NOT EXISTS idx_task_index_created ON task_index(created_at, task_id)",
+        "CREATE INDEX IF NOT EXISTS idx_task_index_status ON task_index(status, created_at, task_id)",
+        "CREATE INDEX IF NOT EXISTS idx_task_index_role ON task_index(role, created_at, task_id)",
+        "CREATE INDEX IF NOT EXISTS idx_task_index_profile ON task_index(profile, created_at, task_id)",
+        "DROP INDEX IF EXISTS idx_task_index_updated",
+        "CREATE INDEX IF NOT EXISTS idx_task_index_stale ON task_index(status, updated_at, task_id)",
+    ]
+    COLUMNS = ("task_id", "status", "role", "profile", "created_at", "updated_at", "finalized_at")
+    # Ids per statement in bulk operations, well below SQLite's host parameter limit.
+    CHUNK_SIZE = 500
+
+    def __init__(self, db_path: str = "src/tasks_state/task_index.db"):
+        self.db_path = db_path
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+        if os.path.dirname(self.db_path):
+            os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+        connection = self._connection()
+        for statement in self.SCHEMA:
+            connection.execute(statement)
+
+    def _connection(self) -> sqlite3.Connection:
+        """Returns this thread's connection, opening it on first use."""
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.db_path, timeout=30, isolation_level=None, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+            with self._connections_lock:
+                self._connections.append(connection)
+        return connection
+
+    def _bump(self, connection: sqlite3.Connection, status: str, delta: int):
+        connection.execute(
+            "INSERT INTO task_status_counts (status, count) VALUES (?, ?) "
+            "ON CONFLICT(status) DO UPDATE SET count = count + excluded.count",
+            (status, delta),
+        )
+
+    def record(self, task_id: str, timestamp: str, status: str = None, role: str = None, profile: str = None, final: bool = False):
+        """
+        Records a transition: inserts the task on first sight, otherwise updates the given
+        fields (None leaves a field unchanged). `final` marks the task as finalized.
+        """
+        connection = self._connection()
+        try:
+            connection.execute("BEGIN IMMEDIATE")
+            row = connection.execute("SELECT status FROM task_index WHERE task_id = ?", (task_id,)).fetchone()
+            if row is None:
+                status = status or "Pending"
+                connection.execute(
+                    "INSERT INTO task_index (task_id, status, role, profile, created_at, updated_at, finalized_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (task_id, status, role, profile, timestamp, timestamp, timestamp if final else None),
+                )
+                self._bump(connection, status, 1)
+            else:
+                connection.execute(
+                    "UPDATE task_index SET status = COALESCE(?, status), role = COALESCE(?, role), "
+                    "profile = COALESCE(?, profile), updated_at = ?, finalized_at = CASE WHEN ? THEN ? ELSE finalized_at END "
+                    "WHERE task_id = ?",
+                    (status, role, profile, timestamp, final, timestamp, task_id),
+                )
+                if status and status != row[0]:
+                    self._bump(connection, row[0], -1)
+                    self._bump(connection, status, 1)
+            connection.execute("COMMIT")
+        except sqlite3.Error as e:
+            connection.execute("ROLLBACK")
+            print(f"Error updating the task index for {task_id}: {e}")
+
+    @staticmethod
+    def encode_cursor(created_at: str, task_id: str) -> str:
+        return base64.urlsafe_b64encode(json.dumps([created_at, task_id]).encode("utf-8")).decode("ascii")
+
+    @staticmethod
+    def decode_cursor(cursor: str) -> tuple[str, str]:
+        """Raises ValueError for a malformed cursor."""
+        try:
+            created_at, task_id = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+            return str(created_at), str(task_id)
+        except Exception as e:
+            raise ValueError(f"Invalid cursor: {cursor}") from e
+
+    def _where(self, status: str = None, role: str = None, profile: str = None,
+               created_after: str = None, created_before: str = None) -> tuple[list[str], list]:
+        clauses, params = [], []
+        for column, value in (("status", status), ("role", role), ("profile", profile)):
+            if value is not None:
+                clauses.append(f"{column} = ?")
+                params.append(value)
+        if created_after is not None:
+            clauses.append("created_at >= ?")
+            params.append(created_after)
+        if created_before is not None:
+            clauses.append("created_at < ?")
+            params.append(created_before)
+        return clauses, params
+
+    def query(self, status: str = None, role: str = None, profile: str = None, created_after: str = None,
+              created_before: str = None, limit: int = 50, cursor: str = None) -> tuple[list[dict], str | None]:
+        """
+        Returns (tasks, next_cursor): up to `limit` index rows matching every given filter,
+        newest first, starting after `cursor`. next_cursor is None on the last page.
+        """
+        clauses, params = self._where(status, role, profile, created_after, created_before)
+        if cursor:
+            cursor_created_at, cursor_task_id = self.decode_cursor(cursor)
+            clauses.append("(created_at, task_id) < (?, ?)")
+            params.extend([cursor_created_at, cursor_task_id])
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        rows = self._connection().execute(
+            f"SELECT {', '.join(self.COLUMNS)} FROM task_index {where} "
+            "ORDER BY created_at DESC, task_id DESC LIMIT ?",
+            params + [limit + 1],
+        ).fetchall()
+        tasks = [dict(zip(self.COLUMNS, row)) for row in rows[:limit]]
+        next_cursor = None
+        if len(rows) > limit:
+            next_cursor = self.encode_cursor(tasks[-1]["created_at"], tasks[-1]["task_id"])
+        return tasks, next_cursor
+
+    def count(self, status: str = None, role: str = None, profile: str = None,
+              created_after: str = None, created_before: str = None) -> int:
+        """Returns the number of tasks matching every given filter."""
+        if not any([role, profile, created_after, created_before]):
+            # Served by the counter table instead of scanning the index.
+            if status is None:
+                row = self._connection().execute("SELECT COALESCE(SUM(count), 0) FROM task_status_counts").fetchone()
+            else:
+                row = self._connection().execute(
+                    "SELECT COALESCE(SUM(count), 0) FROM task_status_counts WHERE status = ?", (status,)
+                ).fetchone()
+            return row[0]
+        clauses, params = self._where(status, role, profile, created_after, created_before)
+        return self._connection().execute(
+            f"SELECT COUNT(*) FROM task_index WHERE {' AND '.join(clauses)}", params
+        ).fetchone()[0]
+
+    def status_counts(self) -> dict[str, int]:
+        """Returns the number of tasks in each status."""
+        return {
+            status: count
+            for status, count in self._connection().execute("SELECT status, count FROM task_status_counts WHERE count > 0")
+        }
+
+    def touch(self, task_ids: list[str], timestamp: str) -> set[str]:
+        """
+        Sets updated_at of the given unfinalized tasks to `timestamp` (a heartbeat) in
+        one transaction, `CHUNK_SIZE` ids per statement. Returns the ids that are still unfinalized.
+        """
+        if not task_ids:
+            return set()
+        connection = self._connection()
+        live = set()
+        try:
+            connection.execute("BEGIN IMMEDIATE")
+            for start in range(0, len(task_ids), self.CHUNK_SIZE):
+                chunk = task_ids[start:start + self.CHUNK_SIZE]
+                placeholders = ", ".join("?" * len(chunk))
+                connection.execute(
+                    f"UPDATE task_index SET updated_at = ? WHERE task_id IN ({placeholders}) AND finalized_at IS NULL",
+                    [timestamp, *chunk],
+                )
+                live.update(
+                    row[0] for row in connection.execute(
+                        f"SELECT task_id FROM task_index WHERE task_id IN ({placeholders}) AND finalized_at IS NULL", chunk
+                    )
+                )
+            connection.execute("COMMIT")
+            return live
+        except sqlite3.Error as e:
+            connection.execute("ROLLBACK")
+            print(f"Error recording task heartbeats: {e}")
+            return set(task_ids)
+
+    def remove(self, task_ids: list[str]) -> int:
+        """Deletes tasks from the index (e.g. expired from the history archive). Returns the number deleted."""
+        connection = self._connection()
+        removed = 0
+        try:
+            connection.execute("BEGIN IMMEDIATE")
+            for start in range(0, len(task_ids), self.CHUNK_SIZE):
+                chunk = task_ids[start:start + self.CHUNK_SIZE]
+                placeholders = ", ".join("?" * len(chunk))
+                for status, count in connection.execute(
+                    f"SELECT status, COUNT(*) FROM task_index WHERE task_id IN ({placeholders}) GROUP BY status", chunk
+                ).fetchall():
+                    self._bump(connection, status, -count)
+                removed += connection.execute(f"DELETE FROM task_index WHERE task_id IN ({placeholders})", chunk).rowcount
+            connection.execute("COMMIT")
+            return removed
+        except sqlite3.Error as e:
+            connection.execute("ROLLBACK")
+            print(f"Error removing tasks from the task index: {e}")
+            return 0
+
+    def stale(self, statuses: list[str], updated_before: str, limit: int = 500, after: tuple[str, str] = None) -> list[dict]:
+        """
+        Returns up to `limit` unfinalized tasks in one of `statuses` whose last transition
+        or heartbeat is older than `updated_before`, oldest first (by updated_at, then
+        task_id), starting after the (updated_at, task_id) keyset cursor `after`.
+        Served by the (status, updated_at, task_id) index.
+        """
+        placeholders = ", ".join("?" * len(statuses))
+        params = [*statuses, updated_before]
+        keyset = ""
+        if after is not None:
+            keyset = "AND (updated_at, task_id) > (?, ?) "
+            params.extend(after)
+        rows = self._connection().execute(
+            f"SELECT {', '.join(self.COLUMNS)} FROM task_index "
+            f"WHERE status IN ({placeholders}) AND updated_at < ? AND finalized_at IS NULL {keyset}"
+            "ORDER BY updated_at, task_id LIMIT ?",
+            [*params, limit],
+        ).fetchall()
+        return [dict(zip(self.COLUMNS, row)) for row in rows]
+
+    def close(self):
+        with self._connections_lock:
+            for connection in self._connections:
+                connection.close()
+            self._connections = []
+        self._local = threading.local()
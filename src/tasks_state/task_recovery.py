@@ -0,0 +1,116 @@
+# src/tasks_state/task_recovery.py
+
+import datetime
+import threading
+import time
+
+RECOVERY_POLICIES = ("requeue", "fail")
+# In-progress statuses: a task in one of them is being run by some node.
+DEFAULT_RECOVERY_STATUSES = ("Received", "Processing", "Executing by Agent")
+
+class TaskRecovery:
+    """
+    Finds tasks left in an in-progress status by a process that died and either
+    requeues them to the inbound queue or fails them (`policy`).
+    Live tasks are heartbeated in the task index every `heartbeat_interval` seconds
+    (TaskStateManager.heartbeat()), so a task is orphaned once neither a transition
+    nor a heartbeat has touched it for `stale_after` seconds. Orphans are found with
+    (status, updated_at) index queries, `batch_size` at a time, paging with a keyset
+    cursor so orphans that cannot be recovered now (leased elsewhere) do not hide the
+    ones after them; the directory or table of task states is never scanned.
+    The first pass runs right after start(). With `recover_all_on_startup`, it takes
+    every in-progress task last touched before this process started, not only stale
+    ones. Without task leases that is only right for a single orchestrator; with them,
+    a task is only taken over once its lease expired (or was left by this node's
+    previous run), so the recovering node holds the lease while it requeues or fails it.
+    A task requeued `max_requeues` times, or that cannot be published again, is failed
+    instead. "Requeued" is not an in-progress status: the task is waiting in the queue.
+    """
+    def __init__(self, task_state_manager, requeue, policy: str = "requeue", statuses: list[str] = None,
+                 stale_after: float = 120.0, heartbeat_interval: float = 15.0, interval: float = 30.0,
+                 batch_size: int = 500, max_requeues: int = 3, recover_all_on_startup: bool = True):
+        if policy not in RECOVERY_POLICIES:
+            print(f"Warning: Unknown task recovery policy '{policy}'. Using 'requeue'.")
+            policy = "requeue"
+        self.task_state_manager = task_state_manager
+        self.requeue = requeue  # callable(task_data, attempts) -> bool, publishes the task again
+        self.policy = policy
+        self.statuses = list(statuses or DEFAULT_RECOVERY_STATUSES)
+        self.stale_after = stale_after
+        self.heartbeat_interval = heartbeat_interval
+        self.interval = interval
+        self.batch_size = max(1, batch_size)
+        self.max_requeues = max_requeues
+        self.recover_all_on_startup = recover_all_on_startup
+        self.started_at = datetime.datetime.now()
+        self.requeued = 0
+        self.failed = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="task-recovery", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def _cutoff(self, startup: bool = False) -> str:
+        cutoff = datetime.datetime.now() - datetime.timedelta(seconds=self.stale_after)
+        if startup and self.recover_all_on_startup:
+            cutoff = max(cutoff, self.started_at)
+        return cutoff.isoformat()
+
+    def recover_once(self, startup: bool = False) -> tuple[int, int]:
+        """Recovers every orphaned task found now. Returns (requeued, failed)."""
+        cutoff = self._cutoff(startup)
+        requeued = failed = 0
+        after = None
+        while not self._stop.is_set():
+            orphans, after = self.task_state_manager.find_orphans(self.statuses, cutoff, self.batch_size, after=after)
+            for row in orphans:
+                outcome = self._recover(row)
+                requeued += outcome == "requeued"
+                failed += outcome == "failed"
+            if after is None:
+                break
+        self.requeued += requeued
+        self.failed += failed
+        return requeued, failed
+
+    def _recover(self, row: dict) -> str | None:
+        task_id = row["task_id"]
+        task_data = self.task_state_manager.get_task_state(task_id)
+        if task_data is None or task_data["status"] not in self.statuses:
+            return None
+        if not self.task_state_manager.acquire_lease(task_id):
+            return None  # Another node holds the task and is still renewing its lease.
+        attempts = (task_data.get("payload") or {}).get("recovery_attempts", 0) + 1
+        reason = f"Task orphaned in status '{row['status']}' (no heartbeat since {row['updated_at']})."
+        if self.policy == "fail" or attempts > self.max_requeues:
+            if self.policy == "requeue":
+                reason += f" Gave up after {self.max_requeues} requeue(s)."
+            self.task_state_manager.fail_task(task_id, error_message=reason)
+            return "failed"
+        previous = self.task_state_manager.mark_requeued(task_id, self.statuses, attempts)
+        if previous is None:
+            return None
+        if not self.requeue(previous, attempts):
+            self.task_state_manager.fail_task(task_id, error_message=f"{reason} Could not be requeued.")
+            return "failed"
+        return "requeued"
+
+    def _run(self):
+        last_recovery = None
+        while not self._stop.is_set():
+            try:
+                self.task_state_manager.heartbeat()
+                if last_recovery is None or time.monotonic() - last_recovery >= self.interval:
+                    requeued, failed = self.recover_once(startup=last_recovery is None)
+                    last_recovery = time.monotonic()
+                    if requeued or failed:
+                        print(f"Task recovery: requeued {requeued} orphaned task(s), failed {failed}.")
+            except Exception as e:
+                print(f"Error recovering orphaned tasks: {e}")
+            self._stop.wait(min(self.heartbeat_interval, self.interval))
+
+    def close(self):
+        self._stop.set()
+        if self._thread.is_alive() and self._thread is not threading.current_thread():
+            self._thread.join(timeout=30)
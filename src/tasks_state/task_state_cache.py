@@ -0,0 +1,279 @@
+# src/tasks_state/task_state_cache.py
+
+import copy
+import threading
+from collections import OrderedDict
+
+from src.tasks_state.task_storage import TaskStorage, check_version
+
+DURABILITY_LEVELS = ("write_through", "finalize", "interval")
+
+class _PendingWrites:
+    """The coalesced, not yet persisted changes of one task."""
+    def __init__(self):
+        self.created = None       # full task state, if the task was created since the last flush
+        self.status = None
+        self.payload = {}
+        self.history = []
+        self.final = None         # (status, fields, entry)
+        self.post_final_history = []
+        self.version = None       # version of the task after these changes
+
+class CachedTaskStorage(TaskStorage):
+    """
+    Write-back, in-memory task table in front of a persistent TaskStorage.
+    Reads are served from memory (tasks are loaded from the backing store on a miss).
+    Writes update the in-memory state and are coalesced per task: a task created,
+    updated and given three history events between two flushes costs one create,
+    one update and one batched history insert in the backing store.
+    `durability` sets when pending writes are persisted:
+    - "write_through": immediately, the cache only serves reads.
+    - "finalize": every `flush_interval` seconds, and synchronously when a task is finalized.
+    - "interval": only every `flush_interval` seconds (and on close).
+    With the last two, a crash loses at most `flush_interval` seconds of non-final updates.
+    Changes the backing store fails to take stay pending (ahead of newer ones) and are
+    retried on the next flush; a task with pending changes is never evicted.
+    Versions are checked and incremented in memory, and written to the backing store
+    with the flushed changes, so compare-and-swap only spans this process.
+    """
+    def __init__(self, backing: TaskStorage, flush_interval: float = 0.5, durability: str = "finalize", max_entries: int = 10000):
+        if durability not in DURABILITY_LEVELS:
+            print(f"Warning: Unknown task state durability '{durability}'. Using 'finalize'.")
+            durability = "finalize"
+        self.backing = backing
+        self.flush_interval = flush_interval
+        self.durability = durability
+        self.max_entries = max_entries
+        self._tasks = OrderedDict()   # task_id -> task state, in LRU order
+        self._pending = {}            # task_id -> _PendingWrites
+        self._in_flight = {}          # task_id -> _PendingWrites being flushed
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._flusher = None
+        if self.durability != "write_through":
+            self._flusher = threading.Thread(target=self._flush_loop, name="task-state-flusher", daemon=True)
+            self._flusher.start()
+
+    def _cache(self, task_id: str, task_data: dict):
+        """Stores a task in memory, evicting the least recently used clean tasks. Caller holds the lock."""
+        self._tasks[task_id] = task_data
+        self._tasks.move_to_end(task_id)
+        while len(self._tasks) > self.max_entries:
+            evicted = next(
+                (cached_id for cached_id in self._tasks if cached_id not in self._pending and cached_id not in self._in_flight),
+                None,
+            )
+            if evicted is None:
+                break
+            del self._tasks[evicted]
+
+    def _pending_for(self, task_id: str) -> _PendingWrites:
+        """Caller holds the lock."""
+        pending = self._pending.get(task_id)
+        if pending is None:
+            pending = self._pending[task_id] = _PendingWrites()
+        return pending
+
+    def _load(self, task_id: str) -> dict | None:
+        """Returns the cached task, loading it from the backing store on a miss. Caller holds the lock."""
+        task_data = self._tasks.get(task_id)
+        if task_data is not None:
+            self._tasks.move_to_end(task_id)
+            return task_data
+        task_data = self.backing.get_task(task_id)
+        if task_data is not None:
+            self._cache(task_id, task_data)
+        return task_data
+
+    def create_task(self, task_data: dict) -> bool:
+        task_id = task_data["task_id"]
+        with self._lock:
+            self._cache(task_id, copy.deepcopy(task_data))
+            # A re-created task replaces whatever was pending for it.
+            self._pending[task_id] = _PendingWrites()
+            self._pending[task_id].created = copy.deepcopy(task_data)
+        if self.durability == "write_through":
+            return self.flush_task(task_id)
+        return True
+
+    def get_task(self, task_id: str) -> dict | None:
+        with self._lock:
+            task_data = self._load(task_id)
+            return copy.deepcopy(task_data) if task_data is not None else None
+
+    def _bump_version(self, task_data: dict, pending: _PendingWrites):
+        """Caller holds the lock."""
+        task_data["version"] = task_data.get("version", 0) + 1
+        pending.version = task_data["version"]
+
+    def update_task(self, task_id: str, status: str = None, payload: dict = None,
+                    expected_version: int = None, version: int = None) -> bool:
+        with self._lock:
+            task_data = self._load(task_id)
+            if task_data is None:
+                return False
+            check_version(task_id, task_data.get("version", 0), expected_version)
+            pending = self._pending_for(task_id)
+            self._bump_version(task_data, pending)
+            if status:
+                task_data["status"] = status
+                pending.status = status
+            if payload:
+                task_data["payload"].update(payload)
+                pending.payload.update(payload)
+        if self.durability == "write_through":
+            return self.flush_task(task_id)
+        return True
+
+    def add_history(self, task_id: str, entry: dict) -> bool:
+        with self._lock:
+            task_data = self._load(task_id)
+            if task_data is None:
+                return False
+            task_data["history"].append(entry)
+            pending = self._pending_for(task_id)
+            self._bump_version(task_data, pending)
+            (pending.post_final_history if pending.final else pending.history).append(entry)
+        if self.durability == "write_through":
+            return self.flush_task(task_id)
+        return True
+
+    def finalize_task(self, task_id: str, status: str, fields: dict, entry: dict,
+                      expected_version: int = None, version: int = None) -> bool:
+        with self._lock:
+            task_data = self._load(task_id)
+            if task_data is None:
+                return False
+            check_version(task_id, task_data.get("version", 0), expected_version)
+            pending = self._pending_for(task_id)
+            self._bump_version(task_data, pending)
+            task_data["status"] = status
+            task_data.update(fields)
+            task_data["history"].append(entry)
+            pending.final = (status, fields, entry)
+        if self.durability in ("write_through", "finalize"):
+            return self.flush_task(task_id)
+        return True
+
+    def _write(self, task_id: str, pending: _PendingWrites) -> _PendingWrites | None:
+        """
+        Applies one task's coalesced changes to the backing store, in order, stopping at
+        the first write that fails. Returns None once everything is written, or the
+        changes that were not (the failed write and the ones after it).
+        """
+        # The last write sets the cached version, so the backing store ends at the same version;
+        # the ones before it increment it as usual, so every write produces a new version.
+        steps = []
+        if pending.created is not None:
+            steps.append(("created", lambda version: self.backing.create_task(pending.created)))
+        if pending.status or pending.payload:
+            steps.append(("update", lambda version: self.backing.update_task(
+                task_id, status=pending.status, payload=pending.payload or None, version=version)))
+        if pending.history:
+            steps.append(("history", lambda version: self.backing.add_history_batch(task_id, pending.history, version=version)))
+        if pending.final:
+            steps.append(("final", lambda version: self.backing.finalize_task(task_id, *pending.final, version=version)))
+        if pending.post_final_history:
+            steps.append(("post_final_history", lambda version: self.backing.add_history_batch(
+                task_id, pending.post_final_history, version=version)))
+        for index, (step, write) in enumerate(steps):
+            try:
+                written = write(pending.version if index == len(steps) - 1 else None)
+            except Exception as e:
+                print(f"Error writing task {task_id} to {type(self.backing).__name__}: {e}")
+                written = False
+            if not written:
+                print(f"Error flushing cached state of task {task_id} to {type(self.backing).__name__}. Will retry.")
+                return self._unwritten(pending, [name for name, _ in steps[index:]])
+        return None
+
+    @staticmethod
+    def _unwritten(pending: _PendingWrites, steps: list[str]) -> _PendingWrites:
+        """Returns the part of `pending` made of the given write steps."""
+        unwritten = _PendingWrites()
+        unwritten.version = pending.version
+        if "created" in steps:
+            unwritten.created = pending.created
+        if "update" in steps:
+            unwritten.status, unwritten.payload = pending.status, dict(pending.payload)
+        if "history" in steps:
+            unwritten.history = list(pending.history)
+        if "final" in steps:
+            unwritten.final = pending.final
+        if "post_final_history" in steps:
+            unwritten.post_final_history = list(pending.post_final_history)
+        return unwritten
+
+    @staticmethod
+    def _merge(older: _PendingWrites, newer: _PendingWrites) -> _PendingWrites:
+        """Combines unwritten changes with the ones made after them, keeping their order."""
+        if newer.created is not None:
+            return newer  # The task was created again; what came before it is replaced.
+        merged = _PendingWrites()
+        merged.created = older.created
+        merged.status = newer.status or older.status
+        merged.payload = {**older.payload, **newer.payload}
+        merged.version = newer.version or older.version
+        if older.final:
+            # Changes made after a pending finalization are written after it.
+            merged.history = older.history
+            merged.final = newer.final or older.final
+            merged.post_final_history = older.post_final_history + newer.history + newer.post_final_history
+        else:
+            merged.history = older.history + newer.history
+            merged.final = newer.final
+            merged.post_final_history = newer.post_final_history
+        return merged
+
+    def _flush_pending(self, pending: dict) -> int:
+        """
+        Writes the given pending changes. Whatever could not be written is put back in
+        front of the changes made meanwhile, so the next flush retries it.
+        Caller holds the flush lock. Returns the number of tasks that failed.
+        """
+        failed = 0
+        for task_id, task_pending in pending.items():
+            unwritten = self._write(task_id, task_pending)
+            with self._lock:
+                self._in_flight.pop(task_id, None)
+                if unwritten is not None:
+                    failed += 1
+                    newer = self._pending.get(task_id)
+                    self._pending[task_id] = self._merge(unwritten, newer) if newer else unwritten
+        return failed
+
+    def flush_task(self, task_id: str) -> bool:
+        """Persists one task's pending changes now. Returns False if they could not all be written."""
+        with self._flush_lock:
+            with self._lock:
+                pending = self._pending.pop(task_id, None)
+                if pending is None:
+                    return True
+                self._in_flight[task_id] = pending
+            return self._flush_pending({task_id: pending}) == 0
+
+    def flush(self) -> int:
+        """Persists every pending change. Returns the number of tasks written."""
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+                self._in_flight.update(pending)
+            failed = self._flush_pending(pending)
+        if failed:
+            print(f"Could not flush {failed} cached task state(s); they stay pending.")
+        return len(pending) - failed
+
+    def _flush_loop(self):
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Error flushing task state cache: {e}")
+
+    def close(self):
+        self._stop.set()
+        if self._flusher and self._flusher is not threading.current_thread():
+            self._flusher.join(timeout=5)
+        self.flush()
+        self.backing.close()
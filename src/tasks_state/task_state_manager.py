@@ -1,163 +1,500 @@
 # src/tasks_state/task_state_manager.py
 
 import json
-import os
+import socket
+from collections import OrderedDict
+import threading
+import time
 import uuid
 import datetime
-import fcntl # For file locking on Unix-like systems
+
+from src.config.config_loader import config
+from src.core.blob_store import BlobStore
+from src.tasks_state.task_storage import TaskStorage, VersionConflictError, create_task_storage
+from src.tasks_state.task_index import TaskIndex
+from src.tasks_state.task_recovery import DEFAULT_RECOVERY_STATUSES
+
+# A task in one of these statuses never moves to another status.
+TERMINAL_STATUSES = ("Completed", "Failed")
+
+class LeaseLostError(RuntimeError):
+    """Raised when this node writes to a task whose lease another node has taken over."""
+    def __init__(self, task_id: str, token: int, lease: dict):
+        super().__init__(
+            f"Task {task_id} is leased to {lease.get('owner')} (token {lease.get('token')}); "
+            f"this node's token {token} is fenced off."
+        )
+        self.task_id = task_id
 
 class TaskStateManager:
     """
-    Manages the state of tasks, ensuring data integrity through file locking.
-    Each task's state is stored in a separate JSON file.
+    Manages the state of tasks on top of a pluggable storage backend
+    (see `task_state.backend`): one JSON file per task, or an embedded SQLite database.
+    Large values (results, payloads) are kept in the blob store and the task state
+    holds only their reference. When `task_state.index.enabled` is set, every
+    transition also updates a TaskIndex used to list and count tasks.
+    Status changes are compare-and-swap on the task's version: on a conflict the
+    task is re-read and the change re-applied (merged) on top of the newer state,
+    up to `task_state.cas_retries` times. Terminal statuses are never overwritten.
+    Tasks this process moves into one of the in-progress statuses (`task_state.recovery.statuses`)
+    are live until they leave them; heartbeat() refreshes them in the index so
+    TaskRecovery can tell them apart from tasks orphaned by a node that died.
+    With `task_state.leases.enabled`, a node owns the tasks it runs through a lease
+    kept in the task's payload ({"owner", "token", "expires_at"}) and renewed every
+    `task_state.leases.renew_interval` seconds by a thread of its own, whether or not
+    task recovery runs. Acquiring a lease increments its fencing token, and every write this
+    node makes to a task it leased checks owner and token in the same compare-and-swap,
+    so a node whose lease was taken over (it stalled or was partitioned) cannot
+    overwrite the new owner's state.
     """
-    def __init__(self, base_dir="src/tasks_state", history_dir="src/tasks_history"):
+    def __init__(self, base_dir="src/tasks_state", history_dir="src/tasks_history", blob_store: BlobStore = None,
+                 storage: TaskStorage = None, task_index: TaskIndex = None):
         self.base_dir = base_dir
         self.history_dir = history_dir
-        os.makedirs(self.base_dir, exist_ok=True)
-        os.makedirs(self.history_dir, exist_ok=True)
-        print(f"TaskStateManager initialized. State dir: {self.base_dir}, History dir: {self.history_dir}")
+        self.blob_store = blob_store or BlobStore()
+        self.storage = storage or create_task_storage(base_dir, history_dir)
+        self.cas_retries = config.get("task_state", {}).get("cas_retries", 5)
+        index_config = config.get("task_state", {}).get("index", {})
+        self.task_index = task_index
+        if self.task_index is None and index_config.get("enabled", False):
+            self.task_index = TaskIndex(index_config.get("db_path", f"{base_dir}/task_index.db"))
+        compactor = getattr(getattr(self.storage, "backing", self.storage), "compactor", None)
+        if compactor:
+            # Blobs only referenced by tasks the history retention policy dropped are deleted.
+            compactor.blob_store = self.blob_store
+        if compactor and self.task_index:
+            # Tasks dropped by the history retention policy leave the listing too.
+            compactor.on_expired = self.task_index.remove
+        lease_config = config.get("task_state", {}).get("leases", {})
+        self.leases_enabled = lease_config.get("enabled", False)
+        self.lease_ttl = lease_config.get("ttl", 60.0)
+        self.node_id = lease_config.get("node_id") or socket.gethostname()
+        self.lease_renew_interval = lease_config.get("renew_interval") or self.lease_ttl / 3
+        if self.leases_enabled and not self.storage.shared:
+            print(f"Warning: {type(self.storage).__name__} is not shared between processes. "
+                  "Task leases only fence writers inside this process.")
+        self.live_statuses = set(config.get("task_state", {}).get("recovery", {}).get("statuses") or DEFAULT_RECOVERY_STATUSES)
+        self._live_tasks = {}  # task_id -> fencing token of this node's lease (None without leases)
+        self._lost_leases = OrderedDict()  # task_id -> token of a lease taken over by another node
+        self._live_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._lease_renewer = None
+        if self.leases_enabled:
+            self._lease_renewer = threading.Thread(target=self._renew_loop, name="task-lease-renewer", daemon=True)
+            self._lease_renewer.start()
+        print(f"TaskStateManager initialized with {type(self.storage).__name__}. State dir: {self.base_dir}, History dir: {self.history_dir}")
 
     def _get_current_timestamp(self) -> str:
         """Returns the current timestamp in ISO format."""
         return datetime.datetime.now().isoformat()
 
-    def _read_state_file(self, file_path: str) -> dict | None:
-        """Reads and decodes a JSON state file."""
-        try:
-            with open(file_path, 'r') as f:
-                return json.load(f)
-        except (IOError, json.JSONDecodeError) as e:
-            print(f"Error reading task state file {file_path}: {e}")
-            return None
+    def _history_entry(self, event_description: str, payload: dict = None) -> dict:
+        """Builds a history entry, offloading a large payload to the blob store."""
+        history_entry = {"timestamp": self._get_current_timestamp(), "event": event_description}
+        if payload:
+            history_entry["payload"] = self.blob_store.offload(payload)
+        return history_entry
 
-    def _write_state_file(self, file_path: str, data: dict):
-        """Encodes and writes data to a JSON state file with locking."""
-        try:
-            with open(file_path, 'w') as f:
-                fcntl.flock(f, fcntl.LOCK_EX) # Lock the file
-                json.dump(data, f, indent=4)
-                fcntl.flock(f, fcntl.LOCK_UN) # Unlock the file
-            return True
-        except IOError as e:
-            print(f"Error writing task state file {file_path}: {e}")
-            return False
+    def _track(self, task_id: str, status: str = None, token: int = None) -> int | None:
+        """
+        Keeps the live tasks in step with a transition made by this process. Returns the
+        token of a lease that is no longer needed: the task left the in-progress statuses
+        without finishing (e.g. "Planned"), so nothing runs it any more.
+        """
+        with self._live_lock:
+            if status in TERMINAL_STATUSES:
+                self._live_tasks.pop(task_id, None)
+            elif token is not None:
+                self._live_tasks[task_id] = token
+                self._lost_leases.pop(task_id, None)
+            elif status in self.live_statuses:
+                if not self.leases_enabled:
+                    self._live_tasks.setdefault(task_id, None)
+            elif status:
+                return self._live_tasks.pop(task_id, None)
+        return None
+
+    def _lose_lease(self, task_id: str):
+        """Stops treating a task as live, but keeps fencing this node's later writes to it."""
+        with self._live_lock:
+            token = self._live_tasks.pop(task_id, None)
+            if token is not None:
+                self._lost_leases[task_id] = token
+                while len(self._lost_leases) > 10000:
+                    self._lost_leases.popitem(last=False)
+
+    def _new_lease(self, token: int) -> dict:
+        return {"owner": self.node_id, "token": token, "expires_at": time.time() + self.lease_ttl}
+
+    def _fence(self, task_id: str, current: dict):
+        """Raises LeaseLostError if this node leased the task and no longer holds that lease."""
+        with self._live_lock:
+            token = self._live_tasks.get(task_id, self._lost_leases.get(task_id))
+        if token is None:
+            return
+        lease = (current.get("payload") or {}).get("lease") or {}
+        if lease.get("owner") != self.node_id or lease.get("token") != token:
+            raise LeaseLostError(task_id, token, lease)
+
+    def _index(self, task_id: str, timestamp: str, status: str = None, payload: dict = None, final: bool = False):
+        """Records a transition in the task index (role and profile come from the diagnosis analysis)."""
+        if not self.task_index:
+            return
+        analysis = (payload or {}).get("analysis") or {}
+        self.task_index.record(
+            task_id, timestamp, status=status,
+            role=analysis.get("target_role"), profile=analysis.get("target_profile"), final=final,
+        )
 
     def create_task_state(self, prompt: str, initial_status: str = "Pending", initial_payload: dict = None, task_id: str = None) -> str | None:
         """
-        Creates a new task state file. If task_id is not provided, a new one is generated.
+        Creates a new task state. If task_id is not provided, a new one is generated.
         Returns the task_id.
         """
         if task_id is None:
             task_id = str(uuid.uuid4())
-        state_file_path = os.path.join(self.base_dir, f"{task_id}.json")
+        payload = dict(initial_payload) if initial_payload is not None else {}
+        token = None
+        if self.leases_enabled and initial_status not in TERMINAL_STATUSES:
+            token = 1
+            payload["lease"] = self._new_lease(token)
         
         task_data = {
             "task_id": task_id,
             "prompt": prompt,
             "status": initial_status,
-            "payload": initial_payload if initial_payload is not None else {},
-            "history": [{"timestamp": self._get_current_timestamp(), "event": f"Task created: {prompt}"}],
+            "payload": payload,
+            "history": [self._history_entry(f"Task created: {prompt}")],
             "result": None,
-            "error": None
+            "error": None,
+            "version": 1
         }
         
-        if self._write_state_file(state_file_path, task_data):
-            print(f"Task state created: {state_file_path}")
+        if self.storage.create_task(self.blob_store.offload(task_data)):
+            self._index(task_id, task_data["history"][0]["timestamp"], initial_status, task_data["payload"])
+            self._track(task_id, initial_status, token)
+            print(f"Task state created: {task_id}")
             return task_id
         return None
 
     def get_task_state(self, task_id: str) -> dict | None:
         """
-        Retrieves the state of a task by its ID.
+        Retrieves the state of a task (active or finalized) by its ID.
         """
-        state_file_path = os.path.join(self.base_dir, f"{task_id}.json")
-        if os.path.exists(state_file_path):
-            return self._read_state_file(state_file_path)
-        else:
-            # If not found in active tasks, check history
-            return self.get_task_from_history(task_id)
+        task_data = self.storage.get_task(task_id)
+        if task_data is None:
+            print(f"Task not found in active state or history for task ID: {task_id}")
+        return task_data
+
+    def _compare_and_swap(self, task_id: str, write) -> bool | None:
+        """
+        Reads the task and calls write(current_state), which writes with
+        expected_version=current_state["version"]. Retries with a fresh read on a
+        version conflict. Returns write's result, False if this node's lease was lost,
+        or None if the task does not exist or the retries ran out.
+        """
+        for _ in range(self.cas_retries + 1):
+            current = self.storage.get_task(task_id)
+            if current is None:
+                return None
+            try:
+                return write(current)
+            except VersionConflictError as e:
+                print(f"{e} Retrying.")
+            except LeaseLostError as e:
+                print(f"{e} Write rejected.")
+                self._lose_lease(task_id)
+                return False
+        print(f"Giving up on task {task_id} after {self.cas_retries + 1} conflicting writes.")
+        return None
+
+    def resolve(self, value):
+        """
+        Returns a value read from a task state with its blob references replaced by the stored data.
+        Task states keep references, so callers resolve only the fields they need.
+        """
+        return self.blob_store.resolve(value)
 
     def get_task_from_history(self, task_id: str) -> dict | None:
         """
-        Retrieves the state of a completed/failed task from the history directory.
+        Retrieves the state of a completed/failed task.
         """
-        history_file_path = os.path.join(self.history_dir, f"{task_id}.json")
-        if os.path.exists(history_file_path):
-            return self._read_state_file(history_file_path)
-        else:
-            print(f"Task not found in active state or history for task ID: {task_id}")
-            return None
+        task_data = self.get_task_state(task_id)
+        if task_data and task_data.get("status") in TERMINAL_STATUSES:
+            return task_data
+        return None
 
     def update_task_state(self, task_id: str, new_status: str = None, new_payload: dict = None):
         """
         Updates the state of an existing task.
         """
-        state_file_path = os.path.join(self.base_dir, f"{task_id}.json")
-        task_data = self.get_task_state(task_id)
+        payload = self.blob_store.offload(new_payload) if new_payload else None
+        applied_status = []
 
-        if task_data:
-            if new_status:
-                task_data["status"] = new_status
-            if new_payload:
-                task_data["payload"].update(new_payload)
-            
-            if self._write_state_file(state_file_path, task_data):
-                print(f"Task state updated for task ID: {task_id}")
-        else:
-            print(f"Task state file not found for task ID: {task_id}. Cannot update.")
+        def write(current: dict) -> bool:
+            self._fence(task_id, current)
+            status = new_status
+            if status and current["status"] in TERMINAL_STATUSES and status != current["status"]:
+                print(f"Task {task_id} is already {current['status']}. Ignoring status '{status}'.")
+                status = None
+            applied_status[:] = [status]
+            if not status and not payload:
+                return True
+            return self.storage.update_task(task_id, status=status, payload=payload, expected_version=current.get("version", 0))
+
+        updated = self._compare_and_swap(task_id, write)
+        if updated:
+            self._index(task_id, self._get_current_timestamp(), applied_status[0], new_payload)
+            token = self._track(task_id, applied_status[0])
+            if token is not None:
+                self._release_lease(task_id, token)
+            print(f"Task state updated for task ID: {task_id}")
+        elif updated is None:
+            print(f"Task state not found for task ID: {task_id}. Cannot update.")
 
     def add_history(self, task_id: str, event_description: str, payload: dict = None):
         """
         Adds a new event to the task's history.
         """
-        state_file_path = os.path.join(self.base_dir, f"{task_id}.json")
-        task_data = self.get_task_state(task_id)
-
-        if task_data:
-            history_entry = {"timestamp": self._get_current_timestamp(), "event": event_description}
-            if payload:
-                history_entry["payload"] = payload
-            task_data["history"].append(history_entry)
-            
-            if self._write_state_file(state_file_path, task_data):
-                print(f"History added for task ID: {task_id}")
+        if self.storage.add_history(task_id, self._history_entry(event_description, payload)):
+            print(f"History added for task ID: {task_id}")
         else:
-            print(f"Task state file not found for task ID: {task_id}. Cannot add history.")
+            print(f"Task state not found for task ID: {task_id}. Cannot add history.")
 
     def _finalize_task(self, task_id: str, status: str, final_payload: dict):
         """
-        Helper function to finalize a task (complete or fail) and move it to history.
+        Helper function to finalize a task (complete or fail).
         """
-        state_file_path = os.path.join(self.base_dir, f"{task_id}.json")
-        history_file_path = os.path.join(self.history_dir, f"{task_id}.json")
-        
-        task_data = self.get_task_state(task_id)
-        if task_data:
-            task_data["status"] = status
-            task_data.update(final_payload)
-            task_data["history"].append({"timestamp": self._get_current_timestamp(), "event": f"Task finalized with status: {status}"})
-            
-            if self._write_state_file(history_file_path, task_data):
-                os.remove(state_file_path)
-                print(f"Task {task_id} finalized as {status} and moved to history.")
-            else:
-                print(f"Error writing history file for task {task_id}.")
+        entry = self._history_entry(f"Task finalized with status: {status}")
+        fields = self.blob_store.offload(final_payload)
+
+        def write(current: dict) -> bool:
+            self._fence(task_id, current)
+            if current["status"] in TERMINAL_STATUSES:
+                print(f"Task {task_id} is already {current['status']}. Not finalizing it as {status}.")
+                return False
+            return self.storage.finalize_task(task_id, status, fields, entry, expected_version=current.get("version", 0))
+
+        finalized = self._compare_and_swap(task_id, write)
+        if finalized:
+            self._index(task_id, entry["timestamp"], status, final=True)
+            self._track(task_id, status)
+            print(f"Task {task_id} finalized as {status}.")
+        elif finalized is None:
+            print(f"Task state not found for task ID: {task_id}. Cannot finalize.")
         else:
-            print(f"Task state file not found for task ID: {task_id}. Cannot finalize.")
+            with self._live_lock:
+                self._live_tasks.pop(task_id, None)
 
     def complete_task(self, task_id: str, final_result: str = None):
         """
-        Marks a task as completed and moves its state file to the history directory.
+        Marks a task as completed.
         """
         self._finalize_task(task_id, "Completed", {"result": final_result})
 
     def fail_task(self, task_id: str, error_message: str):
         """
-        Marks a task as failed and moves its state file to the history directory.
+        Marks a task as failed.
         """
         self._finalize_task(task_id, "Failed", {"error": error_message})
 
+    def acquire_lease(self, task_id: str) -> bool:
+        """
+        Takes the lease of an unfinished task for this node, with the next fencing token.
+        Fails while another node holds an unexpired lease. A lease still naming this node
+        but not held by this process was left by its previous run and is taken at once.
+        Always succeeds when leases are disabled.
+        """
+        if not self.leases_enabled:
+            return True
+        acquired = []
+
+        def write(current: dict) -> bool:
+            if current["status"] in TERMINAL_STATUSES:
+                return False
+            lease = current["payload"].get("lease") or {}
+            with self._live_lock:
+                held = self._live_tasks.get(task_id)
+            if held is not None and lease.get("owner") == self.node_id and lease.get("token") == held:
+                acquired[:] = [held]
+                return True
+            if lease.get("owner") not in (None, self.node_id) and lease.get("expires_at", 0) > time.time():
+                return False
+            acquired[:] = [lease.get("token", 0) + 1]
+            return self.storage.update_task(
+                task_id, payload={"lease": self._new_lease(acquired[0])}, expected_version=current.get("version", 0)
+            )
+
+        if not self._compare_and_swap(task_id, write):
+            return False
+        self._track(task_id, token=acquired[0])
+        return True
+
+    def claim_task(self, task_id: str) -> bool:
+        """
+        Called before running a task from the inbound queue. Returns False if the task is
+        already finished or, with leases, another node holds it (a redelivered message).
+        A task that does not exist yet is claimed by creating it.
+        """
+        task_data = self.storage.get_task(task_id)
+        if task_data is None:
+            return True
+        if task_data["status"] in TERMINAL_STATUSES:
+            return False
+        return self.acquire_lease(task_id)
+
+    def _renew_lease(self, task_id: str, token: int):
+        def write(current: dict) -> bool:
+            self._fence(task_id, current)
+            if current["status"] in TERMINAL_STATUSES:
+                return False
+            return self.storage.update_task(
+                task_id, payload={"lease": self._new_lease(token)}, expected_version=current.get("version", 0)
+            )
+
+        if not self._compare_and_swap(task_id, write):
+            with self._live_lock:
+                self._live_tasks.pop(task_id, None)
+
+    def _release_lease(self, task_id: str, token: int):
+        """Gives a lease up (keeping its token), so another node can take the task right away."""
+        def write(current: dict) -> bool:
+            self._fence(task_id, current)
+            if current["status"] in TERMINAL_STATUSES:
+                return False
+            return self.storage.update_task(
+                task_id, payload={"lease": {"owner": None, "token": token, "expires_at": 0}},
+                expected_version=current.get("version", 0),
+            )
+
+        self._compare_and_swap(task_id, write)
+        with self._live_lock:
+            self._live_tasks.pop(task_id, None)
+
+    def renew_leases(self) -> int:
+        """Renews every lease this node holds, forgetting tasks finalized or taken over elsewhere. Returns the number renewed."""
+        with self._live_lock:
+            leased = [(task_id, token) for task_id, token in self._live_tasks.items() if token is not None]
+        for task_id, token in leased:
+            self._renew_lease(task_id, token)
+        with self._live_lock:
+            return sum(1 for task_id, token in leased if self._live_tasks.get(task_id) == token)
+
+    def _renew_loop(self):
+        while not self._stop.wait(self.lease_renew_interval):
+            try:
+                self.renew_leases()
+            except Exception as e:
+                print(f"Error renewing task leases: {e}")
+
+    def heartbeat(self) -> int:
+        """
+        Refreshes the index timestamp of every live task of this process in one
+        transaction, forgetting tasks finalized elsewhere. Returns the number of live tasks.
+        """
+        if not self.task_index:
+            with self._live_lock:
+                return len(self._live_tasks)
+        with self._live_lock:
+            task_ids = list(self._live_tasks)
+        live = self.task_index.touch(task_ids, self._get_current_timestamp())
+        with self._live_lock:
+            for task_id in set(task_ids) - live:
+                self._live_tasks.pop(task_id, None)
+            return len(self._live_tasks)
+
+    def find_orphans(self, statuses: list[str], updated_before: str, limit: int = 500,
+                     after: tuple[str, str] = None) -> tuple[list[dict], tuple[str, str] | None]:
+        """
+        Returns (rows, next_cursor): index rows of tasks in one of `statuses` with no
+        transition or heartbeat since `updated_before`, excluding this process' live tasks,
+        from one page of `limit` index rows starting after the keyset cursor `after`.
+        next_cursor is None on the last page.
+        """
+        if not self.task_index:
+            return [], None
+        rows = self.task_index.stale(statuses, updated_before, limit, after=after)
+        next_cursor = (rows[-1]["updated_at"], rows[-1]["task_id"]) if len(rows) >= limit else None
+        with self._live_lock:
+            live = set(self._live_tasks)
+        return [row for row in rows if row["task_id"] not in live], next_cursor
+
+    def mark_requeued(self, task_id: str, statuses: list[str], attempts: int) -> dict | None:
+        """
+        Moves an orphaned task to "Requeued" if it is still in one of `statuses`
+        (compare-and-swap, so a task that moved on meanwhile is left alone) and gives up
+        this node's lease on it. Returns the task state it had, or None if it was not requeued.
+        """
+        previous = []
+        with self._live_lock:
+            token = self._live_tasks.get(task_id)
+
+        def write(current: dict) -> bool:
+            self._fence(task_id, current)
+            if current["status"] not in statuses:
+                return False
+            previous[:] = [current]
+            payload = {"recovery_attempts": attempts}
+            if token is not None:
+                payload["lease"] = {"owner": None, "token": token, "expires_at": 0}
+            return self.storage.update_task(
+                task_id, status="Requeued", payload=payload, expected_version=current.get("version", 0),
+            )
+
+        requeued = self._compare_and_swap(task_id, write)
+        with self._live_lock:
+            self._live_tasks.pop(task_id, None)
+        if not requeued:
+            return None
+        self._index(task_id, self._get_current_timestamp(), "Requeued")
+        self.add_history(task_id, f"Task orphaned in status '{previous[0]['status']}'. Requeued (attempt {attempts}).")
+        return previous[0]
+
+    def resume_task(self, task_id: str, status: str, payload: dict = None) -> bool:
+        """
+        Picks up an existing task again (requeued, or redelivered after its node died),
+        keeping its history. Returns False if the task does not exist, so the caller
+        creates it instead.
+        """
+        if self.storage.get_task(task_id) is None:
+            return False
+        self.update_task_state(task_id, new_status=status, new_payload=payload)
+        self.add_history(task_id, f"Task resumed by {self.node_id}.")
+        return True
+
+    def list_tasks(self, status: str = None, role: str = None, profile: str = None, created_after: str = None,
+                   created_before: str = None, limit: int = 50, cursor: str = None) -> dict | None:
+        """
+        Lists tasks from the task index, newest first, with cursor pagination.
+        Returns {"tasks", "next_cursor", "total", "status_counts"}, or None if the index is disabled.
+        Raises ValueError for a malformed cursor.
+        """
+        if not self.task_index:
+            return None
+        filters = {"status": status, "role": role, "profile": profile, "created_after": created_after, "created_before": created_before}
+        tasks, next_cursor = self.task_index.query(limit=limit, cursor=cursor, **filters)
+        return {
+            "tasks": tasks,
+            "next_cursor": next_cursor,
+            "total": self.task_index.count(**filters),
+            "status_counts": self.task_index.status_counts(),
+        }
+
+    def close(self):
+        """
+        Releases this node's leases, then closes the storage backend and the task index.
+        """
+        self._stop.set()
+        if self._lease_renewer and self._lease_renewer is not threading.current_thread():
+            self._lease_renewer.join(timeout=30)
+        with self._live_lock:
+            leased = [(task_id, token) for task_id, token in self._live_tasks.items() if token is not None]
+        for task_id, token in leased:
+            self._release_lease(task_id, token)
+        self.storage.close()
+        if self.task_index:
+            self.task_index.close()
+
 # Example of how TaskStateManager might be used:
 if __name__ == '__main__':
     task_manager = TaskStateManager()
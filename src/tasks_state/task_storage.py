@@ -0,0 +1,755 @@
+# src/tasks_state/task_storage.py
+
+import contextlib
+import copy
+import datetime
+import fcntl # For file locking on Unix-like systems
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import zlib
+from abc import ABC, abstractmethod
+
+from src.config.config_loader import config
+from src.tasks_state.event_log import EventLog
+from src.tasks_state.history_archive import HistoryArchive
+
+class VersionConflictError(RuntimeError):
+    """Raised when a compare-and-swap write finds the task at a different version."""
+    def __init__(self, task_id: str, expected_version: int, current_version: int):
+        super().__init__(f"Task {task_id} is at version {current_version}, expected {expected_version}.")
+        self.task_id = task_id
+        self.expected_version = expected_version
+        self.current_version = current_version
+
+def check_version(task_id: str, current_version: int, expected_version: int = None):
+    """Raises VersionConflictError if `expected_version` is given and differs from the current one."""
+    if expected_version is not None and expected_version != current_version:
+        raise VersionConflictError(task_id, expected_version, current_version)
+
+class TaskStorage(ABC):
+    """
+    Abstract storage backend for task states. A task state is a dict with
+    `task_id`, `prompt`, `status`, `payload`, `history`, `result`, `error` and `version`.
+    Operations are fine-grained so a backend can apply them without rewriting
+    the whole task (a status change or a history event is a single write).
+    Every write increments `version` (or sets it to `version` when given, which the
+    write-back cache uses to keep versions monotonic). Writes that take
+    `expected_version` are compare-and-swap: they raise VersionConflictError
+    if the task has changed since it was read.
+    `shared` tells whether that check also holds against other processes using the
+    same storage (several orchestrator nodes).
+    """
+    shared = False
+
+    @abstractmethod
+    def create_task(self, task_data: dict) -> bool:
+        """Stores a new task state. Returns True on success."""
+        pass
+
+    @abstractmethod
+    def get_task(self, task_id: str) -> dict | None:
+        """Returns a task state (active or finalized), or None if it does not exist."""
+        pass
+
+    @abstractmethod
+    def update_task(self, task_id: str, status: str = None, payload: dict = None,
+                    expected_version: int = None, version: int = None) -> bool:
+        """
+        Sets the status and merges `payload` into the task's payload (top-level keys).
+        Returns False if the task does not exist.
+        """
+        pass
+
+    @abstractmethod
+    def add_history(self, task_id: str, entry: dict) -> bool:
+        """Appends a history entry. Returns False if the task does not exist."""
+        pass
+
+    def add_history_batch(self, task_id: str, entries: list[dict], version: int = None) -> bool:
+        """Appends several history entries, in order. Returns False if the task does not exist."""
+        return all([self.add_history(task_id, entry) for entry in entries])
+
+    @abstractmethod
+    def finalize_task(self, task_id: str, status: str, fields: dict, entry: dict,
+                      expected_version: int = None, version: int = None) -> bool:
+        """
+        Sets the final status, the given top-level fields (`result`, `error`) and appends
+        the closing history entry. Returns False if the task does not exist.
+        """
+        pass
+
+    def close(self):
+        """Releases the backend's resources."""
+        pass
+
+
+class JsonFileTaskStorage(TaskStorage):
+    """
+    The original layout: one JSON file per task in `base_dir`, moved to
+    `history_dir` when the task is finalized. Every operation rewrites the file.
+    With an `archive`, tasks compacted out of `history_dir` are read from it.
+    Files are replaced atomically (written to a temporary file, then renamed), so
+    readers take no lock and always see a complete document. Writers serialize their
+    read-modify-write cycles with an exclusive flock on one of `lock_stripes` lock
+    files (chosen by task_id), which also works across processes.
+    `fsync_policy` is "always" (file and directory), "data" (file only) or "none".
+    """
+    shared = True
+
+    def __init__(self, base_dir: str = "src/tasks_state", history_dir: str = "src/tasks_history", archive=None,
+                 fsync_policy: str = "data", lock_stripes: int = 64):
+        if fsync_policy not in ("always", "data", "none"):
+            print(f"Warning: Unknown fsync policy '{fsync_policy}'. Using 'data'.")
+            fsync_policy = "data"
+        self.base_dir = base_dir
+        self.history_dir = history_dir
+        self.archive = archive
+        self.compactor = None
+        self.fsync_policy = fsync_policy
+        self.lock_stripes = max(1, lock_stripes)
+        self.lock_dir = os.path.join(self.base_dir, ".locks")
+        os.makedirs(self.base_dir, exist_ok=True)
+        os.makedirs(self.history_dir, exist_ok=True)
+        os.makedirs(self.lock_dir, exist_ok=True)
+
+    def _state_path(self, task_id: str) -> str:
+        return os.path.join(self.base_dir, f"{task_id}.json")
+
+    def _history_path(self, task_id: str) -> str:
+        return os.path.join(self.history_dir, f"{task_id}.json")
+
+    @contextlib.contextmanager
+    def _task_lock(self, task_id: str):
+        """Holds the exclusive writer lock of a task's stripe."""
+        stripe = zlib.crc32(task_id.encode("utf-8")) % self.lock_stripes
+        with open(os.path.join(self.lock_dir, f"stripe-{stripe:03d}.lock"), "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _read_state_file(self, file_path: str) -> dict | None:
+        """Reads and decodes a JSON state file. Raises FileNotFoundError if it does not exist."""
+        try:
+            with open(file_path, 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            raise
+        except (IOError, json.JSONDecodeError) as e:
+            print(f"Error reading task state file {file_path}: {e}")
+            return None
+
+    def _write_state_file(self, file_path: str, data: dict) -> bool:
+        """Writes a JSON state file atomically: temporary file, optional fsync, rename."""
+        directory = os.path.dirname(file_path)
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-", suffix=".json")
+            try:
+                with os.fdopen(fd, 'w') as f:
+                    json.dump(data, f, indent=4)
+                    if self.fsync_policy != "none":
+                        f.flush()
+                        os.fsync(f.fileno())
+                os.replace(tmp_path, file_path)
+            except BaseException:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+            if self.fsync_policy == "always":
+                # Makes the rename itself durable.
+                dir_fd = os.open(directory, os.O_RDONLY)
+                try:
+                    os.fsync(dir_fd)
+                finally:
+                    os.close(dir_fd)
+            return True
+        except (IOError, TypeError, ValueError) as e:
+            print(f"Error writing task state file {file_path}: {e}")
+            return False
+
+    def create_task(self, task_data: dict) -> bool:
+        with self._task_lock(task_data["task_id"]):
+            return self._write_state_file(self._state_path(task_data["task_id"]), task_data)
+
+    def get_task(self, task_id: str) -> dict | None:
+        return self._locate(task_id)[0]
+
+    def _locate(self, task_id: str) -> tuple[dict | None, str | None]:
+        """
+        Returns a task's state and the file it is written back to: its state file while it
+        is live, its history file once finalized (also when it was read from the archive,
+        which the compactor then archives again). A write never brings a finalized task
+        back to `base_dir`.
+        """
+        # Opened directly rather than checked with os.path.exists, so a task moved to
+        # history between the two checks is still found.
+        for file_path in (self._state_path(task_id), self._history_path(task_id)):
+            try:
+                return self._read_state_file(file_path), file_path
+            except FileNotFoundError:
+                continue
+        if self.archive:
+            task_data = self.archive.get(task_id)
+            if task_data is not None:
+                return task_data, self._history_path(task_id)
+        return None, None
+
+    @staticmethod
+    def _bump_version(task_data: dict, version: int = None):
+        task_data["version"] = version if version is not None else task_data.get("version", 0) + 1
+
+    def update_task(self, task_id: str, status: str = None, payload: dict = None,
+                    expected_version: int = None, version: int = None) -> bool:
+        with self._task_lock(task_id):
+            task_data, file_path = self._locate(task_id)
+            if not task_data:
+                return False
+            check_version(task_id, task_data.get("version", 0), expected_version)
+            self._bump_version(task_data, version)
+            if status:
+                task_data["status"] = status
+            if payload:
+                task_data["payload"].update(payload)
+            return self._write_state_file(file_path, task_data)
+
+    def add_history(self, task_id: str, entry: dict) -> bool:
+        return self.add_history_batch(task_id, [entry])
+
+    def add_history_batch(self, task_id: str, entries: list[dict], version: int = None) -> bool:
+        with self._task_lock(task_id):
+            task_data, file_path = self._locate(task_id)
+            if not task_data:
+                return False
+            self._bump_version(task_data, version)
+            task_data["history"].extend(entries)
+            return self._write_state_file(file_path, task_data)
+
+    def finalize_task(self, task_id: str, status: str, fields: dict, entry: dict,
+                      expected_version: int = None, version: int = None) -> bool:
+        with self._task_lock(task_id):
+            task_data = self.get_task(task_id)
+            if not task_data:
+                return False
+            check_version(task_id, task_data.get("version", 0), expected_version)
+            self._bump_version(task_data, version)
+            task_data["status"] = status
+            task_data.update(fields)
+            task_data["history"].append(entry)
+            # The history file is complete before the state file goes away, so readers always find one.
+            if not self._write_state_file(self._history_path(task_id), task_data):
+                print(f"Error writing history file for task {task_id}.")
+                return False
+            try:
+                os.remove(self._state_path(task_id))
+            except FileNotFoundError:
+                pass
+            return True
+
+    def close(self):
+        if self.compactor:
+            self.compactor.close()
+        if self.archive:
+            self.archive.close()
+
+
+class SqliteTaskStorage(TaskStorage):
+    """
+    Embedded SQLite storage in WAL mode. Tasks and history events are rows in two
+    tables, so a status change or a history event is one small transaction instead
+    of rewriting (and renaming) a JSON file. WAL lets readers run alongside the writer,
+    and with `synchronous=NORMAL` commits do not fsync (only checkpoints do), so
+    throughput is not bound by filesystem metadata operations.
+    Each thread gets its own connection.
+    """
+    shared = True
+    SCHEMA = [
+        """CREATE TABLE IF NOT EXISTS tasks (
+            task_id TEXT PRIMARY KEY,
+            prompt TEXT,
+            status TEXT NOT NULL,
+            payload TEXT NOT NULL DEFAULT '{}',
+            result TEXT,
+            error TEXT,
+            created_at TEXT NOT NULL,
+            updated_at TEXT NOT NULL,
+            finalized_at TEXT,
+            version INTEGER NOT NULL DEFAULT 1
+        )""",
+        """CREATE TABLE IF NOT EXISTS task_history (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            task_id TEXT NOT NULL REFERENCES tasks(task_id),
+            timestamp TEXT NOT NULL,
+            event TEXT NOT NULL,
+            payload TEXT
+        )""",
+        "CREATE INDEX IF NOT EXISTS idx_tasks_status ON tasks(status)",
+        "CREATE INDEX IF NOT EXISTS idx_tasks_created_at ON tasks(created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_tasks_updated_at ON tasks(updated_at)",
+        "CREATE INDEX IF NOT EXISTS idx_task_history_task ON task_history(task_id, id)",
+        "CREATE INDEX IF NOT EXISTS idx_task_history_timestamp ON task_history(timestamp)",
+    ]
+
+    def __init__(self, db_path: str = "src/tasks_state/tasks.db", synchronous: str = "NORMAL"):
+        self.db_path = db_path
+        self.synchronous = synchronous
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+        if os.path.dirname(self.db_path):
+            os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+        connection = self._connection()
+        for statement in self.SCHEMA:
+            connection.execute(statement)
+        columns = {row[1] for row in connection.execute("PRAGMA table_info(tasks)")}
+        if "version" not in columns:
+            # Databases created before tasks were versioned.
+            connection.execute("ALTER TABLE tasks ADD COLUMN version INTEGER NOT NULL DEFAULT 1")
+
+    def _connection(self) -> sqlite3.Connection:
+        """Returns this thread's connection, opening it on first use."""
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            # Autocommit mode; multi-statement operations open their own transaction.
+            connection = sqlite3.connect(self.db_path, timeout=30, isolation_level=None, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(f"PRAGMA synchronous={self.synchronous}")
+            connection.execute("PRAGMA foreign_keys=ON")
+            self._local.connection = connection
+            with self._connections_lock:
+                self._connections.append(connection)
+        return connection
+
+    def _transaction(self, connection: sqlite3.Connection, fn):
+        """Runs fn(connection) in a write transaction (taken up front, so concurrent writers queue)."""
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            result = fn(connection)
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+        return result
+
+    @staticmethod
+    def _dumps(value) -> str | None:
+        return None if value is None else json.dumps(value)
+
+    @staticmethod
+    def _loads(value):
+        return None if value is None else json.loads(value)
+
+    def _history_row(self, task_id: str, entry: dict) -> tuple:
+        return (task_id, entry["timestamp"], entry["event"], self._dumps(entry.get("payload")))
+
+    def create_task(self, task_data: dict) -> bool:
+        timestamp = task_data["history"][0]["timestamp"] if task_data.get("history") else datetime.datetime.now().isoformat()
+        def insert(connection):
+            connection.execute(
+                "INSERT OR REPLACE INTO tasks (task_id, prompt, status, payload, result, error, created_at, updated_at, version) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (task_data["task_id"], task_data.get("prompt"), task_data["status"],
+                 json.dumps(task_data.get("payload") or {}), self._dumps(task_data.get("result")),
+                 self._dumps(task_data.get("error")), timestamp, timestamp, task_data.get("version", 1)),
+            )
+            # A redelivered task is created again with the same id; it starts a fresh history.
+            connection.execute("DELETE FROM task_history WHERE task_id = ?", (task_data["task_id"],))
+            connection.executemany(
+                "INSERT INTO task_history (task_id, timestamp, event, payload) VALUES (?, ?, ?, ?)",
+                [self._history_row(task_data["task_id"], entry) for entry in task_data.get("history", [])],
+            )
+        try:
+            self._transaction(self._connection(), insert)
+            return True
+        except sqlite3.Error as e:
+            print(f"Error writing task {task_data.get('task_id')} to SQLite: {e}")
+            return False
+
+    def get_task(self, task_id: str) -> dict | None:
+        connection = self._connection()
+        row = connection.execute(
+            "SELECT task_id, prompt, status, payload, result, error, version FROM tasks WHERE task_id = ?", (task_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        history = [
+            {"timestamp": timestamp, "event": event, **({"payload": self._loads(payload)} if payload is not None else {})}
+            for timestamp, event, payload in connection.execute(
+                "SELECT timestamp, event, payload FROM task_history WHERE task_id = ? ORDER BY id", (task_id,)
+            )
+        ]
+        return {
+            "task_id": row[0],
+            "prompt": row[1],
+            "status": row[2],
+            "payload": json.loads(row[3]),
+            "history": history,
+            "result": self._loads(row[4]),
+            "error": self._loads(row[5]),
+            "version": row[6],
+        }
+
+    def update_task(self, task_id: str, status: str = None, payload: dict = None,
+                    expected_version: int = None, version: int = None) -> bool:
+        def update(connection):
+            row = connection.execute("SELECT status, payload, version FROM tasks WHERE task_id = ?", (task_id,)).fetchone()
+            if row is None:
+                return False
+            check_version(task_id, row[2], expected_version)
+            merged = json.loads(row[1])
+            if payload:
+                merged.update(payload)
+            connection.execute(
+                "UPDATE tasks SET status = ?, payload = ?, updated_at = ?, version = COALESCE(?, version + 1) WHERE task_id = ?",
+                (status or row[0], json.dumps(merged), datetime.datetime.now().isoformat(), version, task_id),
+            )
+            return True
+        try:
+            return self._transaction(self._connection(), update)
+        except sqlite3.Error as e:
+            print(f"Error updating task {task_id} in SQLite: {e}")
+            return False
+
+    def add_history(self, task_id: str, entry: dict) -> bool:
+        return self.add_history_batch(task_id, [entry])
+
+    def add_history_batch(self, task_id: str, entries: list[dict], version: int = None) -> bool:
+        if not entries:
+            return True
+        def insert(connection):
+            updated = connection.execute(
+                "UPDATE tasks SET updated_at = ?, version = COALESCE(?, version + 1) WHERE task_id = ?",
+                (entries[-1]["timestamp"], version, task_id),
+            ).rowcount
+            if not updated:
+                return False
+            connection.executemany(
+                "INSERT INTO task_history (task_id, timestamp, event, payload) VALUES (?, ?, ?, ?)",
+                [self._history_row(task_id, entry) for entry in entries],
+            )
+            return True
+        try:
+            return self._transaction(self._connection(), insert)
+        except sqlite3.Error as e:
+            print(f"Error adding history to task {task_id} in SQLite: {e}")
+            return False
+
+    def finalize_task(self, task_id: str, status: str, fields: dict, entry: dict,
+                      expected_version: int = None, version: int = None) -> bool:
+        def finalize(connection):
+            row = connection.execute("SELECT payload, version FROM tasks WHERE task_id = ?", (task_id,)).fetchone()
+            if row is None:
+                return False
+            check_version(task_id, row[1], expected_version)
+            # result/error are columns; any other field is kept in the payload.
+            extra = {key: value for key, value in fields.items() if key not in ("result", "error")}
+            merged = json.loads(row[0])
+            merged.update(extra)
+            connection.execute(
+                "UPDATE tasks SET status = ?, payload = ?, result = COALESCE(?, result), error = COALESCE(?, error), "
+                "updated_at = ?, finalized_at = ?, version = COALESCE(?, version + 1) WHERE task_id = ?",
+                (status, json.dumps(merged), self._dumps(fields.get("result")), self._dumps(fields.get("error")),
+                 entry["timestamp"], entry["timestamp"], version, task_id),
+            )
+            connection.execute(
+                "INSERT INTO task_history (task_id, timestamp, event, payload) VALUES (?, ?, ?, ?)",
+                self._history_row(task_id, entry),
+            )
+            return True
+        try:
+            return self._transaction(self._connection(), finalize)
+        except sqlite3.Error as e:
+            print(f"Error finalizing task {task_id} in SQLite: {e}")
+            return False
+
+    def close(self):
+        with self._connections_lock:
+            for connection in self._connections:
+                connection.close()
+            self._connections = []
+        self._local = threading.local()
+
+
+class EventLogTaskStorage(TaskStorage):
+    """
+    Event-sourced storage: every operation is appended as one record to a segmented
+    JSONL EventLog, and task states are materialized in memory by applying the
+    records. On startup the latest snapshot is loaded and the log after it replayed.
+    Appending a history event writes one line, however long the task's history already is.
+    A record is appended before it is applied, so memory never holds a change the log
+    does not. Each record carries the version it produces, which makes replay idempotent.
+    Every `snapshot_interval` seconds, compact() moves finalized tasks to a HistoryArchive
+    (and out of memory), writes the unfinished ones to a snapshot and deletes the log
+    segments the snapshot covers, so neither memory, disk nor replay time grows with the
+    number of tasks ever run. Finalized tasks are read back from the archive.
+    """
+    SNAPSHOT_PREFIX = "snapshot-"
+    SNAPSHOT_SUFFIX = ".json"
+
+    def __init__(self, log_dir: str = "src/tasks_state/events", segment_max_bytes: int = 64 * 1024 * 1024,
+                 fsync_policy: str = "interval", fsync_interval: float = 0.05, snapshot_interval: float = 300.0,
+                 archive: HistoryArchive = None):
+        self.log_dir = log_dir
+        self.log = EventLog(log_dir, segment_max_bytes=segment_max_bytes, fsync_policy=fsync_policy, fsync_interval=fsync_interval)
+        self.archive = archive or HistoryArchive(os.path.join(log_dir, "archive"))
+        self.snapshot_interval = snapshot_interval
+        self._tasks = {}
+        self._finalized = set()  # ids of the tasks in memory whose last change was a finalization
+        self._lock = threading.Lock()
+        self._compact_lock = threading.Lock()
+        self._dirty = False      # records appended since the last snapshot
+        start_index, tasks = self._load_snapshot()
+        self._tasks.update(tasks)
+        replayed = 0
+        for record in self.log.replay(start_index):
+            self._apply(record)
+            replayed += 1
+        self._dirty = replayed > 0
+        print(f"Loaded {len(tasks)} task(s) from the snapshot and replayed {replayed} task event(s) from {log_dir}.")
+        self._stop = threading.Event()
+        self._compactor = None
+        if self.snapshot_interval:
+            self._compactor = threading.Thread(target=self._compact_loop, name="event-log-compactor", daemon=True)
+            self._compactor.start()
+
+    def _snapshots(self) -> list[str]:
+        """Returns the paths of the snapshot files, oldest first."""
+        names = sorted(
+            name for name in os.listdir(self.log_dir)
+            if name.startswith(self.SNAPSHOT_PREFIX) and name.endswith(self.SNAPSHOT_SUFFIX)
+        )
+        return [os.path.join(self.log_dir, name) for name in names]
+
+    def _load_snapshot(self) -> tuple[int, dict]:
+        """Returns (first segment to replay, tasks) from the newest readable snapshot."""
+        for path in reversed(self._snapshots()):
+            try:
+                with open(path, "r") as f:
+                    snapshot = json.load(f)
+                return snapshot["segment"], snapshot["tasks"]
+            except (IOError, ValueError, KeyError) as e:
+                print(f"Error reading task snapshot {path}: {e}")
+        return 0, {}
+
+    def _load(self, task_id: str) -> dict | None:
+        """Returns a task in memory, bringing a finalized one back from the archive. Caller holds the lock."""
+        task_data = self._tasks.get(task_id)
+        if task_data is None:
+            task_data = self.archive.get(task_id)
+            if task_data is not None:
+                self._tasks[task_id] = task_data
+                self._finalized.add(task_id)
+        return task_data
+
+    def _apply(self, record: dict) -> bool:
+        """
+        Applies one event to the in-memory states. Returns False if its task does not exist.
+        A record whose version the task already has (replayed over a newer archived copy) is skipped.
+        """
+        op = record["op"]
+        if op == "create":
+            self._tasks[record["task"]["task_id"]] = copy.deepcopy(record["task"])
+            self._finalized.discard(record["task"]["task_id"])
+            return True
+        task_data = self._load(record["task_id"])
+        if task_data is None:
+            return False
+        version = record.get("version")
+        if version is not None and version <= task_data.get("version", 0):
+            return True
+        task_data["version"] = version if version is not None else task_data.get("version", 0) + 1
+        if op == "update":
+            if record.get("status"):
+                task_data["status"] = record["status"]
+            if record.get("payload"):
+                task_data["payload"].update(record["payload"])
+        elif op == "history":
+            task_data["history"].extend(record["entries"])
+        elif op == "finalize":
+            task_data["status"] = record["status"]
+            task_data.update(record["fields"])
+            task_data["history"].append(record["entry"])
+            self._finalized.add(record["task_id"])
+        return True
+
+    def _record(self, record: dict, expected_version: int = None) -> bool:
+        """Appends an event to the log and, once it is written, applies it. Returns False if its task does not exist."""
+        with self._lock:
+            if record["op"] != "create":
+                task_data = self._load(record["task_id"])
+                if task_data is None:
+                    return False
+                check_version(record["task_id"], task_data.get("version", 0), expected_version)
+                if record.get("version") is None:
+                    record["version"] = task_data.get("version", 0) + 1
+            # Appended under the lock so the log order matches the order events are applied;
+            # the fsync is awaited outside it so concurrent writers share one.
+            sequence = self.log.append(record, wait=False)
+            self._apply(record)
+            self._dirty = True
+        self.log.wait_durable(sequence)
+        return True
+
+    def create_task(self, task_data: dict) -> bool:
+        return self._record({"op": "create", "task": task_data})
+
+    def get_task(self, task_id: str) -> dict | None:
+        with self._lock:
+            task_data = self._tasks.get(task_id)
+            if task_data is not None:
+                return copy.deepcopy(task_data)
+        return self.archive.get(task_id)
+
+    def update_task(self, task_id: str, status: str = None, payload: dict = None,
+                    expected_version: int = None, version: int = None) -> bool:
+        return self._record(
+            {"op": "update", "task_id": task_id, "status": status, "payload": payload, "version": version}, expected_version
+        )
+
+    def add_history(self, task_id: str, entry: dict) -> bool:
+        return self.add_history_batch(task_id, [entry])
+
+    def add_history_batch(self, task_id: str, entries: list[dict], version: int = None) -> bool:
+        return self._record({"op": "history", "task_id": task_id, "entries": entries, "version": version})
+
+    def finalize_task(self, task_id: str, status: str, fields: dict, entry: dict,
+                      expected_version: int = None, version: int = None) -> bool:
+        return self._record(
+            {"op": "finalize", "task_id": task_id, "status": status, "fields": fields, "entry": entry, "version": version},
+            expected_version,
+        )
+
+    def compact(self) -> int:
+        """
+        Archives the finalized tasks, snapshots the others and deletes the log segments
+        the snapshot covers. Returns the number of tasks archived.
+        The archive and the snapshot are on disk before any segment is deleted; a crash
+        in between replays the older snapshot and segments, over archived copies that
+        the record versions make harmless.
+        """
+        with self._compact_lock:
+            with self._lock:
+                if not self._dirty:
+                    return 0
+                start_index = self.log.roll()
+                finalized = [copy.deepcopy(self._tasks[task_id]) for task_id in self._finalized]
+                live = json.dumps({
+                    "segment": start_index,
+                    "tasks": {task_id: task_data for task_id, task_data in self._tasks.items() if task_id not in self._finalized},
+                })
+                self._dirty = False
+            self.archive.write_segment(finalized)
+            snapshot_path = os.path.join(self.log_dir, f"{self.SNAPSHOT_PREFIX}{start_index:08d}{self.SNAPSHOT_SUFFIX}")
+            self._write_snapshot(snapshot_path, live)
+            for path in self._snapshots():
+                if path != snapshot_path:
+                    os.remove(path)
+            self.log.drop_segments(start_index)
+            with self._lock:
+                # A task changed since it was archived stays in memory until the next snapshot.
+                for task_data in finalized:
+                    task_id = task_data["task_id"]
+                    current = self._tasks.get(task_id)
+                    if task_id in self._finalized and current is not None and current.get("version") == task_data.get("version"):
+                        del self._tasks[task_id]
+                        self._finalized.discard(task_id)
+        return len(finalized)
+
+    def _write_snapshot(self, path: str, data: str):
+        """Writes a snapshot atomically and durably: temporary file, fsync, rename, directory fsync."""
+        fd, tmp_path = tempfile.mkstemp(dir=self.log_dir, prefix=".tmp-", suffix=self.SNAPSHOT_SUFFIX)
+        try:
+            with os.fdopen(fd, "w") as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        dir_fd = os.open(self.log_dir, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+    def _compact_loop(self):
+        while not self._stop.wait(self.snapshot_interval):
+            try:
+                archived = self.compact()
+                if archived:
+                    print(f"Task event log compaction: archived {archived} finalized task(s).")
+            except Exception as e:
+                print(f"Error compacting the task event log: {e}")
+
+    def close(self):
+        self._stop.set()
+        if self._compactor and self._compactor is not threading.current_thread():
+            self._compactor.join(timeout=30)
+        self.log.close()
+        self.archive.close()
+
+
+def create_task_storage(base_dir: str = "src/tasks_state", history_dir: str = "src/tasks_history") -> TaskStorage:
+    """
+    Returns the storage backend selected by `task_state.backend`:
+    "json" (default, one file per task), "sqlite" or "eventlog", wrapped in the write-back
+    cache when `task_state.cache.enabled` is set.
+    """
+    state_config = config.get("task_state", {})
+    backend = state_config.get("backend", "json")
+    if backend == "sqlite":
+        storage = SqliteTaskStorage(
+            db_path=state_config.get("sqlite_path", os.path.join(base_dir, "tasks.db")),
+            synchronous=state_config.get("sqlite_synchronous", "NORMAL"),
+        )
+    elif backend == "eventlog":
+        event_log_config = state_config.get("event_log", {})
+        storage = EventLogTaskStorage(
+            log_dir=event_log_config.get("log_dir", os.path.join(base_dir, "events")),
+            segment_max_bytes=event_log_config.get("segment_max_bytes", 64 * 1024 * 1024),
+            fsync_policy=event_log_config.get("fsync_policy", "interval"),
+            fsync_interval=event_log_config.get("fsync_interval", 0.05),
+            snapshot_interval=event_log_config.get("snapshot_interval", 300.0),
+        )
+    else:
+        if backend != "json":
+            print(f"Warning: Unknown task state backend '{backend}'. Using JSON files.")
+        storage = JsonFileTaskStorage(
+            base_dir, history_dir,
+            fsync_policy=state_config.get("fsync_policy", "data"),
+            lock_stripes=state_config.get("lock_stripes", 64),
+        )
+        compaction_config = state_config.get("compaction", {})
+        if compaction_config.get("enabled", False):
+            from src.tasks_state.history_archive import HistoryCompactor
+            storage.archive = HistoryArchive(
+                archive_dir=compaction_config.get("archive_dir", os.path.join(history_dir, "archive")),
+                compression=compaction_config.get("compression", "none"),
+                compression_level=compaction_config.get("compression_level", 3),
+            )
+            storage.compactor = HistoryCompactor(
+                storage, storage.archive,
+                interval=compaction_config.get("interval", 60.0),
+                batch_size=compaction_config.get("batch_size", 1000),
+                min_age=compaction_config.get("min_age", 60.0),
+                retention_days=compaction_config.get("retention_days", {}),
+            )
+            storage.compactor.start()
+    if not isinstance(storage, JsonFileTaskStorage) and state_config.get("compaction", {}).get("enabled", False):
+        print(f"Warning: task_state.compaction only applies to the 'json' backend. Ignoring it for '{backend}'.")
+
+    cache_config = state_config.get("cache", {})
+    if cache_config.get("enabled", False):
+        from src.tasks_state.task_state_cache import CachedTaskStorage
+        storage = CachedTaskStorage(
+            storage,
+            flush_interval=cache_config.get("flush_interval", 0.5),
+            durability=cache_config.get("durability", "finalize"),
+            max_entries=cache_config.get("max_entries", 10000),
+        )
+    return storage
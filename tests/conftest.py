@@ -0,0 +1,20 @@
+# Test configuration
+
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+# The configuration is loaded from a path relative to the repository root.
+os.chdir(ROOT)
+
+from src.config.config_loader import config
+
+@pytest.fixture
+def configure(monkeypatch):
+    """Overrides configuration sections for one test: configure("task_state", {...})."""
+    def apply(section: str, values: dict):
+        monkeypatch.setitem(config.config, section, values)
+    return apply
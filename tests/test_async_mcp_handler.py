@@ -0,0 +1,83 @@
+# Tests for failure handling in the asyncio MCP transport
+
+import asyncio
+
+import pytest
+
+pytest.importorskip("aio_pika")
+
+from src.core.async_mcp_handler import AsyncMCPHandler
+from src.core.retry_policy import ATTEMPTS_HEADER, DEAD_LETTER_EXCHANGE, ORIGINAL_QUEUE_HEADER
+
+class StubExchange:
+    def __init__(self, name, fail=False):
+        self.name = name
+        self.fail = fail
+        self.published = []
+
+    async def publish(self, message, routing_key):
+        if self.fail:
+            raise ConnectionError("channel closed")
+        self.published.append((message, routing_key))
+
+class StubChannel:
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.exchanges = {}
+
+    async def declare_exchange(self, name, exchange_type, durable=True, arguments=None):
+        return self.exchanges.setdefault(name, StubExchange(name, self.fail))
+
+class StubMessage:
+    def __init__(self, headers=None):
+        self.body = b'{"task_id": "t1"}'
+        self.content_type = "application/json"
+        self.priority = 3
+        self.headers = headers
+        self.settled = []
+
+    async def ack(self):
+        self.settled.append("ack")
+
+    async def nack(self, requeue=False):
+        self.settled.append(("nack", requeue))
+
+def failing_handler(fail_publish=False):
+    handler = AsyncMCPHandler()
+    handler.channel = StubChannel(fail_publish)
+    handler.retry_policy.max_attempts = 3
+    handler.retry_policy.delays_ms = [10, 20]
+    handler.retry_policy.requeue_delay_ms = 0
+
+    def callback(body, content_type):
+        raise RuntimeError("handler failed")
+    handler.callbacks["inbound"] = callback
+    return handler
+
+def test_a_failed_message_goes_to_the_retry_tier_for_its_attempt():
+    handler = failing_handler()
+    message = StubMessage({ATTEMPTS_HEADER: 1})
+    asyncio.run(handler._on_message("inbound", message))
+
+    tier = handler.channel.exchanges[handler.retry_policy.tier_name(20)]
+    [(republished, routing_key)] = tier.published
+    assert routing_key == "inbound"
+    assert republished.headers[ATTEMPTS_HEADER] == 2
+    assert republished.headers[ORIGINAL_QUEUE_HEADER] == "inbound"
+    assert republished.body == message.body and republished.priority == 3
+    assert message.settled == ["ack"]
+
+def test_a_message_out_of_attempts_is_dead_lettered():
+    handler = failing_handler()
+    message = StubMessage({ATTEMPTS_HEADER: 2})
+    asyncio.run(handler._on_message("inbound", message))
+
+    [(republished, routing_key)] = handler.channel.exchanges[DEAD_LETTER_EXCHANGE].published
+    assert routing_key == "inbound" and republished.headers[ATTEMPTS_HEADER] == 3
+    assert message.settled == ["ack"]
+
+def test_a_message_that_cannot_be_republished_is_requeued():
+    handler = failing_handler(fail_publish=True)
+    message = StubMessage()
+    asyncio.run(handler._on_message("inbound", message))
+    assert message.settled == [("nack", True)]
@@ -0,0 +1,73 @@
+# Tests for the claim-check blob store
+
+import asyncio
+import os
+import time
+
+import pytest
+
+from src.core.blob_store import BlobStore, BLOB_REFERENCE_KEY
+
+@pytest.fixture
+def blob_store(tmp_path):
+    return BlobStore(base_dir=str(tmp_path / "blobs"), threshold_bytes=64, enabled=True)
+
+def test_large_values_are_offloaded_and_resolved(blob_store):
+    message = {"task_id": "t1", "prompt": "x" * 100, "nested": [{"data": b"y" * 100}, "small"]}
+    offloaded = blob_store.offload(message)
+    assert offloaded["task_id"] == "t1"
+    assert blob_store.is_reference(offloaded["prompt"])
+    assert blob_store.is_reference(offloaded["nested"][0]["data"])
+    assert offloaded["nested"][1] == "small"
+    assert blob_store.resolve(offloaded) == message
+
+def test_small_values_are_not_copied(blob_store):
+    message = {"task_id": "t1", "prompt": "short"}
+    assert blob_store.offload(message) is message
+
+def test_identical_values_share_one_blob(blob_store):
+    first = blob_store.put("z" * 100)
+    second = blob_store.put("z" * 100)
+    assert first == second
+    assert blob_store.exists(first[BLOB_REFERENCE_KEY])
+
+def test_a_truncated_blob_is_not_resolved(blob_store):
+    reference = blob_store.put("z" * 100)
+    path = blob_store._path_for(reference[BLOB_REFERENCE_KEY])
+    with open(path, "r+b") as f:
+        f.truncate(10)
+    with pytest.raises(ValueError):
+        blob_store.get(reference)
+    assert blob_store.resolve({"result": reference}) == {"result": reference}
+
+def test_only_blobs_not_stored_since_the_cutoff_are_deleted(blob_store):
+    reference = blob_store.put("z" * 100)
+    digest = reference[BLOB_REFERENCE_KEY]
+    path = blob_store._path_for(digest)
+    os.utime(path, (1000, 1000))
+    # Storing the same content again refreshes the blob, which is then kept.
+    blob_store.put("z" * 100)
+    assert not blob_store.delete(digest, stored_before=time.time() - 60)
+    assert blob_store.get(reference) == "z" * 100
+
+    os.utime(path, (1000, 1000))
+    assert blob_store.delete(digest, stored_before=time.time() - 60)
+    assert not blob_store.exists(digest)
+    assert not blob_store.delete(digest, stored_before=time.time())
+    # A deleted blob is written again by the next put.
+    assert blob_store.get(blob_store.put("z" * 100)) == "z" * 100
+
+def test_digests_are_found_at_any_depth(blob_store):
+    first, second = blob_store.put("a" * 100), blob_store.put("b" * 100)
+    task = {"result": first, "history": [{"payload": {"files": [second, "small"]}}, {"payload": None}]}
+    assert BlobStore.digests_in(task) == {first[BLOB_REFERENCE_KEY], second[BLOB_REFERENCE_KEY]}
+
+def test_async_publish_offloads_large_values(blob_store):
+    pytest.importorskip("aio_pika")
+    from src.core.async_mcp_handler import AsyncMCPHandler
+
+    handler = AsyncMCPHandler(blob_store=blob_store)
+    message = {"task_id": "t1", "prompt": "x" * 100}
+    decoded = handler.codec.decode(asyncio.run(handler._encode(message)))
+    assert blob_store.is_reference(decoded["prompt"])
+    assert blob_store.resolve(decoded) == message
@@ -0,0 +1,103 @@
+# Tests for the publisher channel pool
+
+import threading
+import time
+
+import pytest
+
+pytest.importorskip("pika")
+
+from src.core.channel_pool import PublisherChannelPool
+
+class StubConnection:
+    def __init__(self):
+        self.is_open = True
+
+    def close(self):
+        self.is_open = False
+
+class StubChannel:
+    def __init__(self, connection):
+        self.connection = connection
+        self.is_open = True
+
+def stub_pool(size=2, checkout_timeout=1.0, on_open=None):
+    pool = PublisherChannelPool("localhost", size=size, checkout_timeout=checkout_timeout, on_open=on_open)
+    opened = []
+
+    def open_channel():
+        connection = StubConnection()
+        channel = StubChannel(connection)
+        if pool.on_open:
+            pool.on_open(channel)
+        opened.append(channel)
+        return connection, channel
+    pool._open_channel = open_channel
+    return pool, opened
+
+def test_returned_channels_are_reused():
+    pool, opened = stub_pool()
+    with pool.channel() as first:
+        pass
+    with pool.channel() as second:
+        assert pool.get_stats()["in_use"] == 1
+    assert first is second and len(opened) == 1
+    stats = pool.get_stats()
+    assert (stats["checkouts"], stats["open_channels"], stats["in_use"]) == (2, 1, 0)
+
+def test_channels_are_opened_up_to_the_pool_size_then_waited_for():
+    pool, opened = stub_pool(size=1)
+    taken = []
+
+    def checkout():
+        with pool.channel() as channel:
+            taken.append(channel)
+
+    with pool.channel() as channel:
+        waiter = threading.Thread(target=checkout)
+        waiter.start()
+        time.sleep(0.05)
+        assert taken == []
+    waiter.join(timeout=2)
+    assert taken == [channel] and len(opened) == 1
+    stats = pool.get_stats()
+    assert stats["waits"] == 1 and stats["max_wait_ms"] > 0
+
+def test_checkout_times_out_when_every_channel_stays_busy():
+    pool, _ = stub_pool(size=1, checkout_timeout=0.05)
+    with pool.channel():
+        with pytest.raises(TimeoutError):
+            with pool.channel():
+                pass
+    assert pool.get_stats()["timeouts"] == 1
+
+def test_a_channel_closed_while_idle_is_replaced():
+    pool, opened = stub_pool()
+    with pool.channel() as channel:
+        pass
+    channel.connection.close()
+    with pool.channel() as replacement:
+        assert replacement is not channel and replacement.is_open
+    stats = pool.get_stats()
+    assert (stats["discarded"], stats["open_channels"]) == (1, 1)
+
+def test_a_channel_that_fails_while_checked_out_is_discarded():
+    pool, opened = stub_pool()
+    with pytest.raises(RuntimeError):
+        with pool.channel() as channel:
+            raise RuntimeError("publish failed")
+    assert not channel.connection.is_open
+    with pool.channel() as replacement:
+        assert replacement is not channel
+    stats = pool.get_stats()
+    assert (stats["discarded"], stats["open_channels"], len(opened)) == (1, 1, 2)
+
+def test_close_discards_idle_channels_and_refuses_checkouts():
+    pool, _ = stub_pool()
+    with pool.channel() as channel:
+        pass
+    pool.close()
+    assert not channel.connection.is_open and pool.get_stats()["open_channels"] == 0
+    with pytest.raises(RuntimeError):
+        with pool.channel():
+            pass
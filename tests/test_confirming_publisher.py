@@ -0,0 +1,94 @@
+# Tests for pipelined publisher confirms
+
+import threading
+import types
+
+import pytest
+
+pika = pytest.importorskip("pika")
+
+from src.core.confirming_publisher import ConfirmingPublisher
+
+class InlineIOLoop:
+    """Runs the callbacks scheduled onto the I/O thread at once."""
+    def add_callback_threadsafe(self, callback):
+        callback()
+
+class StubConnection:
+    def __init__(self):
+        self.ioloop = InlineIOLoop()
+        self.is_open = True
+
+class StubChannel:
+    def __init__(self):
+        self.is_open = True
+        self.published = []
+
+    def basic_publish(self, exchange, routing_key, body, properties):
+        self.published.append((exchange, routing_key, body))
+
+def open_publisher(max_outstanding=10):
+    publisher = ConfirmingPublisher("localhost", max_outstanding=max_outstanding)
+    publisher._connection, publisher._channel = StubConnection(), StubChannel()
+    return publisher
+
+def confirm(publisher, delivery_tag, ack=True, multiple=False):
+    method = (pika.spec.Basic.Ack if ack else pika.spec.Basic.Nack)(delivery_tag=delivery_tag, multiple=multiple)
+    publisher._on_delivery_confirmation(types.SimpleNamespace(method=method))
+
+def test_one_ack_frame_resolves_every_publish_up_to_its_tag():
+    publisher = open_publisher()
+    futures = [publisher.publish("", "work", b"%d" % n) for n in range(3)]
+    assert not any(future.done() for future in futures)
+
+    confirm(publisher, 2, multiple=True)
+    assert [future.done() for future in futures] == [True, True, False]
+    assert futures[0].result() is True
+    confirm(publisher, 3)
+    assert futures[2].result() is True
+    assert publisher.get_stats() == {
+        "published": 3, "acked": 3, "nacked": 0, "outstanding": 0,
+        "confirm_frames": 2, "average_batch_size": 1.5,
+    }
+
+def test_a_nacked_publish_resolves_to_false():
+    publisher = open_publisher()
+    acked, nacked = publisher.publish("", "work", b"1"), publisher.publish("", "work", b"2")
+    confirm(publisher, 2, ack=False)
+    confirm(publisher, 1)
+    assert (acked.result(), nacked.result()) == (True, False)
+    stats = publisher.get_stats()
+    assert (stats["acked"], stats["nacked"]) == (1, 1)
+
+def test_publishing_waits_for_room_below_max_outstanding():
+    publisher = open_publisher(max_outstanding=1)
+    first = publisher.publish("", "work", b"1")
+    blocked = publisher.publish("", "work", b"2", timeout=0.05)
+    with pytest.raises(TimeoutError):
+        blocked.result(timeout=1)
+    # A confirm frees the slot.
+    confirm(publisher, 1)
+    assert first.result() is True
+    assert not publisher.publish("", "work", b"3", timeout=0.05).done()
+
+def test_a_dropped_connection_fails_unconfirmed_publishes():
+    publisher = open_publisher()
+    future = publisher.publish("", "work", b"1")
+    publisher._on_connection_closed(types.SimpleNamespace(ioloop=types.SimpleNamespace(stop=lambda: None)), "gone")
+    with pytest.raises(ConnectionError):
+        future.result(timeout=1)
+    assert publisher.get_stats()["outstanding"] == 0
+
+def test_the_handler_reports_an_unconfirmed_publish_as_failed():
+    from src.core.mcp_handler import MCPHandler
+
+    handler = MCPHandler()
+    handler.confirm_timeout = 0.05
+    publisher = handler.confirming_publisher = open_publisher()
+    # Never confirmed by the broker: the handler gives up after confirm_timeout.
+    assert not handler.publish_message("work", {"task_id": "t1"})
+
+    handler.confirm_timeout = 2
+    for delivery_tag, ack in ((2, False), (3, True)):
+        threading.Timer(0.02, confirm, args=(publisher, delivery_tag, ack)).start()
+        assert handler.publish_message("work", {"task_id": "t1"}) is ack
@@ -0,0 +1,117 @@
+# Tests for engine health tracking and failover
+
+import random
+import time
+
+import pytest
+
+from src.load_balancer.engine_health import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, EngineHealth
+from src.load_balancer.load_balancer import LoadBalancer
+from tests.test_load_balancer_rules import ENGINES, reference_select, rule_set
+
+LLM_ENGINES = {
+    "ollama_tinyllama": {"model": "tinyllama"},
+    "ollama_phi3": {"model": "phi3:mini"},
+    "openai_gpt": {"model": "gpt-4o"},
+}
+
+def test_breaker_opens_after_consecutive_failures_and_half_opens_after_the_timeout():
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0.05)
+    breaker.record(False, "timeout")
+    assert breaker.state == CLOSED
+    breaker.record(False, "timeout")
+    assert breaker.state == OPEN
+    breaker.tick()
+    assert breaker.state == OPEN
+    time.sleep(0.06)
+    breaker.tick()
+    assert breaker.state == HALF_OPEN
+    # A half-open breaker reopens on the first failure.
+    breaker.record(False, "still down")
+    assert breaker.state == OPEN
+
+def test_success_resets_the_failure_count():
+    breaker = CircuitBreaker(failure_threshold=2)
+    breaker.record(False)
+    breaker.record(True)
+    breaker.record(False)
+    assert breaker.state == CLOSED
+
+def test_probe_trips_on_missing_models_and_unreachable_hosts():
+    health = EngineHealth(LLM_ENGINES, reset_timeout=60)
+    health.add_probe("ollama", lambda: ["phi3:mini"])
+    health.add_probe("openai", lambda: (_ for _ in ()).throw(ConnectionError("refused")))
+    health.probe_once()
+    states = health.states()
+    assert states["ollama_tinyllama"]["state"] == OPEN
+    assert "not available" in states["ollama_tinyllama"]["last_error"]
+    assert states["ollama_phi3"]["state"] == CLOSED
+    assert states["openai_gpt"]["state"] == OPEN
+    assert health.unavailable == {"ollama_tinyllama", "openai_gpt"}
+
+def test_probe_leaves_an_open_breaker_open_until_its_timeout():
+    health = EngineHealth(LLM_ENGINES, failure_threshold=1, reset_timeout=0.1)
+    health.add_probe("ollama", lambda: ["tinyllama:latest", "phi3:mini"])
+    health.record_outcome("ollama", "tinyllama", False, "500 from the host")
+    assert health.states()["ollama_tinyllama"]["state"] == OPEN
+
+    # The model is listed, but the breaker opened on failed calls: it waits out the timeout.
+    health.probe_once()
+    assert health.states()["ollama_tinyllama"]["state"] == OPEN
+    time.sleep(0.11)
+    health.probe_once()
+    assert health.states()["ollama_tinyllama"]["state"] == CLOSED
+    assert "ollama_tinyllama" not in health.unavailable
+
+def test_half_open_engines_are_skipped_only_when_a_probe_decides_on_them():
+    health = EngineHealth(LLM_ENGINES, failure_threshold=1, reset_timeout=0)
+    health.record_outcome("openai", "gpt-4o", False)
+    health.probe_once()  # no openai probe: ticks the breaker to half-open
+    assert health.states()["openai_gpt"]["state"] == HALF_OPEN
+    assert "openai_gpt" not in health.unavailable
+    health.record_outcome("openai", "gpt-4o", True)
+    assert health.states()["openai_gpt"]["state"] == CLOSED
+
+@pytest.fixture
+def load_balancer(configure):
+    configure("engine_health", {"enabled": True, "reset_timeout": 60, "probe_interval": 3600})
+    balancer = LoadBalancer()
+    balancer.reload(
+        llm_engines={name: {**engine_config, "toggle": True} for name, engine_config in LLM_ENGINES.items()},
+        lb_rules={
+            "default_engine": "openai_gpt",
+            "rules": [{"condition": "agent.is('Fast-Coder-Agent')", "engine": "ollama_tinyllama"},
+                      {"condition": "agent.is('Fast-Coder-Agent')", "engine": "ollama_phi3"}],
+        },
+    )
+    yield balancer
+    balancer.close()
+
+def test_load_balancer_fails_over_with_a_stub_probe(load_balancer):
+    task = {"agent": "Fast-Coder-Agent", "prompt": "fizzbuzz"}
+    assert load_balancer.select_llm_engine(task) == "ollama_tinyllama"
+    load_balancer.attach_engines({}, probes={"ollama": lambda: ["phi3:mini"]})
+    load_balancer.engine_health.probe_once()
+    assert load_balancer.select_llm_engine(task) == "ollama_phi3"
+    load_balancer.update_engine_status("ollama_phi3", "error")
+    assert load_balancer.select_llm_engine(task) == "openai_gpt"
+    load_balancer.update_engine_status("ollama_tinyllama", "active")
+    assert load_balancer.select_llm_engine(task) == "ollama_tinyllama"
+
+def test_failover_matches_a_naive_evaluation():
+    random_state = random.Random(11)
+    agents = ["A", "B", "C"]
+    words = ["bug", "sql", "poem"]
+    for _ in range(100):
+        rules = [
+            (f"agent.is('{random_state.choice(agents)}')"
+             + (f" and prompt.contains('{random_state.choice(words)}')" if random_state.random() < 0.5 else ""),
+             random_state.choice(ENGINES))
+            for _ in range(random_state.randint(1, 8))
+        ]
+        compiled = rule_set(rules)
+        for _ in range(10):
+            agent = random_state.choice(agents)
+            prompt = " ".join(random_state.sample(words, random_state.randint(0, 3)))
+            unavailable = frozenset(random_state.sample(ENGINES, random_state.randint(0, 5)))
+            assert compiled.select(agent, prompt, unavailable) == reference_select(rules, agent, prompt, unavailable)
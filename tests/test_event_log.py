@@ -0,0 +1,126 @@
+# Tests for the event log and the event-sourced task storage
+
+import os
+
+import pytest
+
+from src.tasks_state.event_log import EventLog
+from src.tasks_state.task_state_cache import CachedTaskStorage
+from src.tasks_state.task_storage import EventLogTaskStorage
+from tests.test_task_storage import new_task, history_entry
+
+def open_storage(log_dir, **kwargs) -> EventLogTaskStorage:
+    # Compaction is run by hand in these tests.
+    return EventLogTaskStorage(str(log_dir), fsync_policy="none", snapshot_interval=0, **kwargs)
+
+def events(task):
+    return [entry["event"] for entry in task["history"]]
+
+def test_records_are_replayed_across_segments(tmp_path):
+    log = EventLog(str(tmp_path), segment_max_bytes=200, fsync_policy="none")
+    for n in range(50):
+        log.append({"n": n})
+    log.close()
+    log = EventLog(str(tmp_path), segment_max_bytes=200, fsync_policy="none")
+    assert len(log.segments()) > 1
+    assert [record["n"] for record in log.replay()] == list(range(50))
+    log.close()
+
+def test_torn_tail_is_truncated_on_open(tmp_path):
+    log = EventLog(str(tmp_path), fsync_policy="none")
+    log.append({"n": 1})
+    log.append({"n": 2})
+    log.close()
+    segment = log.segments()[-1]
+    with open(segment, "ab") as f:
+        f.write(b'{"n": 3, "par')
+    log = EventLog(str(tmp_path), fsync_policy="none")
+    log.append({"n": 4})
+    assert [record["n"] for record in log.replay()] == [1, 2, 4]
+    log.close()
+
+def test_group_commit_waits_for_fsync(tmp_path):
+    log = EventLog(str(tmp_path), fsync_policy="always")
+    sequence = log.append({"n": 1})
+    assert log._synced >= sequence
+    assert log.fsyncs >= 1
+    log.close()
+
+def test_storage_is_rebuilt_from_the_log(tmp_path):
+    storage = open_storage(tmp_path)
+    storage.create_task(new_task("t1"))
+    storage.update_task("t1", status="Processing", payload={"a": 1})
+    storage.add_history("t1", history_entry("step"))
+    storage.close()
+
+    storage = open_storage(tmp_path)
+    task = storage.get_task("t1")
+    assert task["status"] == "Processing"
+    assert task["payload"] == {"a": 1}
+    assert events(task) == ["Task created: t1", "step"]
+    assert task["version"] == 3
+    storage.close()
+
+def test_failed_append_leaves_memory_unchanged(tmp_path):
+    storage = open_storage(tmp_path)
+    storage.create_task(new_task("t1"))
+    with pytest.raises(TypeError):
+        storage.update_task("t1", payload={"unserializable": object()})
+    task = storage.get_task("t1")
+    assert task["payload"] == {}
+    assert task["version"] == 1
+    storage.close()
+
+def test_compaction_archives_finalized_tasks_and_drops_segments(tmp_path):
+    storage = open_storage(tmp_path)
+    storage.create_task(new_task("live"))
+    storage.create_task(new_task("done"))
+    storage.finalize_task("done", "Completed", {"result": "ok"}, history_entry("Task finalized"))
+    first_segments = storage.log.segments()
+
+    assert storage.compact() == 1
+    assert "done" not in storage._tasks
+    assert not any(os.path.exists(path) for path in first_segments)
+    assert storage.get_task("done")["result"] == "ok"
+    assert storage.compact() == 0  # nothing new since the snapshot
+
+    # A change to an archived task brings it back until the next snapshot.
+    storage.add_history("done", history_entry("after"))
+    storage.update_task("live", status="Processing")
+    storage.close()
+
+    storage = open_storage(tmp_path)
+    assert events(storage.get_task("done")) == ["Task created: done", "Task finalized", "after"]
+    assert storage.get_task("live")["status"] == "Processing"
+    storage.close()
+
+def test_replay_over_a_newer_archived_copy_is_idempotent(tmp_path):
+    storage = open_storage(tmp_path)
+    storage.create_task(new_task("t1"))
+    storage.finalize_task("t1", "Completed", {"result": "ok"}, history_entry("Task finalized"))
+    storage.compact()
+    storage.add_history("t1", history_entry("after"))
+    # A compaction that crashed after archiving, before writing its snapshot.
+    storage.archive.write_segment([storage.get_task("t1")])
+    storage.close()
+
+    storage = open_storage(tmp_path)
+    assert events(storage.get_task("t1")) == ["Task created: t1", "Task finalized", "after"]
+    storage.close()
+
+def test_cache_flushes_to_the_event_log(tmp_path):
+    backing = open_storage(tmp_path)
+    cache = CachedTaskStorage(backing, flush_interval=3600, durability="interval")
+    cache.create_task(new_task("t1"))
+    cache.flush()
+    cache.update_task("t1", status="Processing")
+    cache.add_history("t1", history_entry("one"))
+    cache.add_history("t1", history_entry("two"))
+    cache.flush()
+    cache.close()
+
+    storage = open_storage(tmp_path)
+    task = storage.get_task("t1")
+    assert events(task) == ["Task created: t1", "one", "two"]
+    assert task["version"] == 4
+    storage.close()
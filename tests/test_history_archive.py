@@ -0,0 +1,109 @@
+# Tests for task history compaction
+
+import datetime
+import os
+
+import pytest
+
+from src.core.blob_store import BLOB_REFERENCE_KEY, BlobStore
+from src.tasks_state.history_archive import HistoryArchive, HistoryCompactor
+from src.tasks_state.task_index import TaskIndex
+from src.tasks_state.task_storage import JsonFileTaskStorage, create_task_storage
+from tests.test_task_storage import new_task, history_entry
+
+@pytest.fixture
+def storage(tmp_path):
+    backend = JsonFileTaskStorage(str(tmp_path / "state"), str(tmp_path / "history"), fsync_policy="none")
+    backend.archive = HistoryArchive(str(tmp_path / "archive"))
+    yield backend
+    backend.close()
+
+def finalize(storage, task_id: str, status: str = "Completed", timestamp: str = None, result=None):
+    storage.create_task(new_task(task_id))
+    entry = history_entry("Task finalized")
+    if timestamp:
+        entry["timestamp"] = timestamp
+    storage.finalize_task(task_id, status, {"result": task_id if result is None else result}, entry)
+
+def test_finalized_files_are_archived_and_still_readable(storage):
+    for n in range(5):
+        finalize(storage, f"t{n}")
+    compactor = HistoryCompactor(storage, storage.archive, batch_size=2, min_age=0)
+    assert compactor.compact_once() == 5
+    assert os.listdir(storage.history_dir) == []
+    assert storage.get_task("t3")["result"] == "t3"
+
+def test_a_file_replaced_after_it_was_read_is_kept(storage):
+    finalize(storage, "t1")
+    compactor = HistoryCompactor(storage, storage.archive, min_age=0)
+    write_segment = storage.archive.write_segment
+
+    def write_then_race(tasks):
+        written = write_segment(tasks)
+        # A writer replaces the file between the read and the removal.
+        storage.finalize_task("t1", "Failed", {"error": "late"}, history_entry("Task finalized again"))
+        return written
+
+    storage.archive.write_segment = write_then_race
+    compactor.compact_once()
+    assert storage.get_task("t1")["error"] == "late"
+
+    storage.archive.write_segment = write_segment
+    assert compactor.compact_once() == 1
+    assert storage.get_task("t1")["error"] == "late"
+    assert os.listdir(storage.history_dir) == []
+
+def test_expired_tasks_leave_the_archive_and_the_task_index(storage, tmp_path):
+    old = (datetime.datetime.now() - datetime.timedelta(days=40)).isoformat()
+    finalize(storage, "old", timestamp=old)
+    finalize(storage, "new")
+    task_index = TaskIndex(str(tmp_path / "task_index.db"))
+    for task_id in ("old", "new"):
+        task_index.record(task_id, old, status="Completed", final=True)
+
+    compactor = HistoryCompactor(storage, storage.archive, min_age=0, retention_days={"Completed": 30})
+    compactor.on_expired = task_index.remove
+    compactor.compact_once()
+    expired = storage.archive.expire(compactor.retention_days)
+    compactor.on_expired(expired)
+
+    assert expired == ["old"]
+    assert storage.get_task("old") is None
+    assert storage.get_task("new") is not None
+    assert [task["task_id"] for task in task_index.query()[0]] == ["new"]
+    assert task_index.status_counts() == {"Completed": 1}
+    task_index.close()
+
+def test_blobs_of_expired_tasks_are_deleted_once_nothing_references_them(storage, tmp_path):
+    blob_store = BlobStore(base_dir=str(tmp_path / "blobs"), threshold_bytes=64, enabled=True)
+    only_old, shared, recent = blob_store.put("a" * 100), blob_store.put("b" * 100), blob_store.put("c" * 100)
+    for reference in (only_old, shared, recent):
+        os.utime(blob_store._path_for(reference[BLOB_REFERENCE_KEY]), (1000, 1000))
+    # A live task stored the same content recently.
+    blob_store.put("c" * 100)
+
+    old = (datetime.datetime.now() - datetime.timedelta(days=40)).isoformat()
+    finalize(storage, "old", timestamp=old, result=[only_old, shared, recent])
+    finalize(storage, "new", result=[shared])
+
+    compactor = HistoryCompactor(storage, storage.archive, min_age=0, retention_days={"Completed": 30})
+    compactor.blob_store = blob_store
+    compactor.compact_once()
+    expired = storage.archive.expire(compactor.retention_days)
+    assert compactor.release_blobs(expired) == 1
+
+    assert not blob_store.exists(only_old[BLOB_REFERENCE_KEY])
+    # Still referenced by the archived "new" task.
+    assert blob_store.exists(shared[BLOB_REFERENCE_KEY])
+    assert blob_store.exists(recent[BLOB_REFERENCE_KEY])
+    assert storage.archive.release_blobs(["new"]) == [shared[BLOB_REFERENCE_KEY]]
+
+def test_compaction_is_ignored_for_other_backends(configure, tmp_path, capsys):
+    configure("task_state", {
+        "backend": "sqlite",
+        "sqlite_path": str(tmp_path / "tasks.db"),
+        "compaction": {"enabled": True},
+    })
+    storage = create_task_storage(str(tmp_path / "state"), str(tmp_path / "history"))
+    assert "only applies to the 'json' backend" in capsys.readouterr().out
+    storage.close()
@@ -0,0 +1,80 @@
+# Tests for the in-memory MCP broker
+
+import threading
+import time
+
+import pytest
+
+from src.core.in_memory_mcp_handler import InMemoryMCPHandler
+from src.core.mcp_codec import OBJECT_CONTENT_TYPE
+
+def wait_for(condition, timeout: float = 5.0) -> bool:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return condition()
+
+@pytest.fixture
+def broker():
+    handler = InMemoryMCPHandler()
+    handler.consumer_workers = 1
+    handler.connect()
+    yield handler
+    handler.close()
+
+def queue_stats(broker, queue_name):
+    return broker.get_publisher_pool_stats()["queues"][queue_name]
+
+def test_messages_are_handed_over_as_objects_in_order(broker):
+    received = []
+    broker.subscribe_to_channel("work", lambda message, content_type: received.append((message, content_type)))
+    message = {"task_id": "t-1"}
+    assert broker.publish_batch("work", [message, {"task_id": "t-2"}, {"task_id": "t-3"}]) == [True, True, True]
+    broker.start_consuming()
+
+    assert wait_for(lambda: len(received) == 3)
+    assert [message["task_id"] for message, _ in received] == ["t-1", "t-2", "t-3"]
+    assert received[0][0] is message and received[0][1] == OBJECT_CONTENT_TYPE
+    assert queue_stats(broker, "work") == {"ready": 0, "unacked": 0}
+
+def test_publishing_needs_a_connected_broker():
+    handler = InMemoryMCPHandler()
+    assert not handler.publish_message("work", {"n": 1})
+
+def test_a_full_queue_rejects_messages_after_the_publish_timeout(broker):
+    broker.queue_maxsize = 2
+    broker.publish_timeout = 0.05
+    assert broker.publish_batch("work", [{"n": 1}, {"n": 2}, {"n": 3}]) == [True, True, False]
+
+def test_a_publisher_blocked_on_a_full_queue_resumes_when_a_message_is_taken(broker):
+    broker.queue_maxsize = 1
+    broker.publish_timeout = 5
+    broker.publish_message("work", {"n": 1})
+    published = []
+    publisher = threading.Thread(target=lambda: published.append(broker.publish_message("work", {"n": 2})))
+    publisher.start()
+
+    received = []
+    broker.subscribe_to_channel("work", lambda message, content_type: received.append(message["n"]))
+    broker.start_consuming()
+    publisher.join(timeout=2)
+    assert published == [True]
+    assert wait_for(lambda: received == [1, 2])
+
+def test_nacked_deliveries_are_requeued_at_the_head_or_dead_lettered(broker):
+    broker.subscribe_to_channel("work", lambda message, content_type: None)
+    broker.publish_batch("work", [{"n": 1}, {"n": 2}])
+    with broker._cond:
+        queue, delivery_tag, message = broker._next_delivery()
+    assert message == {"n": 1} and queue_stats(broker, "work") == {"ready": 1, "unacked": 1}
+
+    broker.nack("work", delivery_tag, requeue=True)
+    with broker._cond:
+        queue, delivery_tag, message = broker._next_delivery()
+    assert message == {"n": 1}
+
+    broker.nack("work", delivery_tag)
+    assert queue_stats(broker, "work") == {"ready": 1, "unacked": 0}
+    assert broker.get_publisher_pool_stats()["dead_letters"] == 1
@@ -0,0 +1,139 @@
+# Tests for load balancer rule compilation and selection
+
+import random
+import re
+
+import pytest
+
+from src.load_balancer.keyword_matcher import KeywordMatcher
+from src.load_balancer.rules import RuleSet, RuleSyntaxError, compile_condition, normalize_agent
+
+ENGINES = ["tiny", "coder", "writer", "large", "default"]
+
+def rule_set(rules, engines=ENGINES, default="default"):
+    return RuleSet([{"condition": condition, "engine": engine} for condition, engine in rules], engines, default)
+
+def test_clauses_are_parsed():
+    rule = compile_condition(
+        "agent.is_one_of(['Fast-Coder-Agent', 'DebugAgent']) and prompt.contains('Bug') "
+        "and prompt.contains_any(['sql', 'index']) and prompt.matches('def \\\\w+') and prompt.tokens <= 512",
+        "coder",
+    )
+    assert rule.agents == {"fastcoderagent", "debugagent"}
+    assert rule.keywords == ("bug",)
+    assert rule.keyword_sets == (("sql", "index"),)
+    assert rule.regexes[0].flags & re.IGNORECASE
+    assert rule.measures[0][0] == "tokens"
+
+@pytest.mark.parametrize("condition", [
+    "",
+    "prompt.contains('')",
+    "agent.is('A') or agent.is('B')",
+    "agent.is_one_of('A')",
+    "agent.is('A') and",
+    "prompt.contains_any([])",
+    "prompt.matches('(')",
+    "prompt.length >> 3",
+])
+def test_invalid_conditions_are_rejected(condition):
+    with pytest.raises(RuleSyntaxError):
+        compile_condition(condition, "coder")
+
+def test_invalid_rules_and_unavailable_engines_are_skipped():
+    rules = rule_set([("agent.is('A') or", "coder"), ("agent.is('A')", "missing"), ("agent.is('A')", "writer")])
+    assert len(rules.rules) == 1
+    assert rules.select("A", "") == "writer"
+
+def test_agents_match_by_class_name_or_role():
+    assert normalize_agent("Fast-Coder-Agent") == normalize_agent("FastCoderAgent")
+    rules = rule_set([("agent.is('FastCoderAgent')", "tiny")])
+    assert rules.select("Fast-Coder-Agent", "anything") == "tiny"
+    assert rules.select("Writing-Agent", "anything") == "default"
+    assert rules.select(None, None) == "default"
+
+def test_first_matching_rule_wins():
+    rules = rule_set([
+        ("agent.is('Writing-Agent') and prompt.contains('SQL') and prompt.contains('index')", "coder"),
+        ("agent.is_one_of(['Writing-Agent', 'Chat-Agent']) and prompt.contains('poem')", "writer"),
+        ("agent.is('Writing-Agent')", "tiny"),
+        ("agent.is('Writing-Agent') and prompt.contains('story')", "coder"),  # unreachable
+        ("prompt.contains('story')", "large"),
+    ])
+    assert rules.select("Writing-Agent", "Tune this sql INDEX, then a poem") == "coder"
+    assert rules.select("Writing-Agent", "write a POEM") == "writer"
+    assert rules.select("Chat-Agent", "write a poem") == "writer"
+    assert rules.select("Writing-Agent", "a story") == "tiny"
+    assert rules.select("Chat-Agent", "a story") == "large"
+    assert rules.select("Chat-Agent", "hello") == "default"
+    # Rules after an agent-only rule can never win for that agent.
+    assert len(rules.route_for("Writing-Agent").rules) == 2
+
+def test_extended_conditions_keep_rule_order():
+    rules = rule_set([
+        ("agent.is('Writing-Agent') and prompt.contains_all(['sql', 'index'])", "coder"),
+        ("agent.is('Writing-Agent') and prompt.contains_any(['poem', 'story'])", "writer"),
+        ("agent.is('Writing-Agent') and prompt.length > 100", "large"),
+        ("agent.is('Writing-Agent')", "tiny"),
+        ("agent.is('Writing-Agent') and prompt.contains('poem')", "coder"),  # unreachable
+    ])
+    assert rules.select("Writing-Agent", "Tune this SQL INDEX, then a poem") == "coder"
+    assert rules.select("Writing-Agent", "write a short STORY") == "writer"
+    assert rules.select("Writing-Agent", "x" * 101) == "large"
+    assert rules.select("Writing-Agent", "hello") == "tiny"
+    assert len(rules.route_for("Writing-Agent").rules) == 3
+
+def test_keyword_matcher_finds_overlapping_keywords():
+    matcher = KeywordMatcher({"he": 1, "she": 2, "his": 4, "hers": 8})
+    assert matcher.find("ushers") == 1 | 2 | 8
+    assert matcher.find("nothing") == 0
+
+def reference_select(rules: list[tuple], agent: str, prompt: str, unavailable: frozenset = frozenset()) -> str | None:
+    """Evaluates every rule in order, without any of RuleSet's indexing."""
+    lowered = prompt.lower()
+    for condition, engine in rules:
+        if engine in unavailable:
+            continue
+        clauses = condition.split(" and ")
+        if all(_holds(clause, agent, prompt, lowered) for clause in clauses):
+            return engine
+    return next((engine for engine in ["default"] + ENGINES if engine not in unavailable), None)
+
+def _holds(clause: str, agent: str, prompt: str, lowered: str) -> bool:
+    argument = re.search(r"\((.*)\)", clause)
+    names = re.findall(r"'([^']*)'", clause)
+    if clause.startswith("agent.is_one_of") or clause.startswith("agent.is("):
+        return normalize_agent(agent) in {normalize_agent(name) for name in names}
+    if clause.startswith("prompt.contains_any"):
+        return any(name in lowered for name in names)
+    if clause.startswith("prompt.contains_all") or clause.startswith("prompt.contains("):
+        return all(name in lowered for name in names)
+    assert argument is None and clause.startswith("prompt.length > ")
+    return len(prompt) > int(clause.rsplit(" ", 1)[1])
+
+def test_selection_matches_a_naive_evaluation():
+    random_state = random.Random(7)
+    words = ["bug", "sql", "index", "poem", "story", "code", "test", "plan"]
+    agents = ["A", "B", "C-Agent", "D"]
+    for _ in range(200):
+        rules = []
+        for _ in range(random_state.randint(1, 12)):
+            clauses = []
+            if random_state.random() < 0.7:
+                clauses.append(f"agent.is_one_of({random_state.sample(agents, random_state.randint(1, 2))!r})")
+            kind = random_state.random()
+            if kind < 0.3:
+                clauses.append(f"prompt.contains('{random_state.choice(words)}')")
+            elif kind < 0.5:
+                clauses.append(f"prompt.contains_any({random_state.sample(words, 2)!r})")
+            elif kind < 0.6:
+                clauses.append(f"prompt.contains_all({random_state.sample(words, 2)!r})")
+            elif kind < 0.7:
+                clauses.append(f"prompt.length > {random_state.randint(10, 60)}")
+            if not clauses:
+                clauses.append(f"agent.is('{random_state.choice(agents)}')")
+            rules.append((" and ".join(clauses), random_state.choice(ENGINES)))
+        compiled = rule_set(rules)
+        for _ in range(10):
+            agent = random_state.choice(agents + ["Other"])
+            prompt = " ".join(random_state.choice(words).upper() for _ in range(random_state.randint(0, 8)))
+            assert compiled.select(agent, prompt) == reference_select(rules, agent, prompt), (rules, agent, prompt)
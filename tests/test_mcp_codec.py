@@ -0,0 +1,43 @@
+# Tests for MCP message codecs
+
+import pytest
+
+from src.core import mcp_codec
+from src.core.mcp_codec import (
+    JSON_CONTENT_TYPE, MSGPACK_CONTENT_TYPE, OBJECT_CONTENT_TYPE, MessageDecodeError, decode_message, get_codec,
+)
+
+MESSAGE = {"task_id": "t-1", "payload": {"prompt": "héllo", "steps": [1, 2.5, None, True]}}
+
+@pytest.mark.parametrize("name", sorted(mcp_codec.CODECS))
+def test_available_codecs_round_trip_through_their_content_type(name):
+    codec = get_codec(name)
+    body = codec.encode(MESSAGE)
+    assert isinstance(body, bytes)
+    assert decode_message(body, codec.content_type) == MESSAGE
+
+def test_json_codecs_share_a_wire_format():
+    body = get_codec("json").encode(MESSAGE)
+    assert decode_message(body, JSON_CONTENT_TYPE) == MESSAGE
+    if "orjson" in mcp_codec.CODECS:
+        assert get_codec("json").decode(get_codec("orjson").encode(MESSAGE)) == MESSAGE
+
+def test_messages_without_a_content_type_are_json():
+    assert decode_message(b'{"task_id": "t-1"}') == {"task_id": "t-1"}
+
+def test_objects_from_the_in_memory_broker_are_passed_through():
+    assert decode_message(MESSAGE, OBJECT_CONTENT_TYPE) is MESSAGE
+
+def test_unavailable_codecs_fall_back_to_json(monkeypatch):
+    monkeypatch.delitem(mcp_codec.CODECS, "msgpack", raising=False)
+    assert get_codec("msgpack").name == "json"
+    assert get_codec(None).name == "json"
+
+def test_undecodable_bodies_raise_message_decode_error(monkeypatch):
+    with pytest.raises(MessageDecodeError):
+        decode_message(b"{not json", JSON_CONTENT_TYPE)
+    with pytest.raises(MessageDecodeError):
+        decode_message(b"\x00", "text/plain")
+    monkeypatch.delitem(mcp_codec.DECODERS, MSGPACK_CONTENT_TYPE, raising=False)
+    with pytest.raises(MessageDecodeError):
+        decode_message(b"\x81", MSGPACK_CONTENT_TYPE)
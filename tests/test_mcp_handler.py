@@ -0,0 +1,92 @@
+# Tests for MCPHandler's consumer worker pool and message settlement
+
+import threading
+import types
+
+import pytest
+
+pika = pytest.importorskip("pika")
+
+from src.core.mcp_handler import MCPHandler
+from tests.test_mcp_retries import wait_for
+
+class ConsumerConnection:
+    """Stands in for the consumer thread's connection: records the callbacks scheduled onto it."""
+    def __init__(self, is_open=True):
+        self.is_open = is_open
+        self.scheduled = []
+        self.delayed = []
+
+    def add_callback_threadsafe(self, callback):
+        if not self.is_open:
+            raise ConnectionError("connection closed")
+        self.scheduled.append(callback)
+
+    def call_later(self, delay, callback):
+        self.delayed.append((delay, callback))
+
+    def run_scheduled(self):
+        scheduled, self.scheduled = self.scheduled, []
+        for callback in scheduled:
+            callback()
+
+class ConsumerChannel:
+    def __init__(self, connection=None):
+        self.connection = connection or ConsumerConnection()
+        self.settled = []
+
+    def basic_ack(self, delivery_tag):
+        self.settled.append(("ack", delivery_tag, threading.current_thread().name))
+
+    def basic_nack(self, delivery_tag, requeue):
+        self.settled.append(("nack", delivery_tag, requeue))
+
+def deliver(handler, channel, queue_name, delivery_tag, priority=None):
+    handler._on_message(
+        queue_name, channel, types.SimpleNamespace(delivery_tag=delivery_tag),
+        pika.BasicProperties(content_type="application/json", priority=priority, headers={}), b"{}",
+    )
+
+def test_messages_are_handled_on_worker_threads_and_acked_on_the_consumer_thread():
+    handler = MCPHandler()
+    handler.consumer_workers = 2
+    threads = []
+    handler.callbacks["work"] = lambda body, content_type: threads.append(threading.current_thread().name)
+    channel = ConsumerChannel()
+    for delivery_tag in (1, 2, 3):
+        deliver(handler, channel, "work", delivery_tag)
+
+    assert wait_for(lambda: len(channel.connection.scheduled) == 3)
+    assert all(name.startswith("mcp-worker-default-") for name in threads)
+    # Workers never touch the channel: the acks run when the consumer thread picks them up.
+    assert channel.settled == []
+    channel.connection.run_scheduled()
+    assert sorted(tag for _, tag, _ in channel.settled) == [1, 2, 3]
+    assert all(thread == threading.current_thread().name for _, _, thread in channel.settled)
+
+def test_a_message_without_callback_is_acked():
+    handler = MCPHandler()
+    channel = ConsumerChannel()
+    handler._process_message("work", channel, 4, pika.BasicProperties(headers={}), b"{}")
+    channel.connection.run_scheduled()
+    assert [entry[:2] for entry in channel.settled] == [("ack", 4)]
+
+def test_a_delayed_nack_is_scheduled_through_call_later():
+    handler = MCPHandler()
+    channel = ConsumerChannel()
+    handler._settle(channel, 5, False, requeue=True, delay=0.5)
+    channel.connection.run_scheduled()
+    [(delay, nack)] = channel.connection.delayed
+    assert delay == 0.5 and channel.settled == []
+    nack()
+    assert channel.settled == [("nack", 5, True)]
+
+    handler._settle(channel, 6, False)
+    channel.connection.run_scheduled()
+    assert channel.settled[-1] == ("nack", 6, False)
+
+def test_settling_on_a_closed_connection_is_left_to_redelivery():
+    handler = MCPHandler()
+    channel = ConsumerChannel(ConsumerConnection(is_open=False))
+    handler._settle(channel, 7, True)
+    assert channel.settled == []
@@ -0,0 +1,167 @@
+# Tests for MCP message retries and dead letters
+
+import functools
+import threading
+import time
+import types
+
+import pytest
+
+from src.core.in_memory_mcp_handler import InMemoryMCPHandler
+
+def wait_for(condition, timeout: float = 5.0) -> bool:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return condition()
+
+@pytest.fixture
+def broker():
+    handler = InMemoryMCPHandler()
+    handler.retry_policy.max_attempts = 3
+    handler.retry_policy.delays_ms = [10, 20]
+    handler.connect()
+    yield handler
+    handler.close()
+
+def test_failed_message_is_retried_then_succeeds(broker):
+    calls = []
+
+    def callback(message, content_type):
+        calls.append(message)
+        if len(calls) < 3:
+            raise RuntimeError("transient")
+
+    broker.subscribe_to_channel("work", callback)
+    broker.start_consuming()
+    broker.publish_message("work", {"n": 1})
+    assert wait_for(lambda: len(calls) == 3)
+    time.sleep(0.05)
+    assert len(calls) == 3
+    assert broker.list_dead_letters() == []
+
+def test_message_is_dead_lettered_after_max_attempts_and_replayed(broker):
+    calls = []
+    fail = threading.Event()
+    fail.set()
+
+    def callback(message, content_type):
+        calls.append(message)
+        if fail.is_set():
+            raise RuntimeError("permanent")
+
+    broker.subscribe_to_channel("work", callback)
+    broker.start_consuming()
+    broker.publish_message("work", {"n": 1})
+    assert wait_for(lambda: len(broker.list_dead_letters()) == 1)
+    dead_letter = broker.list_dead_letters("work")[0]
+    assert dead_letter["attempts"] == 3
+    assert dead_letter["last_error"] == "permanent"
+    assert len(calls) == 3
+
+    fail.clear()
+    assert broker.replay_dead_letters("work") == 1
+    assert wait_for(lambda: len(calls) == 4)
+    assert broker.list_dead_letters() == []
+
+def test_nack_without_requeue_dead_letters(broker):
+    # Subscribed but not consuming, so the delivery is taken by hand.
+    broker.subscribe_to_channel("work", lambda message, content_type: None)
+    broker.publish_message("work", {"n": 1})
+    with broker._cond:
+        _, delivery_tag, _ = broker._next_delivery()
+    broker.nack("work", delivery_tag, requeue=False)
+    assert broker.list_dead_letters("work")[0]["last_error"] == "rejected"
+
+class _ConflictingStateManager:
+    """Fails the first `conflicts` feedback updates, like a lost compare-and-swap."""
+    def __init__(self, conflicts: int):
+        self.conflicts = conflicts
+        self.updates = []
+
+    def update_task_state(self, task_id, new_status=None, new_payload=None):
+        if self.conflicts:
+            self.conflicts -= 1
+            raise RuntimeError("version conflict")
+        self.updates.append((task_id, new_status))
+
+    def add_history(self, task_id, event, details=None):
+        pass
+
+def _feedback_handler(conflicts: int):
+    for module in ("pika", "aio_pika", "ollama", "openai"):
+        pytest.importorskip(module)
+    from src.core.orchestration_engine import OrchestrationEngine
+
+    engine = types.SimpleNamespace(task_state_manager=_ConflictingStateManager(conflicts), metrics_collector=None)
+    return engine, functools.partial(OrchestrationEngine.handle_feedback_message, engine)
+
+def test_failed_feedback_is_retried(broker):
+    engine, handle_feedback = _feedback_handler(conflicts=1)
+    broker.subscribe_to_channel("feedback", handle_feedback)
+    broker.start_consuming()
+    broker.publish_message("feedback", {"task_id": "t1", "status": "In Progress"})
+    assert wait_for(lambda: engine.task_state_manager.updates == [("t1", "In Progress")])
+    assert broker.list_dead_letters() == []
+
+def test_undecodable_feedback_is_not_retried():
+    engine, handle_feedback = _feedback_handler(conflicts=0)
+    handle_feedback(b"{not json", "application/json")
+    assert engine.task_state_manager.updates == []
+
+class _Connection:
+    """Records what MCPHandler schedules onto the consumer thread."""
+    def __init__(self):
+        self.scheduled = []
+        self.delayed = []
+
+    def add_callback_threadsafe(self, callback):
+        self.scheduled.append(callback)
+
+    def call_later(self, delay, callback):
+        self.delayed.append((delay, callback))
+
+class _Channel:
+    def __init__(self):
+        self.connection = _Connection()
+        self.settled = []
+
+    def basic_ack(self, delivery_tag):
+        self.settled.append(("ack", delivery_tag))
+
+    def basic_nack(self, delivery_tag, requeue):
+        self.settled.append(("nack", delivery_tag, requeue))
+
+def _rabbitmq_handler(publish_succeeds: bool):
+    pika = pytest.importorskip("pika")
+    from src.core.mcp_handler import MCPHandler
+
+    handler = MCPHandler()
+    handler.retry_policy.requeue_delay_ms = 250
+    handler._publish_raw = lambda exchange, routing_key, body, properties: publish_succeeds
+    handler.callbacks["work"] = lambda body, content_type: (_ for _ in ()).throw(RuntimeError("boom"))
+    return handler, pika.BasicProperties(content_type="application/json", headers={})
+
+def test_rabbitmq_failed_republish_is_requeued_after_a_delay():
+    handler, properties = _rabbitmq_handler(publish_succeeds=False)
+    channel = _Channel()
+    handler._process_message("work", channel, 7, properties, b"{}")
+
+    # Nothing is nacked right away: the nack is scheduled after the back-off.
+    assert len(channel.connection.scheduled) == 1
+    channel.connection.scheduled[0]()
+    assert channel.settled == []
+    delay, nack = channel.connection.delayed[0]
+    assert delay == 0.25
+    nack()
+    assert channel.settled == [("nack", 7, True)]
+
+def test_rabbitmq_retried_message_is_acked():
+    handler, properties = _rabbitmq_handler(publish_succeeds=True)
+    channel = _Channel()
+    handler._process_message("work", channel, 7, properties, b"{}")
+    channel.connection.scheduled[0]()
+    assert channel.settled == [("ack", 7)]
+    assert channel.connection.delayed == []
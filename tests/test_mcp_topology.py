@@ -0,0 +1,84 @@
+# Tests for the MCP topology registry
+
+import pytest
+
+from src.core.mcp_topology import FEEDBACK_QUEUE, INBOUND_QUEUE, TopologyRegistry
+
+class StubConnection:
+    is_open = True
+
+class DeclaringChannel:
+    """Records the declarations made on it."""
+    def __init__(self, connection=None):
+        self.connection = connection
+        self.is_open = True
+        self.declared = []
+        self.published = []
+
+    def exchange_declare(self, exchange, **options):
+        self.declared.append(("exchange", exchange))
+
+    def queue_declare(self, queue, **options):
+        self.declared.append(("queue", queue))
+
+    def queue_bind(self, queue, exchange, routing_key):
+        self.declared.append(("binding", queue, exchange, routing_key))
+
+    def basic_publish(self, exchange, routing_key, body, properties):
+        self.published.append((exchange, routing_key))
+
+def test_declare_all_declares_exchanges_then_queues_then_bindings():
+    topology = TopologyRegistry()
+    topology.register_binding("audit", "events", "task.done")
+    topology.register_exchange("events")
+    topology.register_queue("audit")
+    channel = DeclaringChannel()
+    topology.declare_all(channel)
+    assert channel.declared == [
+        ("exchange", "events"),
+        ("queue", INBOUND_QUEUE), ("queue", FEEDBACK_QUEUE), ("queue", "audit"),
+        ("binding", "audit", "events", "task.done"),
+    ]
+
+def test_registering_twice_keeps_one_declaration():
+    topology = TopologyRegistry()
+    topology.register_queue("audit")
+    topology.register_queue("audit")
+    topology.register_binding("audit", "events", "task.done")
+    topology.register_binding("audit", "events", "task.done")
+    assert list(topology.queues).count("audit") == 1
+    assert topology.bindings == [("audit", "events", "task.done")]
+
+def test_a_queue_is_declared_on_first_use_only():
+    topology = TopologyRegistry()
+    channel = DeclaringChannel()
+    topology.ensure_queue(channel, "replies")
+    topology.ensure_queue(channel, "replies")
+    topology.ensure_queue(channel, INBOUND_QUEUE)
+    assert channel.declared == [("queue", "replies")]
+    assert topology.is_registered("replies")
+
+def test_publishing_declares_the_topology_once_per_connection():
+    pytest.importorskip("pika")
+    from src.core.channel_pool import PublisherChannelPool
+    from src.core.mcp_handler import MCPHandler
+
+    handler = MCPHandler()
+    pool = PublisherChannelPool("localhost", size=1, on_open=handler.topology.declare_all)
+    opened = []
+
+    def open_channel():
+        channel = DeclaringChannel(StubConnection())
+        pool.on_open(channel)
+        opened.append(channel)
+        return channel.connection, channel
+    pool._open_channel = open_channel
+    handler.publisher_pool = pool
+
+    for _ in range(3):
+        assert handler.publish_message(INBOUND_QUEUE, {"task_id": "t1"})
+    assert handler.publish_message("replies", {"task_id": "t1"})
+    [channel] = opened
+    assert len(channel.published) == 4
+    declared_queues = [entry[1] for entry in channel.declared if entry[0] == "queue"]
+    assert declared_queues.count(INBOUND_QUEUE) == 1 and declared_queues.count("replies") == 1
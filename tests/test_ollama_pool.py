@@ -0,0 +1,188 @@
+# Tests for the Ollama endpoint pool's scheduling
+
+import threading
+import time
+
+import pytest
+
+pytest.importorskip("ollama")
+
+from src.llm_engines.local.ollama_pool import EndpointPool, NoEndpointError, OllamaEndpoint, _Waiter
+
+class StubClient:
+    """Answers list() and ps() like an Ollama host with the given pulled and loaded models."""
+    def __init__(self, models=(), running=(), reachable=True):
+        self.models = list(models)
+        self.running = list(running)
+        self.reachable = reachable
+
+    def list(self):
+        if not self.reachable:
+            raise ConnectionError("refused")
+        return {"models": [{"model": model} for model in self.models]}
+
+    def ps(self):
+        return {"models": [{"model": model} for model in self.running]}
+
+class Recorder:
+    """Stands in for a waiter's condition, counting the wakeups it gets."""
+    def __init__(self):
+        self.notified = 0
+
+    def notify(self):
+        self.notified += 1
+
+def endpoint(url, max_concurrency=1, resident=(), **kwargs):
+    host = OllamaEndpoint(url, max_concurrency=max_concurrency, client=StubClient(), **kwargs)
+    host.set_resident([f"{model}:latest" for model in resident])
+    return host
+
+class Waiting:
+    """An acquire() call running in its own thread."""
+    def __init__(self, pool, model, exclude=()):
+        self.endpoint = self.error = None
+        self.finished_at = None
+        waiting = len(pool._waiting)
+        self.thread = threading.Thread(target=self._run, args=(pool, model, exclude), daemon=True)
+        self.thread.start()
+        deadline = time.monotonic() + 2
+        while len(pool._waiting) <= waiting and self.thread.is_alive() and time.monotonic() < deadline:
+            time.sleep(0.001)
+
+    def _run(self, pool, model, exclude):
+        try:
+            self.endpoint = pool.acquire(model, exclude)
+        except NoEndpointError as e:
+            self.error = e
+        self.finished_at = time.monotonic()
+
+    def join(self):
+        self.thread.join(timeout=2)
+        assert not self.thread.is_alive()
+        return self
+
+def test_least_outstanding_spreads_calls_and_respects_concurrency_limits():
+    pool = EndpointPool(acquire_timeout=0.05, residency_aware=False)
+    first, second = pool.add(endpoint("http://a", 2)), pool.add(endpoint("http://b", 1))
+    taken = [pool.acquire("tinyllama") for _ in range(3)]
+    assert sorted(host.url for host in taken) == ["http://a", "http://a", "http://b"]
+    assert (first.outstanding, second.outstanding) == (2, 1)
+
+    with pytest.raises(NoEndpointError) as raised:
+        pool.acquire("tinyllama")
+    assert raised.value.busy
+    pool.release(second, 0.1, True)
+    assert pool.acquire("tinyllama") is second
+
+def test_a_freed_slot_goes_to_the_waiting_call_whose_model_is_loaded():
+    pool = EndpointPool(acquire_timeout=2)
+    host = pool.add(endpoint("http://a", resident=["phi3"]))
+    pool.acquire("phi3")
+    other = Waiting(pool, "tinyllama")
+    same = Waiting(pool, "phi3")
+
+    pool.release(host, 0.1, True)
+    same.join()
+    assert same.endpoint is host and other.endpoint is None
+    assert host.model_loads == 0
+
+    pool.release(host, 0.1, True)
+    other.join()
+    assert other.endpoint is host
+    assert (host.model_loads, host.model_swaps) == (1, 1)
+
+def test_a_waiting_call_is_overtaken_at_most_fairness_window_times():
+    pool = EndpointPool(acquire_timeout=2, fairness_window=1)
+    host = pool.add(endpoint("http://a", resident=["phi3"]))
+    pool.acquire("phi3")
+    head = Waiting(pool, "tinyllama")
+    overtaking = [Waiting(pool, "phi3") for _ in range(2)]
+
+    pool.release(host, 0.1, True)
+    overtaking[0].join()
+    assert pool._waiting[0].skips == 1
+
+    pool.release(host, 0.1, True)
+    head.join()
+    assert head.endpoint is host and overtaking[1].endpoint is None
+    pool.release(host, 0.1, True)
+    overtaking[1].join()
+
+def test_a_freed_slot_wakes_only_the_waiting_call_it_goes_to():
+    pool = EndpointPool()
+    host = pool.add(endpoint("http://a", resident=["phi3"]))
+    waiters = [_Waiter(model, (), pool._lock) for model in ("tinyllama:latest", "phi3:latest", "mistral:latest")]
+    for waiter in waiters:
+        waiter.wake = Recorder()
+    pool._waiting.extend(waiters)
+
+    with pool._lock:
+        pool._dispatch()
+    assert [waiter.wake.notified for waiter in waiters] == [0, 1, 0]
+
+    # A busy endpoint wakes no one.
+    host.outstanding = 1
+    with pool._lock:
+        pool._dispatch()
+    assert [waiter.wake.notified for waiter in waiters] == [0, 1, 0]
+
+def test_waiting_calls_fail_at_once_when_their_endpoint_is_removed():
+    pool = EndpointPool(acquire_timeout=5)
+    pool.add(endpoint("http://a"))
+    pool.acquire("tinyllama")
+    waiting = Waiting(pool, "tinyllama")
+    removed_at = time.monotonic()
+    assert pool.remove("http://a")
+
+    waiting.join()
+    assert isinstance(waiting.error, NoEndpointError) and not waiting.error.busy
+    assert waiting.finished_at - removed_at < 1
+
+def test_failed_calls_take_an_endpoint_out_and_fail_over():
+    pool = EndpointPool(max_failures=1, cooldown=60, residency_aware=False)
+    first, second = pool.add(endpoint("http://a")), pool.add(endpoint("http://b"))
+    taken = pool.acquire("tinyllama")
+    pool.release(taken, 0.1, False, "500")
+    assert taken.stats()["down"]
+    assert pool.acquire("tinyllama") is ({first, second} - {taken}).pop()
+
+def test_refresh_lists_models_and_residency():
+    pool = EndpointPool()
+    up = pool.add(OllamaEndpoint("http://a", client=StubClient(["phi3:mini", "tinyllama"], ["phi3:mini"])))
+    down = pool.add(OllamaEndpoint("http://b", client=StubClient(reachable=False)))
+    assert pool.refresh() == {"phi3:mini", "tinyllama:latest"}
+    assert list(up.resident) == ["phi3:mini"]
+    assert down.stats()["down"]
+    # Only the reachable host serves the model now.
+    assert pool.acquire("tinyllama") is up
+
+def test_use_model_evicts_the_least_recently_used_model():
+    host = endpoint("http://a", resident=["phi3", "tinyllama"], max_loaded_models=2)
+    host.use_model("phi3:latest")
+    host.use_model("mistral:latest")
+    assert list(host.resident) == ["phi3:latest", "mistral:latest"]
+    assert (host.model_loads, host.model_swaps) == (1, 1)
+
+def test_a_model_the_host_lacks_is_no_longer_counted_as_loaded():
+    pool = EndpointPool()
+    unlisted = pool.add(endpoint("http://a"))
+    listed = pool.add(endpoint("http://b"))
+    listed.models = {"phi3:mini"}
+    for host in (unlisted, listed):
+        host.use_model("phi3:mini")
+        pool.forget_model(host, "phi3:mini")
+        assert "phi3:mini" not in host.resident
+    assert listed.models == set()
+    # Unlisted, the host is still tried for the model: that call counts a new load.
+    assert unlisted.serves("phi3:mini")
+
+def test_load_and_swap_counts_are_labelled_as_estimates():
+    pool = EndpointPool()
+    host = pool.add(endpoint("http://a", resident=["phi3"]))
+    pool.release(pool.acquire("tinyllama"), 0.1, True)
+    assert {key: value for key, value in host.stats().items() if "model_" in key} == {
+        "estimated_model_loads": 1, "estimated_model_swaps": 1,
+    }
+    pool.remove("http://a")
+    stats = pool.scheduling_stats()
+    assert (stats["estimated_model_loads"], stats["estimated_model_swaps"]) == (1, 1)
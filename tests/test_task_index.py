@@ -0,0 +1,68 @@
+# Tests for the task index
+
+import datetime
+
+import pytest
+
+from src.tasks_state.task_index import TaskIndex
+
+@pytest.fixture
+def index(tmp_path):
+    task_index = TaskIndex(str(tmp_path / "task_index.db"))
+    yield task_index
+    task_index.close()
+
+def timestamp(seconds: int) -> str:
+    return (datetime.datetime(2026, 1, 1) + datetime.timedelta(seconds=seconds)).isoformat()
+
+def fill(index: TaskIndex, count: int):
+    for n in range(count):
+        index.record(f"t{n:03d}", timestamp(n), status="Pending", role="Coder" if n % 2 else "Writer")
+
+def test_pages_follow_the_cursor_newest_first(index):
+    fill(index, 25)
+    seen, cursor = [], None
+    while True:
+        tasks, cursor = index.query(limit=10, cursor=cursor)
+        seen.extend(task["task_id"] for task in tasks)
+        if cursor is None:
+            break
+    assert seen == [f"t{n:03d}" for n in reversed(range(25))]
+
+def test_ties_on_created_at_are_broken_by_task_id(index):
+    for task_id in ("b", "a", "c"):
+        index.record(task_id, timestamp(0))
+    first, cursor = index.query(limit=2)
+    second, last = index.query(limit=2, cursor=cursor)
+    assert [task["task_id"] for task in first + second] == ["c", "b", "a"]
+    assert last is None
+
+def test_filters_and_counts(index):
+    fill(index, 10)
+    index.record("t001", timestamp(100), status="Processing")
+    index.record("t002", timestamp(101), status="Completed", final=True)
+
+    tasks, _ = index.query(role="Coder", limit=100)
+    assert {task["task_id"] for task in tasks} == {"t001", "t003", "t005", "t007", "t009"}
+    assert index.count() == 10
+    assert index.count(status="Pending") == 8
+    assert index.count(role="Coder", status="Processing") == 1
+    assert index.count(created_after=timestamp(5)) == 5
+    assert index.status_counts() == {"Pending": 8, "Processing": 1, "Completed": 1}
+    # A transition keeps the creation time the listing is ordered by.
+    tasks, _ = index.query(status="Processing")
+    assert tasks[0]["created_at"] == timestamp(1)
+
+def test_malformed_cursor_is_rejected(index):
+    with pytest.raises(ValueError):
+        index.query(cursor="not-a-cursor")
+
+def test_stale_and_touch(index):
+    fill(index, 3)
+    index.record("t000", timestamp(10), status="Processing")
+    index.record("t001", timestamp(11), status="Processing")
+    index.record("t002", timestamp(12), status="Completed", final=True)
+
+    assert [row["task_id"] for row in index.stale(["Processing"], timestamp(20))] == ["t000", "t001"]
+    assert index.touch(["t000", "t002"], timestamp(30)) == {"t000"}
+    assert [row["task_id"] for row in index.stale(["Processing"], timestamp(20))] == ["t001"]
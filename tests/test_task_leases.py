@@ -0,0 +1,80 @@
+# Tests for task leases and fencing tokens
+
+import time
+
+import pytest
+
+from src.tasks_state.task_state_manager import TaskStateManager
+from src.tasks_state.task_storage import SqliteTaskStorage
+
+@pytest.fixture
+def storage(tmp_path):
+    backend = SqliteTaskStorage(str(tmp_path / "tasks.db"))
+    yield backend
+    backend.close()
+
+@pytest.fixture
+def node(configure, tmp_path):
+    """Returns a factory of TaskStateManagers, one per simulated node, sharing one database."""
+    managers = []
+
+    def make(node_id: str, ttl: float = 60, renew_interval: float = 3600) -> TaskStateManager:
+        configure("task_state", {"leases": {"enabled": True, "node_id": node_id, "ttl": ttl, "renew_interval": renew_interval}})
+        manager = TaskStateManager(base_dir=str(tmp_path), storage=SqliteTaskStorage(str(tmp_path / "tasks.db")))
+        managers.append(manager)
+        return manager
+    yield make
+    for manager in managers:
+        manager.close()
+
+def lease_of(manager, task_id):
+    return manager.get_task_state(task_id)["payload"]["lease"]
+
+def expire_lease(storage, task_id):
+    lease = storage.get_task(task_id)["payload"]["lease"]
+    storage.update_task(task_id, payload={"lease": {**lease, "expires_at": 0}})
+
+def test_held_lease_cannot_be_taken(node):
+    a, b = node("a"), node("b")
+    task_id = a.create_task_state("prompt", initial_status="Processing")
+    assert lease_of(a, task_id)["owner"] == "a"
+    assert not b.claim_task(task_id)
+
+def test_stale_owner_is_fenced_off_after_a_takeover(node, storage):
+    a, b = node("a"), node("b")
+    task_id = a.create_task_state("prompt", initial_status="Processing")
+    expire_lease(storage, task_id)
+    assert b.acquire_lease(task_id)
+    assert lease_of(b, task_id)["token"] == 2
+
+    # Node a stalled past its lease; its writes must not land.
+    a.update_task_state(task_id, new_status="Executing by Agent", new_payload={"from": "a"})
+    a.complete_task(task_id, final_result="stale result")
+    task = b.get_task_state(task_id)
+    assert task["status"] == "Processing"
+    assert "from" not in task["payload"]
+
+    b.complete_task(task_id, final_result="fresh result")
+    assert b.get_task_state(task_id)["result"] == "fresh result"
+
+def test_leases_are_renewed_without_task_recovery(node):
+    a = node("a", ttl=2, renew_interval=0.05)
+    task_id = a.create_task_state("prompt", initial_status="Processing")
+    first = lease_of(a, task_id)["expires_at"]
+    time.sleep(0.3)
+    assert lease_of(a, task_id)["expires_at"] > first
+    assert lease_of(a, task_id)["token"] == 1
+
+def test_restarted_node_takes_its_own_lease_at_once(node):
+    before = node("a")
+    task_id = before.create_task_state("prompt", initial_status="Processing")
+    after = node("a")
+    assert after.claim_task(task_id)
+    assert lease_of(after, task_id)["token"] == 2
+
+def test_close_releases_leases(node):
+    a, b = node("a"), node("b")
+    task_id = a.create_task_state("prompt", initial_status="Processing")
+    a.close()
+    assert lease_of(b, task_id)["owner"] is None
+    assert b.claim_task(task_id)
@@ -0,0 +1,104 @@
+# Tests for task priorities, priority lanes and the priority dispatcher
+
+import threading
+import time
+
+import pytest
+
+from src.core.in_memory_mcp_handler import InMemoryMCPHandler
+from src.core.mcp_topology import INBOUND_QUEUE
+from src.core.priority_dispatcher import PriorityDispatcher
+from src.core.task_priority import TaskPrioritizer
+from tests.test_mcp_retries import wait_for
+
+class StubDiagnosis:
+    def classify_intent(self, prompt):
+        return "debugging" if "error" in prompt else "chat"
+
+@pytest.fixture
+def prioritizer(configure):
+    configure("task_priorities", {
+        "max_priority": 10,
+        "default": 5,
+        "by_nature": {"debugging": 9},
+        "by_profile": {"batch": 1},
+        "lanes": [{"name": "low", "min_priority": 0}, {"name": "high", "min_priority": 7, "prefetch": 4}],
+    })
+    return TaskPrioritizer(StubDiagnosis())
+
+def test_priority_comes_from_the_request_then_the_nature_then_the_profile(prioritizer):
+    assert prioritizer.priority_for("an error", priority=2, profile="batch") == 2
+    assert prioritizer.priority_for("an error", profile="batch") == 9
+    assert prioritizer.priority_for("hello", profile="batch") == 1
+    assert prioritizer.priority_for("hello") == 5
+
+def test_priorities_are_bounded(prioritizer):
+    assert prioritizer.priority_for("hello", priority=50) == 10
+    assert prioritizer.priority_for("hello", priority=-3) == 0
+
+def test_priorities_map_to_lanes_most_urgent_first(prioritizer):
+    assert prioritizer.queue_for(9) == f"{INBOUND_QUEUE}.high"
+    assert prioritizer.queue_for(7) == f"{INBOUND_QUEUE}.high"
+    assert prioritizer.queue_for(6) == f"{INBOUND_QUEUE}.low"
+    assert prioritizer.inbound_queues() == [
+        (f"{INBOUND_QUEUE}.high", 4), (f"{INBOUND_QUEUE}.low", None), (INBOUND_QUEUE, None),
+    ]
+
+def run_in_order(dispatcher, jobs, pause=0.0):
+    """Submits (priority, label) jobs while the only worker is busy, then returns the order they ran in."""
+    started, release, ran = threading.Event(), threading.Event(), []
+    dispatcher.submit(0, lambda: (started.set(), release.wait(2)))
+    assert started.wait(2)
+    for priority, label in jobs:
+        dispatcher.submit(priority, ran.append, label)
+        time.sleep(pause)
+    release.set()
+    assert wait_for(lambda: len(ran) == len(jobs))
+    dispatcher.shutdown(wait=True)
+    return ran
+
+def test_higher_priority_jobs_run_first():
+    dispatcher = PriorityDispatcher(1, aging_rate=0.0)
+    assert run_in_order(dispatcher, [(1, "low"), (9, "high"), (5, "normal"), (9, "high again")]) == [
+        "high", "high again", "normal", "low",
+    ]
+
+def test_aging_promotes_low_priority_jobs_that_waited():
+    # At 1000 points per second, 20 ms of waiting outweighs a priority gap of 9.
+    dispatcher = PriorityDispatcher(1, aging_rate=1000.0)
+    assert run_in_order(dispatcher, [(1, "starved"), (10, "urgent")], pause=0.02) == ["starved", "urgent"]
+
+def test_a_shut_down_dispatcher_drains_its_queue_and_refuses_jobs():
+    dispatcher = PriorityDispatcher(1)
+    ran = []
+    for n in range(3):
+        dispatcher.submit(0, ran.append, n)
+    dispatcher.shutdown(wait=True)
+    assert sorted(ran) == [0, 1, 2] and dispatcher.pending() == 0
+    with pytest.raises(RuntimeError):
+        dispatcher.submit(0, ran.append, 3)
+
+@pytest.fixture
+def broker():
+    handler = InMemoryMCPHandler()
+    handler.consumer_workers = 1
+    handler.connect()
+    yield handler
+    handler.close()
+
+def test_the_in_memory_broker_delivers_by_priority(broker):
+    received = []
+    broker.subscribe_to_channel("work", lambda message, content_type: received.append(message["task_id"]))
+    broker.publish_message("work", {"task_id": "t-1"}, priority=1)
+    broker.publish_message("work", {"task_id": "t-2"}, priority=5)
+    broker.publish_message("work", {"task_id": "t-3"})
+    broker.start_consuming()
+    assert wait_for(lambda: len(received) == 3)
+    assert received == ["t-2", "t-1", "t-3"]
+
+def test_priority_does_not_bypass_the_queue_bound(broker):
+    broker.queue_maxsize = 2
+    broker.publish_timeout = 0.05
+    assert broker.publish_batch("work", [{"n": 1}, {"n": 2}]) == [True, True]
+    assert not broker.publish_message("work", {"n": 3}, priority=10)
+    assert broker.get_publisher_pool_stats()["queues"]["work"]["ready"] == 2
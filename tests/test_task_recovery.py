@@ -0,0 +1,110 @@
+# Tests for orphaned task recovery
+
+import pytest
+
+from src.tasks_state.task_index import TaskIndex
+from src.tasks_state.task_recovery import TaskRecovery
+from src.tasks_state.task_state_manager import TaskStateManager
+from src.tasks_state.task_storage import SqliteTaskStorage
+
+@pytest.fixture
+def shared(tmp_path):
+    """Task storage and index shared by the nodes of a test."""
+    storage = SqliteTaskStorage(str(tmp_path / "tasks.db"))
+    task_index = TaskIndex(str(tmp_path / "task_index.db"))
+    yield storage, task_index
+    storage.close()
+    task_index.close()
+
+@pytest.fixture
+def node(configure, shared, tmp_path):
+    """Returns a factory of TaskStateManagers (one per simulated node) over the shared state."""
+    storage, task_index = shared
+
+    def make(node_id: str, leases: bool = False) -> TaskStateManager:
+        configure("task_state", {
+            "leases": {"enabled": leases, "node_id": node_id, "ttl": 60},
+            "recovery": {"statuses": ["Processing"]},
+        })
+        return TaskStateManager(base_dir=str(tmp_path), storage=storage, task_index=task_index)
+    return make
+
+def recovery_for(manager, requeued: list, requeue_succeeds: bool = True, **kwargs) -> TaskRecovery:
+    def requeue(task_data, attempts):
+        requeued.append(task_data["task_id"])
+        return requeue_succeeds
+    return TaskRecovery(manager, requeue, statuses=["Processing"], stale_after=3600, **kwargs)
+
+def test_tasks_of_a_dead_node_are_requeued(node):
+    dead = node("a")
+    task_ids = [dead.create_task_state(f"prompt {n}", initial_status="Processing") for n in range(3)]
+    survivor = node("b")
+    requeued = []
+    recovery = recovery_for(survivor, requeued)
+    assert recovery.recover_once(startup=True) == (3, 0)
+    assert sorted(requeued) == sorted(task_ids)
+    task = survivor.get_task_state(task_ids[0])
+    assert task["status"] == "Requeued"
+    assert task["payload"]["recovery_attempts"] == 1
+
+def test_live_tasks_are_not_recovered(node):
+    manager = node("a")
+    manager.create_task_state("prompt", initial_status="Processing")
+    requeued = []
+    assert recovery_for(manager, requeued).recover_once(startup=True) == (0, 0)
+
+def test_unrecoverable_orphans_do_not_hide_later_ones(configure, node):
+    dead = node("a", leases=True)
+    # The oldest orphans are leased to a node that is still renewing its leases.
+    held = [dead.create_task_state(f"held {n}", initial_status="Processing") for n in range(5)]
+    expired = [dead.create_task_state(f"expired {n}", initial_status="Processing") for n in range(3)]
+    for task_id in expired:
+        dead.storage.update_task(task_id, payload={"lease": {"owner": "a", "token": 1, "expires_at": 0}})
+
+    survivor = node("b", leases=True)
+    requeued = []
+    recovery = recovery_for(survivor, requeued, batch_size=2)
+    assert recovery.recover_once(startup=True) == (3, 0)
+    assert sorted(requeued) == sorted(expired)
+    assert all(survivor.get_task_state(task_id)["status"] == "Processing" for task_id in held)
+
+def test_task_is_failed_when_it_cannot_be_requeued(node):
+    dead = node("a")
+    task_id = dead.create_task_state("prompt", initial_status="Processing")
+    requeued = []
+    recovery = recovery_for(node("b"), requeued, requeue_succeeds=False)
+    assert recovery.recover_once(startup=True) == (0, 1)
+    assert dead.get_task_state(task_id)["status"] == "Failed"
+
+def test_task_is_failed_after_max_requeues(node):
+    dead = node("a")
+    task_id = dead.create_task_state("prompt", initial_status="Processing", initial_payload={"recovery_attempts": 3})
+    recovery = recovery_for(node("b"), [], max_requeues=3)
+    assert recovery.recover_once(startup=True) == (0, 1)
+    assert "Gave up after 3 requeue(s)" in dead.get_task_state(task_id)["error"]
+
+def test_only_in_progress_tasks_are_heartbeated(node):
+    manager = node("a")
+    running = manager.create_task_state("running", initial_status="Processing")
+    planned = manager.create_task_state("planned", initial_status="Processing")
+    manager.update_task_state(planned, new_status="Planned")
+    finished = manager.create_task_state("finished", initial_status="Processing")
+    manager.complete_task(finished, "done")
+    assert set(manager._live_tasks) == {running}
+    assert manager.heartbeat() == 1
+
+def test_planned_task_gives_its_lease_up(node):
+    manager = node("a", leases=True)
+    task_id = manager.create_task_state("prompt", initial_status="Processing")
+    manager.update_task_state(task_id, new_status="Planned")
+    assert task_id not in manager._live_tasks
+    assert manager.get_task_state(task_id)["payload"]["lease"]["owner"] is None
+
+def test_heartbeat_touches_tasks_in_chunks(node, shared):
+    _, task_index = shared
+    task_index.CHUNK_SIZE = 3
+    manager = node("a")
+    task_ids = [manager.create_task_state(f"prompt {n}", initial_status="Processing") for n in range(10)]
+    manager.complete_task(task_ids[4], "done")
+    assert manager.heartbeat() == 9
+    assert task_index.touch(task_ids, "9999") == set(task_ids) - {task_ids[4]}
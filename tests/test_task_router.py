@@ -0,0 +1,105 @@
+# Tests for sharding inbound tasks per agent profile
+
+import threading
+
+import pytest
+
+from src.core.in_memory_mcp_handler import InMemoryMCPHandler
+from src.core.mcp_topology import INBOUND_QUEUE
+from src.core.task_priority import TaskPrioritizer
+from src.core.task_router import TaskRouter
+from tests.test_mcp_retries import wait_for
+
+class StubDiagnosis:
+    """Classifies prompts mentioning "bug" as Developer work, like the DiagnosisAgent."""
+    def classify_intent(self, prompt):
+        return "debugging_task" if "bug" in prompt else "greeting"
+
+    def determine_target_profile_and_role(self, nature):
+        return ("Developer", "Debug-Agent") if nature == "debugging_task" else ("Unsharded", "Chat-Agent")
+
+LANES = {"lanes": [{"name": "low", "min_priority": 0}, {"name": "high", "min_priority": 7, "prefetch": 4}]}
+
+@pytest.fixture
+def router(configure):
+    configure("task_priorities", LANES)
+    configure("task_sharding", {
+        "enabled": True,
+        "exchange": "tasks",
+        "default_shard": "General",
+        "shards": {"Developer": {"workers": 4}, "General": {}},
+    })
+    return TaskRouter(TaskPrioritizer(), StubDiagnosis())
+
+def test_a_known_profile_is_its_own_shard(router):
+    assert router.route("hello", 9, profile="Developer") == ("tasks", "Developer.high")
+    assert router.route("hello", 2, profile="General") == ("tasks", "General.low")
+
+def test_the_shard_is_classified_from_the_prompt_without_a_known_profile(router):
+    assert router.route("fix this bug", 2) == ("tasks", "Developer.low")
+    assert router.route("fix this bug", 2, profile="Finance") == ("tasks", "Developer.low")
+
+def test_unknown_profiles_fall_back_to_the_default_shard(router):
+    # The classified profile has no shard either.
+    assert router.route("hello", 9, profile="Finance") == ("tasks", "General.high")
+
+def test_every_shard_has_lane_queues_in_its_own_consumer_group(router):
+    sharded = [subscription for subscription in router.inbound_subscriptions() if subscription["consumer_group"]]
+    assert {(s["queue"], s["routing_key"], s["consumer_group"], s["prefetch"]) for s in sharded} == {
+        (f"{INBOUND_QUEUE}.Developer.high", "Developer.high", "Developer", 4),
+        (f"{INBOUND_QUEUE}.Developer.low", "Developer.low", "Developer", None),
+        (f"{INBOUND_QUEUE}.Developer.default", "Developer.default", "Developer", None),
+        (f"{INBOUND_QUEUE}.General.high", "General.high", "General", 4),
+        (f"{INBOUND_QUEUE}.General.low", "General.low", "General", None),
+        (f"{INBOUND_QUEUE}.General.default", "General.default", "General", None),
+    }
+    assert all(s["exchange"] == "tasks" for s in sharded)
+    assert router.consumer_groups() == {"Developer": 4, "General": 1}
+
+def test_without_sharding_tasks_go_to_their_lane(configure):
+    configure("task_priorities", LANES)
+    configure("task_sharding", {"enabled": False, "shards": {"Developer": {}}})
+    router = TaskRouter(TaskPrioritizer(), StubDiagnosis())
+    assert router.route("fix this bug", 9) == ("", f"{INBOUND_QUEUE}.high")
+    assert all(subscription["consumer_group"] is None for subscription in router.inbound_subscriptions())
+    assert router.consumer_groups() == {}
+
+@pytest.fixture
+def broker():
+    handler = InMemoryMCPHandler()
+    handler.consumer_workers = 1
+    handler.connect()
+    yield handler
+    handler.close()
+
+def test_routed_tasks_reach_their_shard_queue(router, broker):
+    for subscription in router.inbound_subscriptions():
+        if subscription.get("exchange"):
+            broker.bind_queue(subscription["queue"], subscription["exchange"], subscription["routing_key"])
+    exchange, routing_key = router.route("fix this bug", 9)
+    assert broker.publish_to_exchange(exchange, routing_key, {"task_id": "t-1"})
+    assert not broker.publish_to_exchange(exchange, "Finance.high", {"task_id": "t-2"})
+    ready = {name: queue["ready"] for name, queue in broker.get_publisher_pool_stats()["queues"].items() if queue["ready"]}
+    assert ready == {f"{INBOUND_QUEUE}.Developer.high": 1}
+
+def test_a_busy_shard_does_not_hold_up_the_others(broker):
+    release = threading.Event()
+    threads = {}
+
+    def record(name):
+        def callback(message, content_type):
+            threads.setdefault(name, set()).add(threading.current_thread().name)
+            release.wait(2)
+        return callback
+
+    broker.configure_consumer_group("Developer", 1)
+    broker.subscribe_to_channel("developer", record("developer"), consumer_group="Developer")
+    broker.subscribe_to_channel("general", record("general"))
+    broker.start_consuming()
+    broker.publish_batch("developer", [{"n": 1}, {"n": 2}])
+    broker.publish_message("general", {"n": 1})
+    assert wait_for(lambda: "general" in threads)
+    release.set()
+    assert wait_for(lambda: broker.get_publisher_pool_stats()["queues"]["developer"] == {"ready": 0, "unacked": 0})
+    assert all(name.startswith("mcp-memory-worker-Developer-") for name in threads["developer"])
+    assert all(name.startswith("mcp-memory-worker-default-") for name in threads["general"])
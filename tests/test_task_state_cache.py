@@ -0,0 +1,112 @@
+# Tests for the write-back task state cache
+
+import pytest
+
+from src.tasks_state.task_state_cache import CachedTaskStorage
+from src.tasks_state.task_storage import SqliteTaskStorage, VersionConflictError
+from tests.test_task_storage import new_task, history_entry
+
+class FlakyStorage(SqliteTaskStorage):
+    """SQLite storage whose writes fail while `failing` is set."""
+    failing = False
+
+    def _fail(self):
+        if self.failing:
+            raise OSError("disk unavailable")
+
+    def create_task(self, task_data):
+        self._fail()
+        return super().create_task(task_data)
+
+    def update_task(self, task_id, *args, **kwargs):
+        self._fail()
+        return super().update_task(task_id, *args, **kwargs)
+
+    def add_history_batch(self, task_id, entries, version=None):
+        self._fail()
+        return super().add_history_batch(task_id, entries, version=version)
+
+    def finalize_task(self, task_id, *args, **kwargs):
+        self._fail()
+        return super().finalize_task(task_id, *args, **kwargs)
+
+@pytest.fixture
+def backing(tmp_path):
+    return FlakyStorage(str(tmp_path / "tasks.db"))
+
+def make_cache(backing, durability="interval", max_entries=100):
+    # A long interval keeps the background flusher out of the way; tests flush by hand.
+    return CachedTaskStorage(backing, flush_interval=3600, durability=durability, max_entries=max_entries)
+
+def events(task):
+    return [entry["event"] for entry in task["history"]]
+
+def test_writes_are_coalesced_until_flushed(backing):
+    cache = make_cache(backing)
+    cache.create_task(new_task("t1"))
+    cache.update_task("t1", status="Processing")
+    cache.add_history("t1", history_entry("step"))
+    assert backing.get_task("t1") is None
+    assert cache.flush() == 1
+    task = backing.get_task("t1")
+    assert task["status"] == "Processing"
+    assert events(task) == ["Task created: t1", "step"]
+    assert task["version"] == cache.get_task("t1")["version"] == 3
+    cache.close()
+
+def test_failed_flush_keeps_changes_ahead_of_newer_ones(backing):
+    cache = make_cache(backing)
+    cache.create_task(new_task("t1"))
+    cache.flush()
+    cache.update_task("t1", status="Processing", payload={"a": 1})
+    cache.add_history("t1", history_entry("first"))
+
+    backing.failing = True
+    assert cache.flush() == 0
+    cache.update_task("t1", payload={"b": 2})
+    cache.add_history("t1", history_entry("second"))
+    backing.failing = False
+
+    assert cache.flush() == 1
+    task = backing.get_task("t1")
+    assert task["status"] == "Processing"
+    assert task["payload"] == {"a": 1, "b": 2}
+    assert events(task) == ["Task created: t1", "first", "second"]
+    assert task["version"] == cache.get_task("t1")["version"]
+    cache.close()
+
+def test_finalize_reports_a_failed_flush_and_retries_it(backing):
+    cache = make_cache(backing, durability="finalize")
+    cache.create_task(new_task("t1"))
+    backing.failing = True
+    assert not cache.finalize_task("t1", "Completed", {"result": "done"}, history_entry("Task finalized"))
+    cache.add_history("t1", history_entry("after"))
+    backing.failing = False
+
+    assert cache.flush_task("t1")
+    task = backing.get_task("t1")
+    assert task["status"] == "Completed"
+    assert task["result"] == "done"
+    assert events(task) == ["Task created: t1", "Task finalized", "after"]
+    cache.close()
+
+def test_unflushed_tasks_are_not_evicted(backing):
+    cache = make_cache(backing, max_entries=1)
+    cache.create_task(new_task("t1"))
+    backing.failing = True
+    cache.flush()
+    backing.failing = False
+    # t1 still has unwritten changes, so caching t2 must not evict it.
+    cache.create_task(new_task("t2"))
+    assert cache.get_task("t1")["task_id"] == "t1"
+    cache.flush()
+    assert backing.get_task("t1") is not None
+    cache.close()
+
+def test_version_checks_are_made_in_memory(backing):
+    cache = make_cache(backing)
+    cache.create_task(new_task("t1"))
+    with pytest.raises(VersionConflictError):
+        cache.update_task("t1", status="Processing", expected_version=7)
+    assert cache.update_task("t1", status="Processing", expected_version=1)
+    cache.close()
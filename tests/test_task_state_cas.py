@@ -0,0 +1,71 @@
+# Tests for compare-and-swap task state updates
+
+import threading
+
+import pytest
+
+from src.tasks_state.task_state_manager import TaskStateManager
+from src.tasks_state.task_storage import (
+    JsonFileTaskStorage, SqliteTaskStorage, VersionConflictError
+)
+from tests.test_task_storage import new_task
+
+@pytest.fixture(params=["json", "sqlite"])
+def storage(request, tmp_path):
+    if request.param == "json":
+        backend = JsonFileTaskStorage(str(tmp_path / "state"), str(tmp_path / "history"), fsync_policy="none", lock_stripes=4)
+    else:
+        backend = SqliteTaskStorage(str(tmp_path / "tasks.db"))
+    yield backend
+    backend.close()
+
+@pytest.fixture
+def manager(configure, storage, tmp_path):
+    configure("task_state", {"cas_retries": 50})
+    task_state_manager = TaskStateManager(base_dir=str(tmp_path / "state"), storage=storage)
+    yield task_state_manager
+    task_state_manager.close()
+
+def test_stale_expected_version_is_rejected(storage):
+    storage.create_task(new_task("t1"))
+    assert storage.update_task("t1", status="Processing", expected_version=1)
+    with pytest.raises(VersionConflictError) as conflict:
+        storage.update_task("t1", status="Failed", expected_version=1)
+    assert conflict.value.current_version == 2
+    assert storage.get_task("t1")["status"] == "Processing"
+
+def test_concurrent_payload_updates_are_all_kept(manager):
+    task_id = manager.create_task_state("prompt")
+    threads = [
+        threading.Thread(target=manager.update_task_state, args=(task_id,), kwargs={"new_payload": {f"key{n}": n}})
+        for n in range(8)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    task = manager.get_task_state(task_id)
+    assert task["payload"] == {f"key{n}": n for n in range(8)}
+    assert task["version"] == 9
+
+def test_terminal_status_is_never_overwritten(manager):
+    task_id = manager.create_task_state("prompt")
+    manager.complete_task(task_id, final_result="done")
+    manager.update_task_state(task_id, new_status="Processing")
+    manager.fail_task(task_id, "too late")
+    task = manager.get_task_state(task_id)
+    assert task["status"] == "Completed"
+    assert task["error"] is None
+
+def test_only_one_concurrent_finalization_wins(manager):
+    task_id = manager.create_task_state("prompt")
+    threads = [threading.Thread(target=manager.complete_task, args=(task_id, "done")),
+               threading.Thread(target=manager.fail_task, args=(task_id, "boom"))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    task = manager.get_task_state(task_id)
+    finalizations = [entry for entry in task["history"] if entry["event"].startswith("Task finalized")]
+    assert len(finalizations) == 1
+    assert task["status"] in ("Completed", "Failed")
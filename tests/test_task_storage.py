@@ -0,0 +1,150 @@
+# Tests for the task state storage backends
+
+import datetime
+import json
+import os
+import threading
+
+import pytest
+
+from src.tasks_state.task_storage import JsonFileTaskStorage, SqliteTaskStorage, EventLogTaskStorage
+
+def new_task(task_id: str, status: str = "Pending") -> dict:
+    timestamp = datetime.datetime.now().isoformat()
+    return {
+        "task_id": task_id,
+        "prompt": f"prompt of {task_id}",
+        "status": status,
+        "payload": {},
+        "history": [{"timestamp": timestamp, "event": f"Task created: {task_id}"}],
+        "result": None,
+        "error": None,
+        "version": 1,
+    }
+
+def history_entry(event: str) -> dict:
+    return {"timestamp": datetime.datetime.now().isoformat(), "event": event}
+
+@pytest.fixture(params=["json", "sqlite", "eventlog"])
+def storage(request, tmp_path):
+    if request.param == "json":
+        backend = JsonFileTaskStorage(str(tmp_path / "state"), str(tmp_path / "history"), fsync_policy="none")
+    elif request.param == "sqlite":
+        backend = SqliteTaskStorage(str(tmp_path / "tasks.db"))
+    else:
+        backend = EventLogTaskStorage(str(tmp_path / "events"), fsync_policy="none")
+    yield backend
+    backend.close()
+
+def test_task_lifecycle(storage):
+    assert storage.create_task(new_task("t1"))
+    assert storage.update_task("t1", status="Processing", payload={"analysis": {"target_role": "Coder"}})
+    assert storage.add_history_batch("t1", [history_entry("step 1"), history_entry("step 2")])
+    assert storage.finalize_task("t1", "Completed", {"result": "done"}, history_entry("Task finalized"))
+
+    task = storage.get_task("t1")
+    assert task["status"] == "Completed"
+    assert task["result"] == "done"
+    assert task["payload"] == {"analysis": {"target_role": "Coder"}}
+    assert [entry["event"] for entry in task["history"]] == [
+        "Task created: t1", "step 1", "step 2", "Task finalized",
+    ]
+    assert task["version"] == 4
+
+def test_missing_task(storage):
+    assert storage.get_task("missing") is None
+    assert not storage.update_task("missing", status="Processing")
+    assert not storage.add_history("missing", history_entry("lost"))
+    assert not storage.finalize_task("missing", "Failed", {"error": "x"}, history_entry("Task finalized"))
+
+def test_payload_updates_merge_top_level_keys(storage):
+    storage.create_task(new_task("t1"))
+    storage.update_task("t1", payload={"a": 1, "b": 1})
+    storage.update_task("t1", payload={"b": 2})
+    assert storage.get_task("t1")["payload"] == {"a": 1, "b": 2}
+
+def test_json_backend_moves_finalized_tasks_to_history(tmp_path):
+    storage = JsonFileTaskStorage(str(tmp_path / "state"), str(tmp_path / "history"), fsync_policy="none")
+    storage.create_task(new_task("t1"))
+    assert (tmp_path / "state" / "t1.json").exists()
+    storage.finalize_task("t1", "Failed", {"error": "boom"}, history_entry("Task finalized"))
+    assert not (tmp_path / "state" / "t1.json").exists()
+    assert (tmp_path / "history" / "t1.json").exists()
+    assert storage.get_task("t1")["error"] == "boom"
+
+def test_json_backend_writes_finalized_tasks_back_to_history(tmp_path):
+    storage = JsonFileTaskStorage(str(tmp_path / "state"), str(tmp_path / "history"), fsync_policy="none")
+    storage.create_task(new_task("t1"))
+    storage.finalize_task("t1", "Completed", {"result": "done"}, history_entry("Task finalized"))
+    assert storage.update_task("t1", payload={"late": True})
+    assert storage.add_history("t1", history_entry("late entry"))
+    assert not (tmp_path / "state" / "t1.json").exists()
+    task = json.loads((tmp_path / "history" / "t1.json").read_text())
+    assert task["payload"] == {"late": True}
+    assert task["history"][-1]["event"] == "late entry"
+
+def test_json_backend_readers_never_see_a_partial_document(tmp_path):
+    storage = JsonFileTaskStorage(str(tmp_path / "state"), str(tmp_path / "history"), fsync_policy="none")
+    storage.create_task(new_task("t1"))
+    # Large enough that a file rewritten in place would be read half-written.
+    blob = "x" * 200_000
+    done = threading.Event()
+    torn = []
+
+    def write(worker):
+        for n in range(50):
+            storage.update_task("t1", payload={"blob": blob, f"writer-{worker}": n})
+
+    def read():
+        while not done.is_set():
+            task = storage.get_task("t1")
+            if task is None or task["payload"].get("blob", blob) != blob:
+                torn.append(task)
+
+    readers = [threading.Thread(target=read) for _ in range(2)]
+    writers = [threading.Thread(target=write, args=(worker,)) for worker in range(2)]
+    for thread in readers + writers:
+        thread.start()
+    for thread in writers:
+        thread.join()
+    done.set()
+    for thread in readers:
+        thread.join()
+    assert torn == []
+    assert [name for name in os.listdir(tmp_path / "state") if name.startswith(".tmp-")] == []
+
+def test_json_backend_serializes_writers_on_the_same_stripe(tmp_path):
+    # One stripe: every task shares the lock, so concurrent read-modify-write cycles
+    # on the same task (and across tasks) must not lose an update.
+    storage = JsonFileTaskStorage(str(tmp_path / "state"), str(tmp_path / "history"),
+                                  fsync_policy="none", lock_stripes=1)
+    for task_id in ("t1", "t2"):
+        storage.create_task(new_task(task_id))
+
+    def write(task_id, worker):
+        for n in range(25):
+            storage.update_task(task_id, payload={f"{worker}-{n}": n})
+            storage.add_history(task_id, history_entry(f"{worker}-{n}"))
+
+    threads = [threading.Thread(target=write, args=(task_id, worker))
+               for task_id in ("t1", "t2") for worker in ("a", "b")]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert os.listdir(tmp_path / "state" / ".locks") == ["stripe-000.lock"]
+    for task_id in ("t1", "t2"):
+        task = storage.get_task(task_id)
+        assert len(task["payload"]) == 50
+        assert len(task["history"]) == 51
+        assert task["version"] == 101
+
+@pytest.mark.parametrize("policy, expected", [("always", 2), ("data", 1), ("none", 0), ("unknown", 1)])
+def test_json_backend_fsync_policy(tmp_path, monkeypatch, policy, expected):
+    storage = JsonFileTaskStorage(str(tmp_path / "state"), str(tmp_path / "history"), fsync_policy=policy)
+    synced = []
+    real_fsync = os.fsync
+    monkeypatch.setattr(os, "fsync", lambda fd: (synced.append(fd), real_fsync(fd)))
+    storage.create_task(new_task("t1"))
+    # "always" also syncs the directory, so the rename itself is durable.
+    assert len(synced) == expected